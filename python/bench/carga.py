@@ -0,0 +1,379 @@
+"""Gera carga no sistema completo e mede vazão e latência por serviço e a latência de entrega pub/sub.
+
+Sobe o broker e N servidores como subprocessos em localhost; o proxy XSUB/XPUB e o servidor de
+referência rodam dentro deste processo (python/proxy e python/referencia). O resultado é gravado em JSON.
+
+Uso: python carga.py [--servers N] [--clients N] [--duration S] [--mix publish=4,message=3,...]
+                     [--output resultado.json] [--baseline anterior.json]
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import msgpack
+import zmq
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+BROKER = PYTHON_DIR / 'broker' / 'broker.py'
+SERVER = PYTHON_DIR / 'servidor' / 'servidor.py'
+sys.path.insert(0, str(PYTHON_DIR / 'proxy'))
+sys.path.insert(0, str(PYTHON_DIR / 'referencia'))
+
+from proxy import Proxy  # noqa: E402
+from referencia import Referencia  # noqa: E402
+
+BROKER_ADDRESS = "tcp://127.0.0.1:5555"
+PROXY_PUB_ADDRESS = "tcp://127.0.0.1:5557"
+PROXY_SUB_ADDRESS = "tcp://127.0.0.1:5558"
+REFERENCE_ADDRESS = "tcp://127.0.0.1:5559"
+
+DEFAULT_MIX = "publish=4,message=3,history_channel=1,history_messages=1,users=1,channels=1,login=1"
+REQUEST_TIMEOUT_MS = 5000
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        service, _, weight = item.partition('=')
+        mix[service.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, q):
+    """Percentil por posição (nearest rank) de uma lista já ordenada"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, seconds):
+    values = sorted(latencies)
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None  # noqa: E731
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'throughput': round(len(values) / seconds, 1) if seconds else 0.0,
+        'mean_ms': to_ms(sum(values) / len(values)) if values else None,
+        'p50_ms': to_ms(percentile(values, 0.50)),
+        'p99_ms': to_ms(percentile(values, 0.99)),
+        'p999_ms': to_ms(percentile(values, 0.999)),
+        'max_ms': to_ms(values[-1]) if values else None
+    }
+
+
+# --- Clientes ------------------------------------------------------------------------------------
+
+def request(socket, service, data):
+    data = dict(data, timestamp=time.time(), clock=0)
+    socket.send(msgpack.packb({"service": service, "data": data}))
+    return msgpack.unpackb(socket.recv())
+
+
+def build_request(service, rng, users, channels, payload):
+    user = rng.choice(users)
+    if service == 'login':
+        return {"user": user}
+    if service == 'publish':
+        # O instante de envio segue na mensagem para medir a entrega aos inscritos
+        return {"user": user, "channel": rng.choice(channels), "message": f"{time.time():.6f} {payload}"}
+    if service == 'message':
+        return {"from": user, "to": rng.choice(users), "message": payload}
+    if service == 'history_channel':
+        return {"channel": rng.choice(channels), "limit": 50, "newest_first": True}
+    if service == 'history_messages':
+        return {"user": user, "limit": 50, "newest_first": True}
+    return {}
+
+
+def client_worker(worker_id, config, start_at, results):
+    """Cliente em malha fechada: uma requisição por vez, latência medida do envio à resposta"""
+    rng = random.Random(config['seed'] + worker_id)
+    services = list(config['mix'])
+    weights = [config['mix'][service] for service in services]
+    payload = "x" * config['payload']
+
+    context = zmq.Context()
+    socket = None
+    latencies = {service: [] for service in services}
+    errors = {service: 0 for service in services}
+    measure_from = start_at + config['warmup']
+    deadline = measure_from + config['duration']
+
+    while time.time() < start_at:
+        time.sleep(0.001)
+
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if socket is None:
+            socket = context.socket(zmq.REQ)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.RCVTIMEO, REQUEST_TIMEOUT_MS)
+            socket.connect(config['broker'])
+
+        service = rng.choices(services, weights)[0]
+        data = build_request(service, rng, config['users'], config['channels'], payload)
+        started = time.perf_counter()
+        try:
+            response = request(socket, service, data)
+            failed = 'error' in response or response.get('success') is False
+        except zmq.Again:
+            # REQ fica inutilizável após um timeout
+            socket.close()
+            socket = None
+            failed = True
+        elapsed = time.perf_counter() - started
+
+        if now >= measure_from:
+            if failed:
+                errors[service] += 1
+            else:
+                latencies[service].append(elapsed)
+
+    if socket is not None:
+        socket.close()
+    context.term()
+    results.put(('client', latencies, errors))
+
+
+def subscriber_worker(config, start_at, results, ready):
+    """Inscrito em todos os canais: mede o atraso entre o envio da publicação e a entrega"""
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    socket.connect(config['proxy_sub'])
+    for channel in config['channels']:
+        socket.setsockopt_string(zmq.SUBSCRIBE, channel)
+    ready.set()
+
+    measure_from = start_at + config['warmup']
+    deadline = measure_from + config['duration'] + 1.0  # Entregas em trânsito no fim da janela
+    latencies = []
+
+    while time.time() < deadline:
+        if not socket.poll(100):
+            continue
+        topic, body = socket.recv_multipart()
+        received = time.time()
+        try:
+            sent = float(msgpack.unpackb(body)['message'].split(' ', 1)[0])
+        except (KeyError, ValueError):
+            continue
+        if sent >= measure_from:
+            latencies.append(received - sent)
+
+    socket.close(linger=0)
+    context.term()
+    results.put(('subscriber', latencies, None))
+
+
+# --- Orquestração --------------------------------------------------------------------------------
+
+def wait_until_ready(context, timeout=30):
+    """Espera o broker encaminhar uma requisição a algum servidor"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.setsockopt(zmq.RCVTIMEO, 1000)
+        socket.connect(BROKER_ADDRESS)
+        try:
+            request(socket, 'users', {})
+            return True
+        except zmq.Again:
+            pass
+        finally:
+            socket.close()
+    return False
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PYTHON_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(result, baseline_path):
+    """Variação de vazão e p99 em relação a um resultado anterior"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    changes = {}
+    for service, current in result['services'].items():
+        previous = baseline.get('services', {}).get(service)
+        if not previous:
+            continue
+        change = {}
+        for field in ('throughput', 'p99_ms'):
+            if current.get(field) and previous.get(field):
+                change[field] = f"{(current[field] - previous[field]) / previous[field] * 100:+.1f}%"
+        changes[service] = change
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--subscribers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=10.0, help='segundos medidos')
+    parser.add_argument('--warmup', type=float, default=2.0, help='segundos descartados no início')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='serviço=peso, separados por vírgula')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--payload', type=int, default=100, help='bytes de texto por mensagem')
+    parser.add_argument('--broker-mode', default='balanced')
+    parser.add_argument('--proxy-mode', choices=('proxy', 'fanout'), default='proxy',
+                        help="fanout conta descartes/atrasos por tópico no proxy (python/proxy/difusao.py)")
+    parser.add_argument('--server-runtime', choices=('poll', 'asyncio'), default='poll',
+                        help="laço principal dos servidores (python/servidor/assincrono.py)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='arquivo JSON de saída (padrão: stdout)')
+    parser.add_argument('--baseline', help='resultado anterior para comparação')
+    parser.add_argument('--verbose', action='store_true', help='mostra a saída do broker e dos servidores')
+    args = parser.parse_args()
+
+    config = {
+        'mix': parse_mix(args.mix),
+        'users': [f"bench{i}" for i in range(args.users)],
+        'channels': [f"canal{i}" for i in range(args.channels)],
+        'payload': args.payload,
+        'duration': args.duration,
+        'warmup': args.warmup,
+        'seed': args.seed,
+        'broker': BROKER_ADDRESS,
+        'proxy_sub': PROXY_SUB_ADDRESS
+    }
+
+    context = zmq.Context()
+    proxy = Proxy(context, mode=args.proxy_mode)
+    proxy.metrics_port = 0  # Os contadores do modo fanout são lidos direto do objeto no fim
+    threading.Thread(target=proxy.run, daemon=True).start()
+    threading.Thread(target=Referencia(context).run, daemon=True).start()
+
+    output = None if args.verbose else subprocess.DEVNULL
+    base_env = dict(os.environ, PYTHONUNBUFFERED='1', METRICS_PORT='0', BROKER_MODE=args.broker_mode,
+                    SERVER_RUNTIME=args.server_runtime,
+                    BROKER_ENDPOINT="tcp://127.0.0.1:5556", PROXY_PUB_ENDPOINT=PROXY_PUB_ADDRESS,
+                    PROXY_SUB_ENDPOINT=PROXY_SUB_ADDRESS, REFERENCE_ENDPOINT=REFERENCE_ADDRESS)
+    processes = []
+    data_dirs = []
+
+    try:
+        processes.append(subprocess.Popen([sys.executable, str(BROKER)], cwd=BROKER.parent, env=base_env,
+                                          stdout=output, stderr=output))
+        for i in range(args.servers):
+            data_dir = tempfile.mkdtemp(prefix='bbs-bench-')
+            data_dirs.append(data_dir)
+            env = dict(base_env, SERVER_NAME=f"bench-servidor{i + 1}", DATA_DIR=data_dir)
+            processes.append(subprocess.Popen([sys.executable, str(SERVER)], cwd=SERVER.parent,
+                                              env=env, stdout=output, stderr=output))
+
+        if not wait_until_ready(context):
+            raise SystemExit("Broker/servidores não responderam")
+        time.sleep(1.0)  # Heartbeats de todos os servidores
+
+        # Estado inicial: usuários e canais existentes antes da medição
+        setup = context.socket(zmq.REQ)
+        setup.connect(BROKER_ADDRESS)
+        for user in config['users']:
+            request(setup, 'login', {"user": user})
+        for channel in config['channels']:
+            request(setup, 'channel', {"channel": channel, "user": config['users'][0]})
+        setup.close()
+
+        results = multiprocessing.Queue()
+        start_at = time.time() + 1.0
+        workers = []
+        for _ in range(args.subscribers):
+            ready = multiprocessing.Event()
+            worker = multiprocessing.Process(target=subscriber_worker, args=(config, start_at, results, ready))
+            worker.start()
+            ready.wait(5)
+            workers.append(worker)
+        for i in range(args.clients):
+            worker = multiprocessing.Process(target=client_worker, args=(i, config, start_at, results))
+            worker.start()
+            workers.append(worker)
+
+        latencies = {service: [] for service in config['mix']}
+        errors = {service: 0 for service in config['mix']}
+        fanout = []
+        for _ in workers:
+            kind, values, worker_errors = results.get()
+            if kind == 'subscriber':
+                fanout.extend(values)
+                continue
+            for service, service_latencies in values.items():
+                latencies[service].extend(service_latencies)
+                errors[service] += worker_errors[service]
+        for worker in workers:
+            worker.join()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        context.term()
+        for data_dir in data_dirs:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        'config': {
+            'servers': args.servers,
+            'clients': args.clients,
+            'subscribers': args.subscribers,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'mix': config['mix'],
+            'users': args.users,
+            'channels': args.channels,
+            'payload': args.payload,
+            'broker_mode': args.broker_mode,
+            'proxy_mode': args.proxy_mode,
+            'server_runtime': args.server_runtime
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'commit': git_commit(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(start_at))
+        },
+        'services': {service: summarize(latencies[service], errors[service], args.duration)
+                     for service in config['mix']},
+        'total': summarize(all_latencies, sum(errors.values()), args.duration),
+        'fanout': summarize(fanout, 0, args.duration)
+    }
+    if args.proxy_mode == 'fanout':
+        counters = proxy.metrics.counters
+        result['proxy'] = {name: int(sum(counters.get(f'bbs_proxy_{name}_total', {}).values()))
+                           for name in ('messages', 'delivered', 'dropped', 'conflated', 'late', 'blocked')}
+    if args.baseline:
+        result['baseline'] = {'path': args.baseline, 'changes': compare(result, args.baseline)}
+
+    text = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+        print(f"Resultado gravado em {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
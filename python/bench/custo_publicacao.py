@@ -0,0 +1,90 @@
+"""Mede a serialização de cada publicação (log, frame de replicação e pub/sub): CPU e bytes por publicação.
+
+Compara o caminho antigo (uma serialização por destino) com o RecordCodec nos esquemas 'map' e 'array'.
+
+Uso: python custo_publicacao.py [--publications N] [--frame-ops N] [--payload BYTES] [--repeat N]
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import msgpack
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'servidor'))
+
+from persistencia import WriteAheadLog  # noqa: E402
+from registros import Publication, encode_record  # noqa: E402
+from serializacao import RecordCodec  # noqa: E402
+
+
+def frame(ops, last_seq):
+    return {"type": "frame", "source": "servidor1", "first_seq": last_seq - len(ops) + 1, "last_seq": last_seq,
+            "ops": ops, "sender": "servidor1", "clock": 1, "timestamp": time.time()}
+
+
+def run(mode, publications, frame_ops, directory):
+    """Caminho de escrita de handle_publish + envio do frame; retorna (µs, bytes de log, de frame e de pub/sub)"""
+    codec = RecordCodec(mode) if mode != 'antigo' else None
+    wal = WriteAheadLog(Path(directory) / mode, fsync_policy='interval', fsync_interval=3600,
+                        default=codec.default if codec else encode_record)
+    frame_bytes = pubsub_bytes = 0
+    ops = []
+
+    started = time.perf_counter()
+    for seq, publication in enumerate(publications, 1):
+        if codec is None:
+            wal.append_batch([('publish', publication, ('servidor1', seq))])
+            ops.append({"seq": seq, "operation": 'publish', "data": publication})
+            payload = msgpack.packb(publication.to_dict())
+        else:
+            packed = codec.pack(publication)
+            wal.append_batch([('publish', packed, ('servidor1', seq))])
+            ops.append(codec.pack_op(seq, 'publish', packed))
+            payload = codec.wire(publication, packed)
+        pubsub_bytes += len(payload)
+
+        if len(ops) >= frame_ops:
+            message = frame(ops, seq)
+            packed_frame = codec.pack_tree(message) if codec else msgpack.packb(message, default=encode_record)
+            frame_bytes += len(packed_frame)
+            ops = []
+    elapsed = time.perf_counter() - started
+    wal.close()
+
+    count = len(publications)
+    return {
+        "us_per_publish": round(elapsed / count * 1e6, 2),
+        "wal_bytes": round(wal.bytes_written / count, 1),
+        "frame_bytes": round(frame_bytes / count, 1),
+        "pubsub_bytes": round(pubsub_bytes / count, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--publications', type=int, default=50000)
+    parser.add_argument('--frame-ops', type=int, default=64)
+    parser.add_argument('--payload', type=int, default=100, help="bytes de texto por publicação")
+    parser.add_argument('--repeat', type=int, default=5, help="rodadas por modo; vale a mais rápida")
+    args = parser.parse_args()
+
+    publications = [Publication(f"user{i % 100}", f"canal{i % 10}", "x" * args.payload, 1700000000.0 + i, i)
+                    for i in range(args.publications)]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # Modos intercalados: variações da máquina afetam todos igualmente
+        for round_number in range(args.repeat):
+            for mode in ('antigo', 'map', 'array'):
+                result = run(mode, publications, args.frame_ops, f"{directory}/{round_number}")
+                if mode not in results or result['us_per_publish'] < results[mode]['us_per_publish']:
+                    results[mode] = result
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
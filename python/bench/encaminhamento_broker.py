@@ -0,0 +1,123 @@
+"""Mede a vazão do broker (mensagens/s ida e volta) em cada modo de encaminhamento.
+
+Sobe o broker como subprocesso e usa servidores de eco no lugar dos servidores reais.
+Uso: python encaminhamento_broker.py [--modes balanced,dealer,proxy] [--messages N] [--clients N] [--window N]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import msgpack
+import zmq
+
+BROKER = Path(__file__).resolve().parent.parent / 'broker' / 'broker.py'
+CONTROL_FRAME = b"BBS_CTRL"
+
+
+def echo_server(context, stop, capacity):
+    """Devolve cada requisição como veio; anuncia capacidade para o modo balanceado"""
+    socket = context.socket(zmq.DEALER)
+    socket.connect("tcp://localhost:5556")
+    heartbeat = [CONTROL_FRAME, b"heartbeat", msgpack.packb({"name": "eco", "capacity": capacity})]
+    last_heartbeat = 0
+
+    while not stop.is_set():
+        if time.time() - last_heartbeat >= 0.5:
+            socket.send_multipart(heartbeat)
+            last_heartbeat = time.time()
+        if socket.poll(50):
+            while True:
+                try:
+                    frames = socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                except zmq.Again:
+                    break
+                socket.send_multipart(frames, copy=False)
+
+    socket.close(linger=0)
+
+
+def client(context, messages, window, payload, done):
+    """Mantém até 'window' requisições em voo (o modo balanceado as serializa por cliente)"""
+    socket = context.socket(zmq.DEALER)
+    socket.connect("tcp://localhost:5555")
+    sent = received = 0
+
+    while received < messages:
+        while sent < messages and sent - received < window:
+            socket.send(payload)
+            sent += 1
+        if not socket.poll(5000):
+            break
+        socket.recv()
+        received += 1
+
+    done.append(received)
+    socket.close(linger=0)
+
+
+def run_mode(mode, args):
+    env = dict(os.environ, BROKER_MODE=mode, PYTHONUNBUFFERED='1')
+    broker = subprocess.Popen([sys.executable, str(BROKER)], cwd=BROKER.parent, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    context = zmq.Context()
+    stop = threading.Event()
+    servers = [threading.Thread(target=echo_server, args=(context, stop, args.window * args.clients))
+               for _ in range(args.servers)]
+
+    try:
+        for server in servers:
+            server.start()
+        time.sleep(1.5)  # Conexões e primeiro heartbeat
+
+        payload = msgpack.packb({"service": "users", "data": {"x": "y" * args.size}})
+        done = []
+        clients = [threading.Thread(target=client, args=(context, args.messages, args.window, payload, done))
+                   for _ in range(args.clients)]
+
+        cpu_before = os.times()
+        start = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        stop.set()
+        for server in servers:
+            server.join()
+        broker.terminate()
+        broker.wait()
+        context.term()
+
+    total = sum(done)
+    return {
+        'messages': total,
+        'seconds': elapsed,
+        'msgs_per_sec': total / elapsed if elapsed else 0.0,
+        'complete': total == args.messages * args.clients,
+        'bench_cpu_seconds': sum(os.times()[:2]) - sum(cpu_before[:2])
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='balanced,dealer,proxy')
+    parser.add_argument('--messages', type=int, default=20000, help='mensagens por cliente')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--servers', type=int, default=2)
+    parser.add_argument('--window', type=int, default=64)
+    parser.add_argument('--size', type=int, default=100, help='bytes de carga útil')
+    args = parser.parse_args()
+
+    results = {mode: run_mode(mode, args) for mode in args.modes.split(',')}
+    print(json.dumps({'clients': args.clients, 'servers': args.servers, 'window': args.window,
+                      'size': args.size, 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Mede a memória por registro: dicionários (formato antigo) x registros compactos.
+
+Uso: python memoria_registros.py [--records N] [--users N] [--channels N]
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'servidor'))
+
+from registros import Publication, Message  # noqa: E402
+
+
+def generate(records, users, channels, seed=42):
+    """Gera publicações e mensagens como o json.load as devolveria (strings repetidas, não compartilhadas)"""
+    rng = random.Random(seed)
+    publications = []
+    messages = []
+
+    for clock in range(records):
+        # json.loads cria um objeto str novo para cada valor, mesmo quando repetido
+        user = json.loads(f'"user{rng.randrange(users)}"')
+        channel = json.loads(f'"canal{rng.randrange(channels)}"')
+        to_user = json.loads(f'"user{rng.randrange(users)}"')
+        text = f"mensagem {clock} " + "x" * rng.randrange(10, 60)
+
+        publications.append({'user': user, 'channel': channel, 'message': text,
+                             'timestamp': 1700000000.0 + clock, 'clock': clock})
+        messages.append({'from': user, 'to': to_user, 'message': text,
+                         'timestamp': 1700000000.0 + clock, 'clock': clock})
+
+    return publications, messages
+
+
+def measure(build):
+    """Bytes alocados por build() e ainda vivos ao final"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=50)
+    args = parser.parse_args()
+
+    results = {}
+
+    for kind in ('publications', 'messages'):
+        # O texto das mensagens é o mesmo nos dois formatos; só a estrutura é comparada
+        _, dict_bytes = measure(lambda: generate(args.records, args.users, args.channels)[kind == 'messages'])
+
+        def build_compact():
+            records = generate(args.records, args.users, args.channels)[kind == 'messages']
+            if kind == 'publications':
+                return [Publication.from_dict(record) for record in records]
+            return [Message.from_dict(record) for record in records]
+
+        _, compact_bytes = measure(build_compact)
+
+        # Só os textos, para separar o custo da estrutura do custo do conteúdo
+        _, text_bytes = measure(lambda: [record['message'] for record in
+                                         generate(args.records, args.users, args.channels)[kind == 'messages']])
+
+        results[kind] = {
+            'dict_bytes_per_record': dict_bytes / args.records,
+            'compact_bytes_per_record': compact_bytes / args.records,
+            'ratio': dict_bytes / compact_bytes,
+            'text_bytes_per_record': text_bytes / args.records,
+            'overhead_ratio': (dict_bytes - text_bytes) / (compact_bytes - text_bytes)
+        }
+
+    print(json.dumps({'records': args.records, 'users': args.users, 'channels': args.channels,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
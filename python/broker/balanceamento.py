@@ -0,0 +1,116 @@
+import hashlib
+import time
+
+# Primeiro frame das mensagens de controle servidor -> broker (nunca colide com identidades do ROUTER)
+CONTROL_FRAME = b"BBS_CTRL"
+
+# Serviços sem efeito colateral: podem ser repetidos em outro servidor após timeout
+IDEMPOTENT_SERVICES = {'users', 'channels', 'history_messages', 'history_channel', 'sync'}
+
+# Todos os serviços atendidos pelos servidores (rótulos das métricas)
+SERVICES = IDEMPOTENT_SERVICES | {'login', 'channel', 'publish', 'message', 'publish_batch', 'message_batch', 'retention'}
+
+
+def retryable_on_failure(service, data):
+    """Podem ir a outro servidor quando o primeiro morre: leituras e escritas com 'request_id'.
+
+    Após um simples timeout só as leituras são repetidas: o servidor lento ainda pode aplicar a escrita, e o
+    par que recebesse a cópia não saberia disso (a tabela de request_id só chega a ele pela replicação).
+    """
+    return service in IDEMPOTENT_SERVICES or (isinstance(data, dict) and data.get('request_id') is not None)
+
+
+def request_pin(data):
+    """'request_id' da requisição, que fixa o servidor: repetições do cliente caem onde a original foi registrada"""
+    if isinstance(data, dict) and data.get('request_id') is not None:
+        return str(data['request_id'])
+    return None
+
+
+def pin_score(pin, name):
+    """Rendezvous hashing: cada ID ordena os servidores da mesma forma em qualquer broker"""
+    return hashlib.md5(f"{pin}@{name}".encode()).digest()[:8]
+
+
+class ServerState:
+    """Estado de um servidor visto pelo broker"""
+
+    def __init__(self, identity, name, capacity):
+        self.identity = identity
+        self.name = name
+        self.capacity = capacity
+        self.inflight = 0
+        self.latency = None  # Média móvel exponencial (s)
+        self.last_seen = time.time()
+
+    def load(self):
+        return self.inflight / self.capacity
+
+
+class ServerPool:
+    """Servidores disponíveis para o broker balanceado (padrão 'ready worker' com crédito por servidor)"""
+
+    def __init__(self, heartbeat_interval=1.0, liveness=3, latency_alpha=0.2):
+        self.heartbeat_interval = heartbeat_interval
+        self.liveness = liveness  # Heartbeats perdidos até o servidor ser considerado morto
+        self.latency_alpha = latency_alpha
+        self.servers = {}
+
+    def heartbeat(self, identity, info):
+        """Registra (ou reativa) o servidor e atualiza sua capacidade"""
+        capacity = max(1, int(info.get('capacity', 1)))
+        server = self.servers.get(identity)
+        if server is None:
+            server = self.servers[identity] = ServerState(identity, info.get('name', identity.hex()), capacity)
+            print(f"✅ Servidor disponível: {server.name} (capacidade {capacity})")
+        server.capacity = capacity
+        server.last_seen = time.time()
+        return server
+
+    def seen(self, identity):
+        server = self.servers.get(identity)
+        if server is not None:
+            server.last_seen = time.time()
+        return server
+
+    def pick(self, exclude=(), allowed=None, pin=None):
+        """Servidor vivo menos carregado com crédito livre (desempate pela latência); 'allowed' restringe por nome"""
+        if pin is not None:
+            return self.pinned(pin, exclude, allowed)
+        best = None
+        for server in self.servers.values():
+            if server.identity in exclude or server.inflight >= server.capacity:
+                continue
+            if allowed is not None and server.name not in allowed:
+                continue
+            key = (server.load(), server.latency if server.latency is not None else 0.0)
+            if best is None or key < best[0]:
+                best = (key, server)
+        return best[1] if best else None
+
+    def pinned(self, pin, exclude=(), allowed=None):
+        """Primeiro servidor vivo na ordem do pin, mesmo mais carregado; sem crédito livre a requisição espera nele"""
+        candidates = [server for server in self.servers.values()
+                      if server.identity not in exclude and (allowed is None or server.name in allowed)]
+        if not candidates:
+            return None
+        server = max(candidates, key=lambda server: pin_score(pin, server.name))
+        return server if server.inflight < server.capacity else None
+
+    def record_latency(self, server, elapsed):
+        if server.latency is None:
+            server.latency = elapsed
+        else:
+            server.latency += self.latency_alpha * (elapsed - server.latency)
+
+    def expire(self):
+        """Remove e retorna os servidores que perderam heartbeats demais"""
+        deadline = time.time() - self.heartbeat_interval * self.liveness
+        dead = [server for server in self.servers.values() if server.last_seen < deadline]
+        for server in dead:
+            del self.servers[server.identity]
+            print(f"⚠️  Servidor {server.name} sem heartbeat, removido do balanceamento")
+        return dead
+
+    def __len__(self):
+        return len(self.servers)
@@ -1,78 +1,351 @@
+import argparse
+import os
+import struct
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+import msgpack
 import zmq
 
+# Módulos compartilhados entre os componentes (métricas, particionamento) ficam em python/comum
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'comum'))
+
+from balanceamento import CONTROL_FRAME, IDEMPOTENT_SERVICES, SERVICES, ServerPool, request_pin, retryable_on_failure
+from metricas import Metrics, Log, start_metrics_server
+from particionamento import ring_from_env, shard_key
+
 class Broker:
-    def __init__(self):
-        self.context = zmq.Context()
-        
+    def __init__(self, context=None, frontend=None, backend=None, control=None):
+        self.context = context or zmq.Context()
+
+        # Endpoints configuráveis para rodar fora do Docker (ipc://, inproc:// com contexto compartilhado)
+        self.frontend = frontend or os.getenv('BROKER_FRONTEND', 'tcp://*:5555')
+        self.backend = backend or os.getenv('BROKER_BACKEND', 'tcp://*:5556')
+        self.control = control or os.getenv('BROKER_CONTROL', 'tcp://*:5560')
+
+        # 'balanced': escolhe o servidor por carga e saúde; 'dealer': round-robin do DEALER;
+        # 'proxy': round-robin dentro da libzmq (zmq.proxy_steerable), sem passar pelo Python
+        self.mode = os.getenv('BROKER_MODE', 'balanced')
+        if self.mode not in ('balanced', 'dealer', 'proxy'):
+            raise ValueError(f"Modo de broker inválido: {self.mode}")
+
+        # Mensagens drenadas por socket a cada retorno do poll
+        self.drain_budget = int(os.getenv('BROKER_DRAIN_BUDGET', '256'))
+
         # Socket para clientes (ROUTER)
         self.client_socket = self.context.socket(zmq.ROUTER)
-        self.client_socket.bind("tcp://*:5555")
-        
-        # Socket para servidores (DEALER)
-        self.server_socket = self.context.socket(zmq.DEALER)
-        self.server_socket.bind("tcp://*:5556")
-        
+        self.client_socket.bind(self.frontend)
+
+        # Socket para servidores (ROUTER no modo balanceado, para endereçar cada servidor)
+        self.server_socket = self.context.socket(zmq.ROUTER if self.mode == 'balanced' else zmq.DEALER)
+        self.server_socket.bind(self.backend)
+
         self.poller = zmq.Poller()
         self.poller.register(self.client_socket, zmq.POLLIN)
         self.poller.register(self.server_socket, zmq.POLLIN)
-        
+
         self.client_count = 0
         self.server_count = 0
-    
+
+        # Balanceamento
+        self.pool = ServerPool(
+            heartbeat_interval=float(os.getenv('BROKER_HEARTBEAT_INTERVAL', '1')),
+            liveness=int(os.getenv('BROKER_HEARTBEAT_LIVENESS', '3'))
+        )
+        self.request_timeout = float(os.getenv('BROKER_REQUEST_TIMEOUT', '5'))
+        self.max_attempts = int(os.getenv('BROKER_MAX_ATTEMPTS', '3'))
+        self.next_request_id = 0
+        self.pending = {}  # id -> requisição encaminhada e ainda sem resposta
+        self.waiting = deque()  # Requisições sem servidor com crédito livre
+        self.client_queues = {}  # cliente -> requisições aguardando a anterior (uma em andamento por cliente)
+
+        # Particionamento: requisições de canal/caixa de mensagens só vão aos servidores donos da chave
+        self.ring = ring_from_env()
+        if self.ring is not None and self.mode != 'balanced':
+            raise ValueError("SHARD_NODES exige BROKER_MODE=balanced")
+
+        # Observabilidade
+        self.log = Log()
+        self.metrics = Metrics()
+        self.metrics_port = int(os.getenv('METRICS_PORT', '9100'))
+        self.register_metrics()
+
+    def register_metrics(self):
+        m = self.metrics
+        m.describe('bbs_broker_messages_total', 'Mensagens encaminhadas por direção')
+        m.describe('bbs_broker_requests_total', 'Requisições recebidas de clientes por serviço (modo balanceado)')
+        m.describe('bbs_broker_request_seconds', 'Tempo entre a chegada da requisição e a resposta ao cliente')
+        m.describe('bbs_broker_server_seconds', 'Tempo entre o envio ao servidor e a resposta')
+        m.describe('bbs_broker_retries_total', 'Requisições repetidas em outro servidor (leituras; escritas com request_id só se o servidor morreu)')
+        m.describe('bbs_broker_failures_total', 'Requisições respondidas com erro pelo broker')
+
+        m.gauge('bbs_broker_requests_inflight', lambda: len(self.pending))
+        m.gauge('bbs_broker_waiting_requests', lambda: len(self.waiting))
+        m.gauge('bbs_broker_queued_requests', lambda: sum(len(q) for q in list(self.client_queues.values())))
+        m.gauge('bbs_broker_servers', lambda: len(self.pool))
+        m.gauge('bbs_broker_server_inflight',
+                lambda: {(('server', s.name),): s.inflight for s in list(self.pool.servers.values())})
+        m.gauge('bbs_broker_server_capacity',
+                lambda: {(('server', s.name),): s.capacity for s in list(self.pool.servers.values())})
+        m.gauge('bbs_broker_server_latency_seconds',
+                lambda: {(('server', s.name),): s.latency or 0.0 for s in list(self.pool.servers.values())})
+
+    def service_label(self, service):
+        # Só serviços conhecidos viram rótulos: o nome vem do cliente
+        if isinstance(service, str) and service in SERVICES:
+            return service
+        return 'desconhecido'
+
     def run(self):
         print("Broker Request-Reply iniciado")
-        print("Porta clientes: 5555")
-        print("Porta servidores: 5556")
-        
+        print(f"Clientes: {self.frontend}")
+        print(f"Servidores: {self.backend}")
+        print(f"Modo: {self.mode}")
+        if self.ring is not None:
+            print(f"Particionamento: {', '.join(self.ring.nodes)} ({self.ring.replicas} réplica(s) por chave)")
+
+        if self.mode != 'proxy':
+            # No modo proxy as estatísticas vêm do socket de controle (STATISTICS)
+            start_metrics_server(self.metrics, self.metrics_port, self.log)
+
+        if self.mode == 'balanced':
+            self.run_balanced()
+        elif self.mode == 'proxy':
+            self.run_proxy()
+        else:
+            self.run_dealer()
+
+    def drain(self, socket, handler):
+        """Processa as mensagens já disponíveis no socket, até o orçamento por wakeup"""
+        for _ in range(self.drain_budget):
+            try:
+                # copy=False: os frames ficam nos buffers da libzmq e são reenviados sem cópia
+                frames = socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            handler(frames)
+
+    def run_dealer(self):
         while True:
             socks = dict(self.poller.poll())
-            
-            # Mensagem do cliente para servidor
+
+            # Mensagens do cliente para servidor
+            if self.client_socket in socks:
+                self.drain(self.client_socket, self.forward_to_server)
+
+            # Mensagens do servidor para cliente
+            if self.server_socket in socks:
+                self.drain(self.server_socket, self.forward_to_client)
+
+    def forward_to_server(self, frames):
+        self.client_count += 1
+        self.server_socket.send_multipart(frames, copy=False)
+        self.metrics.inc('bbs_broker_messages_total', direction='client')
+
+        if self.client_count % 100 == 0:
+            self.log.debug(f"Mensagens de clientes: {self.client_count}", key='contagem')
+
+    def forward_to_client(self, frames):
+        # Mensagens de controle (heartbeats) não são respostas
+        if frames[0].bytes == CONTROL_FRAME:
+            return
+
+        self.server_count += 1
+        self.client_socket.send_multipart(frames, copy=False)
+        self.metrics.inc('bbs_broker_messages_total', direction='server')
+
+        if self.server_count % 100 == 0:
+            self.log.debug(f"Mensagens de servidores: {self.server_count}", key='contagem')
+
+    def run_proxy(self):
+        """Encaminhamento inteiro dentro da libzmq; o socket de controle aceita PAUSE/RESUME/TERMINATE/STATISTICS"""
+        control = self.context.socket(zmq.REP)
+        control.bind(self.control)
+        print(f"Controle do proxy: {self.control}")
+
+        # Heartbeats dos servidores chegam ao ROUTER dos clientes sem destino válido e são descartados
+        zmq.proxy_steerable(self.client_socket, self.server_socket, None, control)
+
+    def run_balanced(self):
+        """Loop do modo balanceado: servidores anunciam crédito por heartbeat e recebem requisições endereçadas"""
+        while True:
+            socks = dict(self.poller.poll(100))
+
             if self.client_socket in socks:
-                self.client_count += 1
-                
-                # Recebe todas as partes da mensagem
-                frames = []
-                while True:
-                    frame = self.client_socket.recv()
-                    frames.append(frame)
-                    
-                    if not self.client_socket.getsockopt(zmq.RCVMORE):
-                        break
-                
-                # Encaminha para servidor
-                for i, frame in enumerate(frames):
-                    if i < len(frames) - 1:
-                        self.server_socket.send(frame, zmq.SNDMORE)
-                    else:
-                        self.server_socket.send(frame)
-                
-                if self.client_count % 100 == 0:
-                    print(f"Mensagens de clientes: {self.client_count}")
-            
-            # Mensagem do servidor para cliente
+                self.drain(self.client_socket, self.handle_client)
+
             if self.server_socket in socks:
-                self.server_count += 1
-                
-                # Recebe todas as partes da mensagem
-                frames = []
-                while True:
-                    frame = self.server_socket.recv()
-                    frames.append(frame)
-                    
-                    if not self.server_socket.getsockopt(zmq.RCVMORE):
-                        break
-                
-                # Encaminha para cliente
-                for i, frame in enumerate(frames):
-                    if i < len(frames) - 1:
-                        self.client_socket.send(frame, zmq.SNDMORE)
-                    else:
-                        self.client_socket.send(frame)
-                
-                if self.server_count % 100 == 0:
-                    print(f"Mensagens de servidores: {self.server_count}")
+                self.drain(self.server_socket, self.handle_server)
+
+            self.check_timeouts()
+
+    def handle_client(self, frames):
+        self.client_count += 1
+        client = frames[0].bytes
+
+        try:
+            msg = msgpack.unpackb(frames[-1].buffer)
+            service = msg['service']
+        except Exception:
+            msg, service = {}, None
+
+        owners = None
+        if self.ring is not None:
+            key = shard_key(service, msg.get('data'))
+            if key is not None:
+                owners = self.ring.owners(key)
+
+        label = self.service_label(service)
+        self.metrics.inc('bbs_broker_messages_total', direction='client')
+        self.metrics.inc('bbs_broker_requests_total', service=label)
+
+        self.next_request_id += 1
+        request = {
+            "id": struct.pack('>Q', self.next_request_id),
+            "client": client,
+            "frames": frames,
+            "service": label,
+            "idempotent": service in IDEMPOTENT_SERVICES,
+            "retry_on_failure": retryable_on_failure(service, msg.get('data')),
+            "owners": owners,  # Nomes dos servidores que podem atender (None = qualquer um)
+            "pin": request_pin(msg.get('data')),  # request_id: repetições do cliente vão ao mesmo servidor
+            "attempts": 0,
+            "tried": set(),
+            "server": None,
+            "received_at": time.time(),
+            "sent_at": None
+        }
+
+        # Preserva a ordem por cliente: a próxima só sai quando a anterior for respondida
+        queue = self.client_queues.get(client)
+        if queue is not None:
+            queue.append(request)
+            return
+        self.client_queues[client] = deque()
+
+        self.route(request)
+
+        if self.client_count % 100 == 0:
+            self.log.debug(f"Mensagens de clientes: {self.client_count}", key='contagem')
+
+    def route(self, request):
+        """Envia a requisição ao servidor menos carregado (ou ao fixado pelo request_id), ou a deixa na fila de espera"""
+        server = self.pool.pick(exclude=request['tried'], allowed=request['owners'], pin=request['pin'])
+        if server is None and request['tried']:
+            server = self.pool.pick(allowed=request['owners'], pin=request['pin'])
+        if server is None:
+            self.waiting.append(request)
+            return
+
+        request['attempts'] += 1
+        request['tried'].add(server.identity)
+        request['server'] = server.identity
+        request['sent_at'] = time.time()
+        self.pending[request['id']] = request
+        server.inflight += 1
+
+        # [servidor, id da requisição, envelope do cliente..., payload]; o servidor devolve o envelope intacto
+        self.server_socket.send_multipart([server.identity, request['id']] + request['frames'], copy=False)
+
+    def handle_server(self, frames):
+        identity = frames[0].bytes
+        tag = frames[1].bytes
+
+        if tag == CONTROL_FRAME:
+            info = msgpack.unpackb(frames[3].buffer) if len(frames) > 3 else {}
+            self.pool.heartbeat(identity, info)
+            self.drain_waiting()
+            return
+
+        self.server_count += 1
+        server = self.pool.seen(identity)
+        if server is not None:
+            server.inflight = max(0, server.inflight - 1)
+
+        request = self.pending.pop(tag, None)
+        if request is None:
+            return  # Resposta atrasada de uma requisição já repetida em outro servidor
+
+        now = time.time()
+        if server is not None:
+            self.pool.record_latency(server, now - request['sent_at'])
+
+        self.client_socket.send_multipart(frames[2:], copy=False)
+        self.metrics.inc('bbs_broker_messages_total', direction='server')
+        self.metrics.observe('bbs_broker_server_seconds', now - request['sent_at'], service=request['service'])
+        self.metrics.observe('bbs_broker_request_seconds', now - request['received_at'], service=request['service'])
+        self.finish(request)
+        self.drain_waiting()
+
+        if self.server_count % 100 == 0:
+            self.log.debug(f"Mensagens de servidores: {self.server_count}", key='contagem')
+
+    def finish(self, request):
+        """Libera o cliente e encaminha sua próxima requisição, se houver"""
+        queue = self.client_queues.get(request['client'])
+        if queue:
+            self.route(queue.popleft())
+        else:
+            self.client_queues.pop(request['client'], None)
+
+    def fail(self, request, message):
+        """Responde ao cliente com erro (escrita em servidor morto, tentativas esgotadas)"""
+        self.pending.pop(request['id'], None)
+        self.metrics.inc('bbs_broker_failures_total', reason=message)
+        envelope = request['frames'][:-1]
+        self.client_socket.send_multipart(envelope + [msgpack.packb({"error": message})], copy=False)
+        self.finish(request)
+
+    def drain_waiting(self):
+        """Reencaminha as requisições em espera; as que ainda não têm servidor voltam para a fila, na mesma ordem"""
+        if not self.waiting or self.pool.pick() is None:
+            return
+        waiting, self.waiting = self.waiting, deque()
+        for request in waiting:
+            self.route(request)
+
+    def check_timeouts(self):
+        """Remove servidores sem heartbeat e repete leituras atrasadas em outro servidor.
+
+        Escritas com request_id só são repetidas quando o servidor morre, nunca por timeout.
+        """
+        for server in self.pool.expire():
+            for request in [r for r in self.pending.values() if r['server'] == server.identity]:
+                self.pending.pop(request['id'], None)
+                if request['retry_on_failure'] and request['attempts'] < self.max_attempts:
+                    self.metrics.inc('bbs_broker_retries_total', service=request['service'])
+                    self.route(request)
+                else:
+                    self.fail(request, "Servidor indisponível")
+
+        now = time.time()
+        for request in list(self.pending.values()):
+            if now - request['sent_at'] < self.request_timeout:
+                continue
+            if request['idempotent'] and request['attempts'] < self.max_attempts:
+                # O servidor lento continua com o crédito ocupado até responder
+                self.log.warning(f"⏱️  Repetindo '{request['service']}' em outro servidor (tentativa {request['attempts'] + 1})",
+                                 key='retentativa')
+                self.metrics.inc('bbs_broker_retries_total', service=request['service'])
+                self.pending.pop(request['id'], None)
+                self.route(request)
+            elif request['idempotent']:
+                self.fail(request, "Tempo esgotado")
+
+        # Sem servidores vivos por tempo demais: não deixa o cliente pendurado
+        while self.waiting and now - self.waiting[0]['received_at'] >= self.request_timeout:
+            self.fail(self.waiting.popleft(), "Nenhum servidor disponível")
+
+        self.drain_waiting()
 
 if __name__ == "__main__":
-    broker = Broker()
-    broker.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Broker Request-Reply")
+    parser.add_argument('--frontend', help="endpoint dos clientes (padrão: BROKER_FRONTEND ou tcp://*:5555)")
+    parser.add_argument('--backend', help="endpoint dos servidores (padrão: BROKER_BACKEND ou tcp://*:5556)")
+    parser.add_argument('--control', help="controle do modo proxy (padrão: BROKER_CONTROL ou tcp://*:5560)")
+    args = parser.parse_args()
+
+    broker = Broker(frontend=args.frontend, backend=args.backend, control=args.control)
+    broker.run()
@@ -0,0 +1,226 @@
+"""Métricas no formato texto do Prometheus e log com nível e limite de taxa, compartilhadas por broker, servidor e proxy."""
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Limites dos buckets dos histogramas de latência (segundos)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ''
+    escaped = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for name, value in items)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics:
+    """Contadores, gauges e histogramas rotulados; seguro para várias threads"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = {}  # nome -> {rótulos: valor}
+        self.gauges = {}  # nome -> {rótulos: valor}
+        self.callbacks = {}  # nome -> função lida na coleta
+        self.histograms = {}  # nome -> {rótulos: _Histogram}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _labels_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[_labels_key(labels)] = value
+
+    def gauge(self, name, function):
+        """Gauge calculado na coleta; a função retorna um número ou {tupla de (rótulo, valor): número}"""
+        self.callbacks[name] = function
+
+    def observe(self, name, seconds, **labels):
+        key = _labels_key(labels)
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def render(self):
+        """Texto no formato de exposição do Prometheus"""
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            gauges = {name: dict(series) for name, series in self.gauges.items()}
+            histograms = {
+                name: {key: (list(h.counts), h.sum, h.count) for key, h in series.items()}
+                for name, series in self.histograms.items()
+            }
+
+        # Funções lidas fora do lock: podem consultar estruturas de outras threads
+        for name, function in list(self.callbacks.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            gauges[name] = dict(value) if isinstance(value, dict) else {(): value}
+
+        lines = []
+        for kind, families in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(families):
+                self._header(lines, name, kind)
+                for key, value in sorted(families[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+
+        for name in sorted(histograms):
+            self._header(lines, name, 'histogram')
+            for key, (counts, total, count) in sorted(histograms[name].items()):
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(key)} {count}")
+
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, kind):
+        if name in self.help:
+            lines.append(f"# HELP {name} {self.help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def start_metrics_server(metrics, port, log=None):
+    """Serve GET /metrics em uma thread daemon; retorna None se a porta estiver desabilitada ou ocupada"""
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # Uma linha por coleta só polui a saída
+
+    try:
+        server = ThreadingHTTPServer(('', port), Handler)
+    except OSError as e:
+        if log is not None:
+            log.warning(f"⚠️  Métricas indisponíveis na porta {port}: {e}")
+        return None
+
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metricas", daemon=True).start()
+    if log is not None:
+        log.info(f"📈 Métricas em http://0.0.0.0:{port}/metrics")
+    return server
+
+
+class Log:
+    """print() com nível mínimo (LOG_LEVEL) e limite de mensagens por chave (LOG_RATE_BURST a cada LOG_RATE_INTERVAL s)"""
+
+    def __init__(self, level=None, burst=None, interval=None):
+        level = (level or os.getenv('LOG_LEVEL', 'INFO')).upper()
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Nível de log inválido: {level}")
+        self.level = LOG_LEVELS[level]
+        self.burst = burst if burst is not None else int(os.getenv('LOG_RATE_BURST', '5'))
+        self.interval = interval if interval is not None else float(os.getenv('LOG_RATE_INTERVAL', '10'))
+        self.lock = threading.Lock()
+        self.windows = {}  # chave -> [início da janela, mensagens na janela, suprimidas]
+
+    def enabled(self, level):
+        return LOG_LEVELS[level] >= self.level
+
+    def log(self, level, message, key=None):
+        """Com 'key', mensagens repetidas da mesma origem são limitadas e resumidas na janela seguinte"""
+        if LOG_LEVELS[level] < self.level:
+            return
+
+        if key is not None:
+            now = time.time()
+            with self.lock:
+                window = self.windows.get(key)
+                if window is None or now - window[0] >= self.interval:
+                    suppressed = window[2] if window is not None else 0
+                    self.windows[key] = [now, 1, 0]
+                    if suppressed:
+                        print(f"   ({suppressed} mensagens '{key}' suprimidas nos últimos {self.interval:.0f}s)")
+                elif window[1] >= self.burst:
+                    window[2] += 1
+                    return
+                else:
+                    window[1] += 1
+
+        print(message)
+
+    def debug(self, message, key=None):
+        self.log('DEBUG', message, key)
+
+    def info(self, message, key=None):
+        self.log('INFO', message, key)
+
+    def warning(self, message, key=None):
+        self.log('WARNING', message, key)
+
+    def error(self, message, key=None):
+        self.log('ERROR', message, key)
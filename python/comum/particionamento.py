@@ -0,0 +1,81 @@
+"""Particionamento de canais e caixas de mensagens entre servidores por hashing consistente, usado pelo broker e pelos servidores."""
+import hashlib
+import os
+from bisect import bisect_right
+
+# Serviço -> (campo da requisição, prefixo da chave); os demais serviços não são particionados
+SHARDED_FIELDS = {
+    'publish': ('channel', 'canal'),
+    'history_channel': ('channel', 'canal'),
+    'message': ('to', 'usuario'),
+    'history_messages': ('user', 'usuario')
+}
+
+
+def channel_key(channel):
+    return f"canal:{channel}"
+
+
+def mailbox_key(user):
+    return f"usuario:{user}"
+
+
+def shard_key(service, data):
+    """Chave de partição da requisição, ou None se qualquer servidor pode atendê-la"""
+    field = SHARDED_FIELDS.get(service)
+    if field is None or not isinstance(data, dict) or data.get(field[0]) is None:
+        return None
+    return f"{field[1]}:{data[field[0]]}"
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Anel de hashing consistente com nós virtuais: incluir um nó só move as chaves que passam a ser dele"""
+
+    CACHE_LIMIT = 100000
+
+    def __init__(self, nodes, replicas=2, vnodes=64):
+        self.nodes = sorted(set(nodes))
+        if not self.nodes:
+            raise ValueError("Anel de partições sem servidores")
+        self.replicas = max(1, min(replicas, len(self.nodes)))
+
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.points = [node for _, node in points]
+        self.cache = {}
+
+    def owners(self, key):
+        """Servidores responsáveis pela chave: os 'replicas' primeiros nós distintos no sentido horário"""
+        owners = self.cache.get(key)
+        if owners is not None:
+            return owners
+
+        owners = []
+        index = bisect_right(self.hashes, _hash(key))
+        while len(owners) < self.replicas:
+            node = self.points[index % len(self.points)]
+            if node not in owners:
+                owners.append(node)
+            index += 1
+        owners = tuple(owners)
+
+        if len(self.cache) >= self.CACHE_LIMIT:
+            self.cache.clear()
+        self.cache[key] = owners
+        return owners
+
+
+def ring_from_env():
+    """Anel definido por SHARD_NODES (nomes dos servidores, separados por vírgula), ou None sem particionamento"""
+    nodes = [node.strip() for node in os.getenv('SHARD_NODES', '').split(',') if node.strip()]
+    if not nodes:
+        return None
+    return HashRing(
+        nodes,
+        replicas=int(os.getenv('SHARD_REPLICAS', '2')),
+        vnodes=int(os.getenv('SHARD_VNODES', '64'))
+    )
@@ -0,0 +1,136 @@
+"""Sobe referência, proxy, broker e N servidores em um único processo, sem Docker.
+
+Todos compartilham um contexto ZMQ; com --transport inproc as mensagens nem passam pelo kernel,
+com ipc ficam em sockets Unix (visíveis para clientes em outros processos) e com tcp usam localhost.
+
+Uso: python cluster.py [--servers N] [--transport inproc|ipc|tcp] [--data-dir DIR] [--broker-mode MODO]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import zmq
+
+PYTHON_DIR = Path(__file__).resolve().parent.parent
+# comum/ (módulos compartilhados) entra no sys.path pelos próprios broker.py, servidor.py e proxy.py
+for component in ('referencia', 'proxy', 'broker', 'servidor'):
+    sys.path.insert(0, str(PYTHON_DIR / component))
+
+from referencia import Referencia  # noqa: E402
+from proxy import Proxy  # noqa: E402
+from broker import Broker  # noqa: E402
+from servidor import Servidor  # noqa: E402
+
+PORTS = {'clientes': 5555, 'servidores': 5556, 'pub': 5557, 'sub': 5558, 'referencia': 5559}
+
+
+def endpoints(transport, directory):
+    """(bind, connect) de cada socket do sistema para o transporte escolhido"""
+    if transport == 'inproc':
+        return {name: (f"inproc://bbs-{name}",) * 2 for name in PORTS}
+    if transport == 'ipc':
+        return {name: (f"ipc://{directory}/{name}.ipc",) * 2 for name in PORTS}
+    if transport == 'tcp':
+        return {name: (f"tcp://*:{port}", f"tcp://127.0.0.1:{port}") for name, port in PORTS.items()}
+    raise ValueError(f"Transporte inválido: {transport}")
+
+
+def run_quietly(target):
+    """Threads terminam sem traceback quando o contexto é encerrado"""
+    def run():
+        try:
+            target()
+        except zmq.ZMQError:
+            pass
+    return run
+
+
+class LocalCluster:
+    """Sistema completo em threads de um processo; client() devolve um REQ já conectado ao broker"""
+
+    def __init__(self, servers=3, transport='inproc', data_dir=None):
+        # Portas de métricas fixas colidiriam entre os componentes do mesmo processo
+        os.environ.setdefault('METRICS_PORT', '0')
+
+        self.context = zmq.Context()
+        self.temporary = data_dir is None
+        self.data_dir = Path(data_dir or tempfile.mkdtemp(prefix='bbs-local-'))
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.endpoints = endpoints(transport, self.data_dir)
+        self.servers = []
+
+        bind = {name: pair[0] for name, pair in self.endpoints.items()}
+        connect = {name: pair[1] for name, pair in self.endpoints.items()}
+        self.client_endpoint = connect['clientes']
+        self.subscribe_endpoint = connect['sub']
+
+        # inproc exige o bind antes do connect: referência, proxy e broker primeiro
+        self.reference = Referencia(self.context, bind['referencia'])
+        self.start(self.reference.run, "referencia")
+        self.proxy = Proxy(self.context, bind['pub'], bind['sub'])
+        self.start(self.proxy.run, "proxy")
+        self.broker = Broker(self.context, bind['clientes'], bind['servidores'])
+        self.start(self.broker.run, "broker")
+
+        for i in range(servers):
+            name = f"servidor{i + 1}"
+            server = Servidor(
+                context=self.context,
+                name=name,
+                data_dir=self.data_dir / name,
+                broker=connect['servidores'],
+                proxy_pub=connect['pub'],
+                proxy_sub=connect['sub'],
+                reference=connect['referencia']
+            )
+            self.servers.append(server)
+            self.start(server.run, name)
+
+    def start(self, target, name):
+        threading.Thread(target=run_quietly(target), name=name, daemon=True).start()
+
+    def client(self):
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(self.client_endpoint)
+        return socket
+
+    def close(self):
+        for server in self.servers:
+            server.dispatcher.close()
+            server.wal.close()
+        # Fechar os sockets de outras threads derruba a libzmq; term() faz cada thread sair com
+        # ContextTerminated, mas só retorna quando todos fecham, então não bloqueia quem chama
+        self.start(self.context.term, "encerramento")
+        if self.temporary:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster local em um único processo")
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--transport', choices=('inproc', 'ipc', 'tcp'), default='ipc',
+                        help="inproc só aceita clientes deste processo")
+    parser.add_argument('--data-dir', help="diretório persistente (padrão: temporário, apagado ao sair)")
+    parser.add_argument('--broker-mode', choices=('balanced', 'dealer', 'proxy'),
+                        help="modo do broker (padrão: BROKER_MODE ou balanced)")
+    args = parser.parse_args()
+
+    if args.broker_mode:
+        os.environ['BROKER_MODE'] = args.broker_mode
+
+    cluster = LocalCluster(args.servers, args.transport, args.data_dir)
+    print(f"🚀 Cluster local com {args.servers} servidor(es)")
+    print(f"  Clientes: {cluster.client_endpoint}")
+    print(f"  Inscritos: {cluster.subscribe_endpoint}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.close()
@@ -0,0 +1,280 @@
+import os
+import time
+from collections import OrderedDict, deque
+
+import zmq
+
+from metricas import Log
+
+# Tópicos internos dos servidores (replicação, eleição e Berkeley)
+SYSTEM_TOPICS = (b"replication", b"servers")
+TOPIC_CLASSES = ('channel', 'private', 'system')
+OTHER_TOPICS = 'outros'  # Rótulo dos tópicos além do limite de séries por tópico
+
+
+def topic_class(topic):
+    if topic in SYSTEM_TOPICS:
+        return 'system'
+    if topic.startswith(b"private_"):
+        return 'private'
+    return 'channel'
+
+
+class TopicPolicy:
+    """Limites de uma classe de tópicos: fila por tópico no proxy (hwm), conflação, espera máxima e atraso tolerado"""
+
+    # classe -> (hwm, conflação, atraso tolerado em segundos, espera máxima em segundos)
+    DEFAULTS = {
+        'channel': (1000, False, 0.1, 0.1),
+        'private': (1000, False, 0.1, 0.1),
+        'system': (100000, False, 1.0, 0.0)  # Replicação não espera por um servidor lento: ele se recupera pelo catch-up
+    }
+
+    def __init__(self, name, hwm, conflate=False, late_after=0.1, max_wait=0.1):
+        if name == 'system' and conflate:
+            # Replicação conflacionada perderia operações
+            raise ValueError("Tópicos de sistema não aceitam conflação")
+        self.name = name
+        self.hwm = hwm  # Mensagens pendentes por tópico; 0 = sem limite
+        self.conflate = conflate  # Guarda só a última mensagem pendente do tópico
+        self.late_after = late_after
+        self.max_wait = max_wait  # Depois disso a mensagem vai para quem tem espaço e o subscriber cheio a perde
+
+    @classmethod
+    def from_env(cls, name):
+        hwm, conflate, late_after, max_wait = cls.DEFAULTS[name]
+        prefix = f"FANOUT_{name.upper()}_"
+        return cls(
+            name,
+            hwm=int(os.getenv(prefix + 'HWM', str(hwm))),
+            conflate=os.getenv(prefix + 'CONFLATE', '1' if conflate else '0') == '1',
+            late_after=float(os.getenv(prefix + 'LATE_MS', str(late_after * 1000))) / 1000,
+            max_wait=float(os.getenv(prefix + 'MAX_WAIT_MS', str(max_wait * 1000))) / 1000
+        )
+
+
+class TopicQueue:
+    """Mensagens de um tópico recusadas pelo XPUB, em ordem de chegada"""
+
+    def __init__(self, kind, label, policy):
+        self.kind = kind
+        self.label = label
+        self.policy = policy
+        self.items = deque()  # (frames, instante em que entrou na fila)
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, frames, now):
+        """Enfileira e retorna 'queued', 'conflated' ou 'full' (nada enfileirado)"""
+        if self.policy.conflate and self.items:
+            # A mensagem nova substitui a pendente e herda a espera dela
+            self.items[-1] = (frames, self.items[-1][1])
+            return 'conflated'
+        if self.policy.hwm and len(self.items) >= self.policy.hwm:
+            return 'full'
+        self.items.append((frames, now))
+        return 'queued'
+
+    def head(self):
+        return self.items[0]
+
+    def pop(self):
+        self.items.popleft()
+
+
+class FanOut:
+    """Difusão XSUB -> XPUB em Python: acompanha as inscrições e contabiliza vazão, descartes e atrasos por tópico.
+
+    Com XPUB_NODROP a libzmq recusa (EAGAIN) o envio inteiro quando algum subscriber do tópico está no HWM.
+    A mensagem espera na fila do seu tópico, sem atrasar os outros tópicos, até max_wait; depois é enviada
+    uma vez sem NODROP, como no zmq.proxy: quem tem espaço recebe, o subscriber cheio a perde e o descarte
+    é contado. Subscribers saudáveis nunca perdem mensagens por causa de um lento.
+    """
+
+    def __init__(self, xsub, xpub, metrics=None, log=None, policies=None, topic_labels=None, drain_budget=256,
+                 retry_interval=0.005):
+        self.xsub = xsub
+        self.xpub = xpub
+        self.metrics = metrics
+        self.log = log or Log()
+        self.policies = policies or {name: TopicPolicy.from_env(name) for name in TOPIC_CLASSES}
+        self.topics = {}  # tópico -> TopicQueue
+        self.queues = OrderedDict()  # tópico -> TopicQueue, só enquanto houver mensagens pendentes
+        self.topic_labels = topic_labels if topic_labels is not None else int(os.getenv('FANOUT_TOPIC_LABELS', '1000'))
+        self.labels = {}  # tópico -> rótulo nas métricas
+        self.drain_budget = drain_budget
+        self.retry_interval = retry_interval  # Espera entre tentativas com mensagens na fila
+        self.subscriptions = {}  # prefixo -> inscrições ativas
+
+        # Todas as inscrições e cancelamentos chegam ao proxy, não só o primeiro/último de cada tópico
+        self.xpub.setsockopt(getattr(zmq, 'XPUB_VERBOSER', zmq.XPUB_VERBOSE), 1)
+        self.xpub.setsockopt(zmq.XPUB_NODROP, 1)
+
+        if metrics is not None:
+            self.register_metrics()
+
+    def register_metrics(self):
+        m = self.metrics
+        m.describe('bbs_proxy_messages_total', 'Mensagens recebidas dos publishers por tópico')
+        m.describe('bbs_proxy_delivered_total', 'Mensagens entregues ao XPUB por tópico')
+        m.describe('bbs_proxy_dropped_total', 'Mensagens que ao menos um subscriber no HWM perdeu, por tópico')
+        m.describe('bbs_proxy_conflated_total', 'Mensagens pendentes substituídas por outra do mesmo tópico')
+        m.describe('bbs_proxy_late_total', 'Mensagens entregues depois do atraso tolerado da classe, por tópico')
+        m.describe('bbs_proxy_blocked_total', 'Envios recusados porque algum subscriber estava no HWM')
+        m.describe('bbs_proxy_queue_seconds', 'Tempo de espera na fila do proxy por classe')
+        m.describe('bbs_proxy_subscriptions', 'Inscrições ativas por prefixo')
+
+        m.gauge('bbs_proxy_queue_depth', self.queue_depth)
+        m.gauge('bbs_proxy_subscriptions',
+                lambda: {(('topic', self.label(prefix) if prefix else '*'),): count
+                         for prefix, count in list(self.subscriptions.items())})
+
+    def queue_depth(self):
+        depth = {(('class', name),): 0 for name in self.policies}
+        for queue in list(self.queues.values()):
+            depth[(('class', queue.kind),)] += len(queue)
+        return depth
+
+    def label(self, topic):
+        """Um rótulo por tópico até FANOUT_TOPIC_LABELS; os demais somam em 'outros'"""
+        label = self.labels.get(topic)
+        if label is None:
+            if len(self.labels) < self.topic_labels or topic in SYSTEM_TOPICS:
+                label = topic.decode(errors='replace')
+            else:
+                label = OTHER_TOPICS
+            self.labels[topic] = label
+        return label
+
+    def inc(self, name, topic_label, kind):
+        if self.metrics is not None:
+            self.metrics.inc(name, topic=topic_label, **{'class': kind})
+
+    def send(self, frames):
+        """Envio com NODROP: falha se algum subscriber do tópico estiver no HWM"""
+        try:
+            self.xpub.send_multipart(frames, zmq.NOBLOCK, copy=False)
+            return True
+        except zmq.Again:
+            return False
+
+    def send_lossy(self, frames):
+        """Envio do zmq.proxy: os subscribers no HWM perdem a mensagem, os demais a recebem"""
+        self.xpub.setsockopt(zmq.XPUB_NODROP, 0)
+        try:
+            self.xpub.send_multipart(frames, zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            pass
+        finally:
+            self.xpub.setsockopt(zmq.XPUB_NODROP, 1)
+
+    def blocked(self, kind):
+        if self.metrics is not None:
+            self.metrics.inc('bbs_proxy_blocked_total', **{'class': kind})
+
+    def delivered(self, queue, frames, waited, forced):
+        """Contabiliza uma entrega; forced = enviada sem NODROP, perdida pelo subscriber cheio"""
+        kind, label, policy = queue.kind, queue.label, queue.policy
+        if forced:
+            self.send_lossy(frames)
+            self.inc('bbs_proxy_dropped_total', label, kind)
+            self.log.warning(f"⚠️  Subscriber de '{label}' no HWM por mais de {policy.max_wait * 1000:.0f} ms: "
+                             f"mensagens descartadas para ele", key=f"descarte:{kind}")
+        self.inc('bbs_proxy_delivered_total', label, kind)
+        if waited > policy.late_after:
+            self.inc('bbs_proxy_late_total', label, kind)
+        if self.metrics is not None and waited:
+            self.metrics.observe('bbs_proxy_queue_seconds', waited, **{'class': kind})
+
+    def publish(self, frames):
+        topic = frames[0].bytes
+        now = time.perf_counter()
+        queue = self.topics.get(topic)
+        if queue is None:
+            kind = topic_class(topic)
+            queue = self.topics[topic] = TopicQueue(kind, self.label(topic), self.policies[kind])
+        self.inc('bbs_proxy_messages_total', queue.label, queue.kind)
+
+        # Fila do tópico vazia: tenta direto; com fila, entra atrás para manter a ordem do tópico
+        if not queue:
+            if self.send(frames):
+                self.delivered(queue, frames, 0, forced=False)
+                return
+            self.blocked(queue.kind)
+            if queue.policy.max_wait <= 0:
+                self.delivered(queue, frames, 0, forced=True)
+                return
+            self.queues[topic] = queue
+
+        result = queue.push(frames, now)
+        if result == 'full':
+            # Fila do tópico cheia: a mais antiga segue sem esperar mais e abre espaço
+            head, enqueued_at = queue.head()
+            queue.pop()
+            self.delivered(queue, head, now - enqueued_at, forced=True)
+            queue.push(frames, now)
+        elif result == 'conflated':
+            self.inc('bbs_proxy_conflated_total', queue.label, queue.kind)
+
+    def flush(self):
+        """Reenvia as mensagens pendentes; um tópico bloqueado não segura os demais"""
+        now = time.perf_counter()
+        for topic, queue in list(self.queues.items()):
+            while queue:
+                frames, enqueued_at = queue.head()
+                waited = now - enqueued_at
+                if self.send(frames):
+                    queue.pop()
+                    self.delivered(queue, frames, waited, forced=False)
+                    continue
+                self.blocked(queue.kind)
+                if waited < queue.policy.max_wait:
+                    break
+                queue.pop()
+                self.delivered(queue, frames, waited, forced=True)
+            if not queue:
+                del self.queues[topic]
+
+    def subscription(self, message):
+        """Primeiro byte 1 = inscrição, 0 = cancelamento; o resto é o prefixo do tópico"""
+        if not message:
+            return
+        prefix = message[1:]
+        if message[0] == 1:
+            self.subscriptions[prefix] = self.subscriptions.get(prefix, 0) + 1
+        elif message[0] == 0:
+            remaining = self.subscriptions.get(prefix, 0) - 1
+            if remaining > 0:
+                self.subscriptions[prefix] = remaining
+            else:
+                self.subscriptions.pop(prefix, None)
+        # Os publishers filtram na origem, como no zmq.proxy
+        self.xsub.send(message)
+
+    def drain(self, socket, handler, copy):
+        for _ in range(self.drain_budget):
+            try:
+                frames = socket.recv_multipart(zmq.NOBLOCK, copy=copy)
+            except zmq.Again:
+                return
+            handler(frames)
+
+    def pending(self):
+        return bool(self.queues)
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.xsub, zmq.POLLIN)
+        poller.register(self.xpub, zmq.POLLIN)
+
+        while True:
+            timeout = max(1, int(self.retry_interval * 1000)) if self.pending() else None
+            socks = dict(poller.poll(timeout))
+
+            if self.xpub in socks:
+                self.drain(self.xpub, lambda frames: self.subscription(frames[0]), copy=True)
+            if self.xsub in socks:
+                self.drain(self.xsub, self.publish, copy=False)
+            if self.pending():
+                self.flush()
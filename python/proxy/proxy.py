@@ -0,0 +1,82 @@
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import zmq
+
+# Módulos compartilhados entre os componentes (métricas, particionamento) ficam em python/comum
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'comum'))
+
+from difusao import FanOut
+from metricas import Metrics, Log, start_metrics_server
+
+
+class Proxy:
+    """Proxy Pub-Sub em Python (equivalente ao nodejs/proxy): publishers no XSUB, subscribers no XPUB"""
+
+    def __init__(self, context=None, frontend=None, backend=None, control=None, mode=None):
+        self.context = context or zmq.Context.instance()
+        self.frontend = frontend or os.getenv('PROXY_XSUB_BIND', 'tcp://*:5557')
+        self.backend = backend or os.getenv('PROXY_XPUB_BIND', 'tcp://*:5558')
+        self.control = control or os.getenv('PROXY_CONTROL')
+
+        # 'proxy': encaminhamento cego dentro da libzmq; 'fanout': difusão em Python com contabilidade
+        # por tópico (inscrições, vazão, descartes e atrasos) e políticas por classe (difusao.py)
+        self.mode = mode or os.getenv('PROXY_MODE', 'proxy')
+        if self.mode not in ('proxy', 'fanout'):
+            raise ValueError(f"Modo de proxy inválido: {self.mode}")
+
+        # Socket XSUB - recebe de publishers
+        self.xsub = self.context.socket(zmq.XSUB)
+        self.xsub.bind(self.frontend)
+
+        # Socket XPUB - envia para subscribers
+        self.xpub = self.context.socket(zmq.XPUB)
+        # HWM por subscriber; precisa valer antes do bind
+        self.xpub.setsockopt(zmq.SNDHWM, int(os.getenv('PROXY_SNDHWM', '1000')))
+        self.xpub.bind(self.backend)
+
+        self.log = Log()
+        self.metrics = Metrics()
+        self.metrics_port = int(os.getenv('METRICS_PORT', '9100'))
+
+    def run(self):
+        print("Proxy Pub-Sub iniciado")
+        print(f"Publishers (XSUB): {self.frontend}")
+        print(f"Subscribers (XPUB): {self.backend}")
+        print(f"Modo: {self.mode}")
+
+        control = None
+        try:
+            if self.mode == 'fanout':
+                start_metrics_server(self.metrics, self.metrics_port, self.log)
+                FanOut(self.xsub, self.xpub, self.metrics, self.log).run()
+            elif self.control:
+                # PAUSE/RESUME/TERMINATE/STATISTICS pelo socket de controle, como no broker
+                control = self.context.socket(zmq.REP)
+                control.bind(self.control)
+                print(f"Controle: {self.control}")
+                zmq.proxy_steerable(self.xsub, self.xpub, None, control)
+            else:
+                zmq.proxy(self.xsub, self.xpub)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            # Com o contexto compartilhado, term() só retorna depois que os sockets fecham
+            self.xsub.close(linger=0)
+            self.xpub.close(linger=0)
+            if control is not None:
+                control.close(linger=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Proxy Pub-Sub XSUB/XPUB")
+    parser.add_argument('--frontend', help="endpoint XSUB (padrão: PROXY_XSUB_BIND ou tcp://*:5557)")
+    parser.add_argument('--backend', help="endpoint XPUB (padrão: PROXY_XPUB_BIND ou tcp://*:5558)")
+    parser.add_argument('--control', help="endpoint de controle opcional (padrão: PROXY_CONTROL)")
+    parser.add_argument('--mode', choices=('proxy', 'fanout'), help="modo de encaminhamento (padrão: PROXY_MODE ou proxy)")
+    args = parser.parse_args()
+
+    proxy = Proxy(frontend=args.frontend, backend=args.backend, control=args.control, mode=args.mode)
+    proxy.run()
@@ -0,0 +1,134 @@
+import argparse
+import os
+import threading
+import time
+
+import msgpack
+import zmq
+
+
+class ServerInfo:
+    def __init__(self, name, rank):
+        self.name = name
+        self.rank = rank
+        self.last_heartbeat = time.time()
+
+
+class Referencia:
+    """Servidor de referência em Python (mesmo protocolo do csharp/referencia): ranks e lista de servidores"""
+
+    def __init__(self, context=None, endpoint=None, inactive_after=60, cleanup_interval=30):
+        self.context = context or zmq.Context.instance()
+        self.endpoint = endpoint or os.getenv('REFERENCE_BIND', 'tcp://*:5559')
+        self.inactive_after = inactive_after
+        self.cleanup_interval = cleanup_interval
+
+        self.servers = {}
+        self.next_rank = 1
+        self.logical_clock = 0
+        self.lock = threading.Lock()
+
+        self.rep_socket = self.context.socket(zmq.REP)
+        self.rep_socket.bind(self.endpoint)
+
+    def increment_clock(self):
+        with self.lock:
+            self.logical_clock += 1
+            return self.logical_clock
+
+    def update_clock(self, received_clock):
+        with self.lock:
+            self.logical_clock = max(self.logical_clock, received_clock) + 1
+            return self.logical_clock
+
+    def handle_rank(self, data):
+        server_name = str(data.get('user', ''))
+        self.update_clock(data.get('clock', 0))
+
+        with self.lock:
+            server = self.servers.get(server_name)
+            if server is None:
+                server = self.servers[server_name] = ServerInfo(server_name, self.next_rank)
+                self.next_rank += 1
+                print(f"✓ Servidor '{server_name}' registrado com rank {server.rank}")
+            else:
+                server.last_heartbeat = time.time()
+            rank = server.rank
+
+        return {"service": "rank", "data": {"rank": rank, "timestamp": int(time.time()), "clock": self.increment_clock()}}
+
+    def handle_list(self, data):
+        self.update_clock(data.get('clock', 0))
+
+        with self.lock:
+            server_list = [{"name": server.name, "rank": server.rank} for server in self.servers.values()]
+
+        return {"service": "list", "data": {"list": server_list, "timestamp": int(time.time()), "clock": self.increment_clock()}}
+
+    def handle_heartbeat(self, data):
+        server_name = str(data.get('user', ''))
+        self.update_clock(data.get('clock', 0))
+
+        with self.lock:
+            server = self.servers.get(server_name)
+            if server is not None:
+                server.last_heartbeat = time.time()
+
+        return {"service": "heartbeat", "data": {"timestamp": int(time.time()), "clock": self.increment_clock()}}
+
+    def cleanup_inactive_servers(self):
+        while True:
+            time.sleep(self.cleanup_interval)
+
+            with self.lock:
+                deadline = time.time() - self.inactive_after
+                inactive = [name for name, server in self.servers.items() if server.last_heartbeat < deadline]
+                for name in inactive:
+                    print(f"⚠️  Removendo servidor inativo: {name}")
+                    del self.servers[name]
+                if inactive:
+                    print(f"📊 Servidores ativos: {len(self.servers)}")
+
+    def run(self):
+        print("Servidor de Referência iniciado")
+        print(f"Endpoint: {self.endpoint}")
+
+        threading.Thread(target=self.cleanup_inactive_servers, name="limpeza", daemon=True).start()
+
+        handlers = {
+            'rank': self.handle_rank,
+            'list': self.handle_list,
+            'heartbeat': self.handle_heartbeat
+        }
+
+        while True:
+            try:
+                message = msgpack.unpackb(self.rep_socket.recv())
+            except zmq.ContextTerminated:
+                # Com o contexto compartilhado, term() só retorna depois que o socket fecha
+                self.rep_socket.close(linger=0)
+                return
+
+            try:
+                data = message.get('data')
+                handler = handlers.get(message.get('service'))
+                if not isinstance(data, dict):
+                    response = {"error": "Dados inválidos"}
+                elif handler is None:
+                    response = {"error": "Serviço desconhecido"}
+                else:
+                    response = handler(data)
+            except Exception as e:
+                print(f"❌ Erro ao processar mensagem: {e}")
+                response = {"error": str(e)}
+
+            self.rep_socket.send(msgpack.packb(response))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor de referência (ranks e lista de servidores)")
+    parser.add_argument('--bind', help="endpoint do socket REP (padrão: REFERENCE_BIND ou tcp://*:5559)")
+    args = parser.parse_args()
+
+    referencia = Referencia(endpoint=args.bind)
+    referencia.run()
@@ -0,0 +1,158 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+import zmq
+import zmq.asyncio
+
+
+class AsyncRuntime:
+    """Laço do servidor em asyncio: cada socket e cada temporizador é uma tarefa independente.
+
+    Os sockets lidos aqui ganham uma visão zmq.asyncio do mesmo socket libzmq. Todas as tarefas rodam na
+    thread do laço, então cada socket continua com um único dono; o fsync do log vai para um executor e
+    não atrasa as demais tarefas. O atraso de cada temporizador é medido em bbs_server_timer_lag_seconds.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.log = server.log
+        self.metrics = server.metrics
+        self.disk = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disco")
+        self.tasks = []
+        self.terminated = False
+
+        # O heartbeat ao broker também sai por aqui: enviar pelo socket síncrono consumiria eventos
+        # do descritor que o zmq.asyncio espera
+        self.req_socket = zmq.asyncio.Socket.from_socket(server.req_socket)
+        self.reply_socket = zmq.asyncio.Socket.from_socket(server.dispatcher.reply_socket)
+        self.replication_socket = zmq.asyncio.Socket.from_socket(server.replication_socket)
+        self.election_socket = zmq.asyncio.Socket.from_socket(server.election_socket)
+
+        self.metrics.describe('bbs_server_timer_lag_seconds', 'Atraso de cada disparo de temporizador no laço asyncio')
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def loop_exception(self, loop, context):
+        """Com o contexto ZMQ encerrado, os leitores de descritor do zmq.asyncio falham fora das tarefas"""
+        if isinstance(context.get('exception'), zmq.ContextTerminated):
+            self.terminated = True
+            for task in self.tasks:
+                task.cancel()
+            return
+        loop.default_exception_handler(context)
+
+    async def main(self):
+        server = self.server
+        asyncio.get_running_loop().set_exception_handler(self.loop_exception)
+        self.tasks = [
+            asyncio.create_task(self.requests(), name="requisicoes"),
+            asyncio.create_task(self.replies(), name="respostas"),
+            asyncio.create_task(self.replication(), name="replicacao"),
+            asyncio.create_task(self.election(), name="eleicao"),
+            asyncio.create_task(self.every('broker', server.broker_heartbeat_interval, self.broker_heartbeat, first=0)),
+            asyncio.create_task(self.every('coordenador', server.coordinator_heartbeat_interval, server.heartbeat)),
+            asyncio.create_task(self.every('eleicao', 0.5, server.check_election)),
+            asyncio.create_task(self.berkeley()),
+            asyncio.create_task(self.wal())
+        ]
+        try:
+            # A primeira tarefa que falhar (ex.: contexto encerrado) derruba o laço
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            if self.terminated:
+                raise zmq.ContextTerminated()
+            raise
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            self.disk.shutdown(wait=False)
+
+    async def requests(self):
+        while True:
+            frames = await self.req_socket.recv_multipart()
+            try:
+                self.server.dispatcher.dispatch(frames)
+            except Exception as e:
+                self.log.error(f"❌ Erro ao despachar requisição: {e}", key='despacho')
+
+    async def replies(self):
+        while True:
+            frames = await self.reply_socket.recv_multipart()
+            try:
+                await self.req_socket.send_multipart(self.server.dispatcher.finish_reply(frames))
+                self.server.message_count += 1
+            except zmq.ContextTerminated:
+                raise
+            except Exception as e:
+                self.log.error(f"❌ Erro ao enviar resposta: {e}", key='resposta')
+
+    async def replication(self):
+        server = self.server
+        while True:
+            topic, payload = await self.replication_socket.recv_multipart()
+            try:
+                msg = msgpack.unpackb(payload)
+                server.dispatcher.submit_write(lambda msg=msg: server.handle_replication_message(msg))
+            except Exception as e:
+                self.log.error(f"❌ Erro ao processar replicação: {e}", key='replicacao')
+
+    async def election(self):
+        while True:
+            topic, payload = await self.election_socket.recv_multipart()
+            try:
+                self.server.handle_election_message(msgpack.unpackb(payload))
+            except Exception as e:
+                self.log.error(f"❌ Erro ao processar mensagem de eleição: {e}", key='eleicao')
+
+    async def broker_heartbeat(self):
+        await self.req_socket.send_multipart(self.server.broker_heartbeat_frames())
+
+    async def every(self, name, interval, action, first=None):
+        """Chama action a cada interval segundos em horários fixos: um disparo atrasado não empurra os seguintes"""
+        loop = asyncio.get_running_loop()
+        due = loop.time() + (interval if first is None else first)
+        while True:
+            await asyncio.sleep(max(0, due - loop.time()))
+            self.metrics.observe('bbs_server_timer_lag_seconds', loop.time() - due, timer=name)
+            try:
+                result = action()
+                if asyncio.iscoroutine(result):
+                    await result
+            except zmq.ContextTerminated:
+                raise
+            except Exception as e:
+                self.log.error(f"❌ Erro no temporizador {name}: {e}", key=f"temporizador:{name}")
+            due += interval
+            if due < loop.time():
+                due = loop.time() + interval  # Voltas perdidas não disparam em rajada
+
+    async def berkeley(self):
+        """Agenda rodadas e acorda exatamente no fim da janela de coleta da rodada em andamento"""
+        server = self.server
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                server.berkeley_tick()
+            except Exception as e:
+                self.log.error(f"❌ Erro no Berkeley: {e}", key='berkeley')
+            delay = 0.5
+            if server.berkeley_round is not None:
+                delay = min(delay, server.berkeley_round['deadline'] - time.time())
+            due = loop.time() + max(0, delay)
+            await asyncio.sleep(max(0, delay))
+            self.metrics.observe('bbs_server_timer_lag_seconds', loop.time() - due, timer='berkeley')
+
+    async def wal(self):
+        """Políticas 'batch' e 'interval' do log: o fsync roda no executor de disco"""
+        wal = self.server.wal
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(wal.fsync_interval)
+            if wal.pending:
+                try:
+                    await loop.run_in_executor(self.disk, wal.tick)
+                except Exception as e:
+                    self.log.error(f"❌ Erro no fsync do log: {e}", key='wal')
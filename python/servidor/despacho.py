@@ -0,0 +1,294 @@
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+import zmq
+
+from metricas import Log
+
+
+class PackedReply(bytes):
+    """Resposta já serializada em msgpack (ex.: vinda do cache): enviada sem passar pelo packb"""
+
+
+class ReadWriteLock:
+    """Lock leitores/escritor: leituras em paralelo, escritas exclusivas (prioridade ao escritor)"""
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer_active = False
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.condition:
+            while self.writer_active or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.condition:
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer_active or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer_active = True
+
+    def release_write(self):
+        with self.condition:
+            self.writer_active = False
+            self.condition.notify_all()
+
+    def read(self):
+        return _Guard(self.acquire_read, self.release_read)
+
+    def write(self):
+        return _Guard(self.acquire_write, self.release_write)
+
+
+class _Guard:
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class RequestDispatcher:
+    """Distribui requisições do broker entre leitores paralelos e um escritor único"""
+
+    REPLY_ENDPOINT = "inproc://servidor-respostas"
+    READ_TAG = b"r"
+    WRITE_TAG = b"w"
+
+    def __init__(self, context, handlers, write_services, workers=4, writer_tick=None, tick_interval=0.05,
+                 encode_default=None, metrics=None, log=None, commit=None, commit_batch=64, commit_wait=0.0):
+        self.context = context
+        self.metrics = metrics
+        self.log = log or Log()
+        self.encode_default = encode_default  # Hook 'default' do msgpack para tipos próprios nas respostas
+        self.handlers = handlers
+        self.write_services = set(write_services)
+        self.workers = workers
+        self.writer_tick = writer_tick  # Chamado pelo escritor após cada tarefa e quando ocioso
+        self.tick_interval = tick_interval
+        self.lock = ReadWriteLock()
+
+        # Group commit: com 'commit', as respostas de escrita só saem depois que commit() torna o lote
+        # durável; o lote junta até commit_batch tarefas já na fila ou chegadas em até commit_wait segundos
+        self.commit = commit
+        self.commit_batch = max(1, commit_batch)
+        self.commit_wait = commit_wait
+        self.held = []  # (envelope, serviço, início, resposta) aguardando o commit (só o escritor altera)
+
+        # Respostas dos workers voltam ao loop principal, único dono do socket do broker;
+        # o sufixo permite vários servidores no mesmo contexto (python/local/cluster.py)
+        self.reply_endpoint = f"{self.REPLY_ENDPOINT}-{id(self):x}"
+        self.reply_socket = self.context.socket(zmq.PULL)
+        self.reply_socket.bind(self.reply_endpoint)
+        self.local = threading.local()
+
+        self.readers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="leitor")
+        self.write_queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._writer_loop, name="escritor", daemon=True)
+        self.writer_thread.start()
+
+        # Escritas ainda sem resposta por cliente: leituras seguintes esperam na fila do escritor
+        self.pending_writes = {}
+        self.inflight = 0  # Requisições despachadas e ainda sem resposta (só o loop principal altera)
+
+        if metrics is not None:
+            metrics.describe('bbs_server_requests_total', 'Requisições atendidas por serviço e tipo (read/write)')
+            metrics.describe('bbs_server_request_errors_total', 'Requisições respondidas com erro')
+            metrics.describe('bbs_server_request_seconds', 'Tempo entre o despacho e a resposta pronta, por serviço')
+            metrics.gauge('bbs_server_requests_inflight', lambda: self.inflight)
+            metrics.gauge('bbs_server_write_queue_depth', self.write_queue.qsize)
+            metrics.describe('bbs_server_commit_batches_total', 'Lotes de escritas tornados duráveis por um único commit')
+            metrics.describe('bbs_server_commit_responses_total', 'Respostas de escrita liberadas pelo group commit')
+
+    def _push_socket(self):
+        sock = getattr(self.local, 'push', None)
+        if sock is None:
+            sock = self.context.socket(zmq.PUSH)
+            sock.setsockopt(zmq.LINGER, 0)
+            sock.connect(self.reply_endpoint)
+            self.local.push = sock
+        return sock
+
+    def _execute(self, service, data):
+        handler = self.handlers.get(service)
+        if handler is None:
+            return {"error": "Serviço desconhecido"}
+        return handler(data)
+
+    def _reply(self, tag, envelope, response):
+        """Devolve a resposta ao loop principal; a tag indica se veio do escritor"""
+        try:
+            payload = self._pack(response)
+        except Exception as e:
+            self.log.error(f"❌ Erro ao serializar resposta: {e}", key='serializacao')
+            payload = msgpack.packb({"error": str(e)})
+        self._push_socket().send_multipart([tag] + envelope + [payload])
+
+    def _pack(self, response):
+        if isinstance(response, PackedReply):
+            return response
+        return msgpack.packb(response, default=self.encode_default)
+
+    def _observe(self, service, kind, started, response):
+        if self.metrics is None:
+            return
+        # Serviços desconhecidos não viram rótulos (cardinalidade controlada pelo cliente)
+        label = service if service in self.handlers else 'desconhecido'
+        self.metrics.inc('bbs_server_requests_total', service=label, kind=kind)
+        self.metrics.observe('bbs_server_request_seconds', time.perf_counter() - started, service=label)
+        if isinstance(response, dict) and 'error' in response:
+            self.metrics.inc('bbs_server_request_errors_total', service=label)
+
+    def _read_task(self, envelope, service, data, started):
+        try:
+            # Serializa ainda com o lock: a resposta pode referenciar estruturas compartilhadas
+            with self.lock.read():
+                response = self._execute(service, data)
+                payload = self._pack(response)
+            self._push_socket().send_multipart([self.READ_TAG] + envelope + [payload])
+        except Exception as e:
+            self.log.error(f"❌ Erro ao processar requisição: {e}", key=f"requisicao:{service}")
+            response = {"error": str(e)}
+            self._reply(self.READ_TAG, envelope, response)
+        self._observe(service, 'read', started, response)
+
+    def _write_task(self, envelope, service, data, started):
+        try:
+            response = self._execute(service, data)
+        except Exception as e:
+            self.log.error(f"❌ Erro ao processar requisição: {e}", key=f"requisicao:{service}")
+            response = {"error": str(e)}
+        if self.commit is not None:
+            self.held.append((envelope, service, started, response))
+            return
+        self._reply(self.WRITE_TAG, envelope, response)
+        self._observe(service, 'write', started, response)
+
+    def _next_task(self, deadline):
+        """Próxima tarefa do lote: a que já está na fila ou a que chegar até o prazo"""
+        remaining = deadline - time.perf_counter()
+        try:
+            if remaining <= 0:
+                return self.write_queue.get_nowait()
+            return self.write_queue.get(timeout=remaining)
+        except queue.Empty:
+            return None
+
+    def _commit(self):
+        """Torna o lote durável e libera juntas as respostas retidas"""
+        held, self.held = self.held, []
+        try:
+            self.commit()
+        except Exception as e:
+            # O estado em memória já mudou, mas o cliente não recebe confirmação do que não foi gravado
+            self.log.error(f"❌ Erro no commit do lote: {e}", key='commit')
+            held = [(envelope, service, started, {"error": f"Falha ao gravar: {e}"})
+                    for envelope, service, started, _ in held]
+
+        for envelope, service, started, response in held:
+            self._reply(self.WRITE_TAG, envelope, response)
+            self._observe(service, 'write', started, response)
+
+        if self.metrics is not None:
+            self.metrics.inc('bbs_server_commit_batches_total')
+            self.metrics.inc('bbs_server_commit_responses_total', len(held))
+
+    def _writer_loop(self):
+        while True:
+            try:
+                task = self.write_queue.get(timeout=self.tick_interval)
+            except queue.Empty:
+                task = None
+
+            # Sem group commit cada tarefa é um lote; com ele, o escritor segue aplicando tarefas até
+            # encher o lote ou esgotar o prazo, e um único commit cobre todas
+            count = 0
+            deadline = time.perf_counter() + self.commit_wait
+            while task is not None:
+                try:
+                    with self.lock.write():
+                        task()
+                except Exception as e:
+                    self.log.error(f"❌ Erro no escritor: {e}", key='escritor')
+                count += 1
+                if self.commit is None or count >= self.commit_batch:
+                    break
+                task = self._next_task(deadline)
+
+            if self.held:
+                self._commit()
+
+            if self.writer_tick is not None:
+                try:
+                    self.writer_tick()
+                except Exception as e:
+                    self.log.error(f"❌ Erro no escritor: {e}", key='escritor')
+
+    def submit_write(self, task):
+        """Enfileira uma alteração de estado (ex.: replicação) no escritor único"""
+        self.write_queue.put(task)
+
+    def dispatch(self, frames):
+        """Chamado pelo loop principal com os frames recebidos do broker"""
+        started = time.perf_counter()
+        envelope, payload = frames[:-1], frames[-1]
+        self.inflight += 1
+
+        try:
+            msg = msgpack.unpackb(payload)
+            service = msg['service']
+            data = msg['data']
+        except Exception as e:
+            self.log.error(f"❌ Erro ao processar requisição: {e}", key='requisicao_invalida')
+            self._reply(self.READ_TAG, envelope, {"error": str(e)})
+            return
+
+        client = tuple(envelope)
+
+        if service in self.write_services or self.pending_writes.get(client):
+            self.pending_writes[client] = self.pending_writes.get(client, 0) + 1
+            self.write_queue.put(lambda: self._write_task(envelope, service, data, started))
+        else:
+            self.readers.submit(self._read_task, envelope, service, data, started)
+
+    def recv_reply(self):
+        """Lê uma resposta pronta e retorna os frames a enviar ao broker"""
+        return self.finish_reply(self.reply_socket.recv_multipart())
+
+    def finish_reply(self, frames):
+        """Frames lidos do socket de respostas -> frames a enviar ao broker (também usado pelo laço asyncio)"""
+        tag, frames = frames[0], frames[1:]
+        self.inflight -= 1
+
+        if tag == self.WRITE_TAG:
+            client = tuple(frames[:-1])
+            remaining = self.pending_writes.get(client, 0) - 1
+            if remaining > 0:
+                self.pending_writes[client] = remaining
+            else:
+                self.pending_writes.pop(client, None)
+
+        return frames
+
+    def close(self):
+        self.readers.shutdown(wait=False)
@@ -0,0 +1,180 @@
+import base64
+from bisect import bisect_left, bisect_right, insort
+from operator import attrgetter
+
+import msgpack
+
+from registros import order_key
+
+clock_of = attrgetter('clock')
+
+
+def encode_cursor(last, newest_first):
+    """Codifica como cursor opaco a chave (relógio, servidor de origem) do último registro entregue"""
+    clock, server = last
+    packed = msgpack.packb([clock, server, newest_first])
+    return base64.urlsafe_b64encode(packed).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decodifica um cursor gerado por encode_cursor"""
+    try:
+        clock, server, newest_first = msgpack.unpackb(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (int(clock), str(server)), bool(newest_first)
+    except Exception:
+        raise ValueError("Cursor de histórico inválido")
+
+
+def key_span(items, clock_of, key_of, after_clock, before_clock, resume, newest_first):
+    """Intervalo [low, high) de uma sequência em ordem (relógio, servidor) que atende aos filtros e ao cursor"""
+    low, high = 0, len(items)
+    if after_clock is not None:
+        low = bisect_right(items, after_clock, key=clock_of)
+    if before_clock is not None:
+        high = bisect_left(items, before_clock, lo=low, key=clock_of)
+    if resume is not None:
+        if newest_first:
+            high = bisect_left(items, resume, lo=low, hi=high, key=key_of)
+        else:
+            low = bisect_right(items, resume, lo=low, hi=high, key=key_of)
+    return low, max(low, high)
+
+
+def insert_ordered(records, record):
+    """Insere o registro na ordem (relógio, servidor de origem); retorna se ele chegou fora de ordem.
+
+    Chegadas em ordem (o caso comum) custam um append; as atrasadas entram por busca binária, em geral perto do fim.
+    """
+    if not records or order_key(records[-1]) <= order_key(record):
+        records.append(record)
+        return False
+    insort(records, record, key=order_key)
+    return True
+
+
+class HistoryIndex:
+    """Índice secundário chave -> registros (canal -> publicações, usuário -> mensagens).
+
+    Os registros de cada chave ficam em ordem (relógio, servidor de origem), a mesma em todas as réplicas.
+    """
+
+    def __init__(self, cold=None):
+        self.entries = {}  # chave -> registros quentes (em memória)
+        self.cold = cold  # SegmentStore com os registros selados; as páginas os intercalam com os quentes
+        self.floors = {}  # chave -> piso de retenção: registros com relógio <= piso deixam de existir
+
+    def retained(self, key, record):
+        floor = self.floors.get(key)
+        return floor is None or record.clock > floor
+
+    def expired(self, key, clock):
+        floor = self.floors.get(key)
+        return floor is not None and clock <= floor
+
+    def live(self, record):
+        """O registro ainda pertence a alguma das suas chaves (mensagens ficam em duas caixas)"""
+        return any(self.retained(key, record) for key in record.index_keys())
+
+    def set_floor(self, key, clock):
+        """Sobe o piso de retenção da chave; retorna quantos registros quentes saíram do índice"""
+        if self.expired(key, clock):
+            return 0
+        self.floors[key] = clock
+
+        records = self.entries.get(key)
+        if not records:
+            return 0
+        kept = [record for record in records if record.clock > clock]
+        if kept:
+            self.entries[key] = kept
+        else:
+            del self.entries[key]
+        return len(records) - len(kept)
+
+    def add(self, key, record):
+        """Indexa o registro sob a chave na ordem (relógio, servidor de origem)"""
+        if not self.retained(key, record):
+            return
+        records = self.entries.get(key)
+        if records is None:
+            records = self.entries[key] = []
+        insert_ordered(records, record)
+
+    def get(self, key):
+        """Retorna os registros da chave (custo proporcional ao resultado)"""
+        return self.page(key)[0]
+
+    def discard_sealed(self, key, count):
+        """Remove da parte quente os count registros mais antigos da chave, já selados em segmento"""
+        records = self.entries.get(key)
+        if records is None:
+            return
+        if count >= len(records):
+            del self.entries[key]
+        else:
+            self.entries[key] = records[count:]
+
+    def page(self, key, limit=None, before_clock=None, after_clock=None, cursor=None, newest_first=False):
+        """Retorna (registros, próximo cursor) de uma página do histórico da chave.
+
+        Frios e quentes estão, cada um, em ordem (relógio, servidor de origem), e a página intercala os dois.
+        O cursor é a chave do último registro entregue: inserções atrasadas, cortes de retenção e a selagem
+        não deslocam a página seguinte.
+        """
+        resume = None
+        if cursor is not None:
+            # O cursor fixa a direção da paginação iniciada na primeira página
+            resume, newest_first = decode_cursor(cursor)
+
+        # Registros abaixo do piso ainda podem estar nos segmentos frios: o piso entra como after_clock
+        floor = self.floors.get(key)
+        if floor is not None and (after_clock is None or after_clock < floor):
+            after_clock = floor
+
+        records = self.entries.get(key, ())
+        hot_low, hot_high = key_span(records, clock_of, order_key, after_clock, before_clock, resume, newest_first)
+        cold_positions = self.cold.key_positions(key) if self.cold else ()
+        cold_low, cold_high = 0, 0
+        if cold_positions:
+            cold_low, cold_high = key_span(cold_positions, self.cold.clock, self.cold.order_key,
+                                           after_clock, before_clock, resume, newest_first)
+
+        page = []
+        last = None
+        while cold_low < cold_high or hot_low < hot_high:
+            if limit is not None and len(page) >= limit:
+                break
+            # Compara pelas chaves do índice e só desserializa os registros frios entregues
+            if newest_first:
+                cold_key = self.cold.order_key(cold_positions[cold_high - 1]) if cold_low < cold_high else None
+                hot_key = order_key(records[hot_high - 1]) if hot_low < hot_high else None
+                if hot_key is None or (cold_key is not None and cold_key > hot_key):
+                    cold_high -= 1
+                    last = cold_key
+                    page.append(self.cold.get(cold_positions[cold_high]))
+                else:
+                    hot_high -= 1
+                    last = hot_key
+                    page.append(records[hot_high])
+            else:
+                cold_key = self.cold.order_key(cold_positions[cold_low]) if cold_low < cold_high else None
+                hot_key = order_key(records[hot_low]) if hot_low < hot_high else None
+                if hot_key is None or (cold_key is not None and cold_key <= hot_key):
+                    cold_low += 1
+                    last = cold_key
+                    page.append(self.cold.get(cold_positions[cold_low - 1]))
+                else:
+                    hot_low += 1
+                    last = hot_key
+                    page.append(records[hot_low - 1])
+
+        remaining = cold_low < cold_high or hot_low < hot_high
+        next_cursor = encode_cursor(last, newest_first) if last is not None and remaining else None
+        return page, next_cursor
+
+    def clear(self):
+        """Limpa os registros; os pisos de retenção continuam valendo"""
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,61 @@
+import os
+import time
+from collections import OrderedDict
+
+
+class RequestDedup:
+    """Respostas de escritas já aplicadas, por ID de requisição do cliente: uma repetição recebe a resposta original.
+
+    Limitada por quantidade (REQUEST_DEDUP_ENTRIES) e por idade (REQUEST_DEDUP_TTL); as entradas saem na ordem
+    de inserção. Só o escritor consulta e altera a tabela. As respostas ficam sem o relógio lógico, preenchido
+    a cada repetição.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries  # 0 desliga a deduplicação
+        self.ttl = ttl
+        self.entries = OrderedDict()  # (serviço, ID) -> (instante da escrita, resposta)
+
+    @classmethod
+    def from_env(cls):
+        return cls(int(os.getenv('REQUEST_DEDUP_ENTRIES', '10000')), float(os.getenv('REQUEST_DEDUP_TTL', '300')))
+
+    def get(self, service, request_id, now=None):
+        self.expire(now)
+        entry = self.entries.get((service, request_id))
+        return entry[1] if entry is not None else None
+
+    def put(self, service, request_id, response, timestamp, now=None):
+        """Guarda a resposta; entradas já vencidas (ex.: reaplicadas do log) são ignoradas"""
+        now = time.time() if now is None else now
+        if not self.max_entries or now - timestamp >= self.ttl:
+            return False
+
+        key = (service, request_id)
+        self.entries.pop(key, None)
+        self.entries[key] = (timestamp, response)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return True
+
+    def expire(self, now=None):
+        """Remove as entradas mais antigas que o TTL (as replicadas chegam quase em ordem de instante)"""
+        deadline = (time.time() if now is None else now) - self.ttl
+        while self.entries:
+            timestamp, _ = next(iter(self.entries.values()))
+            if timestamp > deadline:
+                break
+            self.entries.popitem(last=False)
+
+    def state(self):
+        """Entradas vivas, para o snapshot e para a transferência a outro servidor"""
+        self.expire()
+        return [[service, request_id, timestamp, response]
+                for (service, request_id), (timestamp, response) in self.entries.items()]
+
+    def load(self, state):
+        for service, request_id, timestamp, response in state or ():
+            self.put(service, request_id, response, timestamp)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,237 @@
+import msgpack
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from serializacao import Packed
+
+# Chaves dos registros do log já serializadas: os dados (muitas vezes Packed) entram sem nova serialização
+_LSN_KEY = msgpack.packb("lsn")
+_OP_KEY = msgpack.packb("op")
+_DATA_KEY = msgpack.packb("data")
+_SRC_KEY = msgpack.packb("src")
+
+
+class WriteAheadLog:
+    """Log append-only de operações do servidor (registros msgpack em segmentos)"""
+
+    # 'group': o fsync vem do commit do escritor (despacho.py), antes de responder ao lote
+    FSYNC_POLICIES = ('always', 'batch', 'interval', 'group')
+
+    def __init__(self, directory, fsync_policy='batch', batch_size=64, fsync_interval=0.05, default=None,
+                 on_sync=None):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            raise ValueError(f"Política de fsync inválida: {fsync_policy}")
+
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.fsync_policy = fsync_policy
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.default = default  # Hook 'default' do msgpack para tipos próprios nos dados
+        self.packer = msgpack.Packer(default=default)  # Reutilizado sob o lock
+        self.on_sync = on_sync  # on_sync(segundos, registros) após cada fsync (métricas)
+
+        # Protege a lista de segmentos (o snapshot roda em outra thread)
+        self.lock = threading.Lock()
+
+        self.last_lsn = 0
+        self.pending = 0  # Registros escritos e ainda não sincronizados
+        self.last_fsync = time.time()
+        self.bytes_written = 0  # Bytes no log desde o último snapshot
+
+        self.segments = self._list_segments()
+        self.fd = None
+
+    def _segment_path(self, first_lsn):
+        return self.directory / f"wal-{first_lsn:016d}.log"
+
+    def _list_segments(self):
+        """Retorna [(primeiro_lsn, caminho)] dos segmentos existentes, em ordem"""
+        segments = []
+        for path in self.directory.glob('wal-*.log'):
+            try:
+                segments.append((int(path.stem.split('-')[1]), path))
+            except ValueError:
+                continue
+        return sorted(segments)
+
+    def _open_segment(self, first_lsn):
+        path = self._segment_path(first_lsn)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        if not self.segments or self.segments[-1][1] != path:
+            self.segments.append((first_lsn, path))
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        try:
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+    def replay(self, after_lsn=0):
+        """Lê os registros com lsn > after_lsn; descarta cauda corrompida do último segmento"""
+        for index, (first_lsn, path) in enumerate(list(self.segments)):
+            with open(path, 'rb') as f:
+                unpacker = msgpack.Unpacker(f, raw=False)
+                good_offset = 0
+
+                while True:
+                    try:
+                        record = unpacker.unpack()
+                    except msgpack.OutOfData:
+                        break
+                    except Exception as e:
+                        print(f"⚠️  Registro corrompido em {path.name}: {e}")
+                        break
+
+                    good_offset = unpacker.tell()
+                    lsn = record['lsn']
+                    self.last_lsn = max(self.last_lsn, lsn)
+
+                    if lsn > after_lsn:
+                        yield lsn, record['op'], record['data'], record.get('src')
+
+            size = path.stat().st_size
+            if good_offset < size:
+                # Escrita interrompida por queda: corta o lixo para não anexar depois dele
+                if index == len(self.segments) - 1:
+                    print(f"⚠️  Truncando cauda incompleta de {path.name} ({size - good_offset} bytes)")
+                    os.truncate(path, good_offset)
+                    size = good_offset
+
+            self.bytes_written += size
+
+        self.last_lsn = max(self.last_lsn, after_lsn)
+
+    def append(self, operation, data, origin=None):
+        """Anexa uma operação ao log e retorna seu lsn"""
+        return self.append_batch([(operation, data, origin)])
+
+    def append_batch(self, operations):
+        """Anexa [(operação, dados, origem)] com uma única escrita; retorna o último lsn"""
+        if not operations:
+            return self.last_lsn
+
+        with self.lock:
+            if self.fd is None:
+                self._open_segment(self.last_lsn + 1)
+
+            packer = self.packer
+            chunks = []
+            for operation, data, origin in operations:
+                self.last_lsn += 1
+                # Mesmo formato de {"lsn", "op", "data"[, "src"]}, montado a partir das partes
+                chunks.append(packer.pack_map_header(3 if origin is None else 4))
+                chunks.append(_LSN_KEY + packer.pack(self.last_lsn) + _OP_KEY + packer.pack(operation) + _DATA_KEY)
+                chunks.append(data if isinstance(data, Packed) else packer.pack(data))
+                if origin is not None:
+                    # (servidor de origem, sequência de replicação)
+                    chunks.append(_SRC_KEY + packer.pack(list(origin)))
+
+            buffer = b"".join(chunks)
+            os.write(self.fd, buffer)
+
+            self.bytes_written += len(buffer)
+            self.pending += len(operations)
+
+        if self.fsync_policy == 'always':
+            self.sync()
+        elif self.fsync_policy == 'batch' and self.pending >= self.batch_size:
+            self.sync()
+
+        return self.last_lsn
+
+    def sync(self):
+        """Força os registros pendentes para o disco (group commit)"""
+        with self.lock:
+            if self.fd is None or self.pending == 0:
+                return
+            started = time.perf_counter()
+            os.fsync(self.fd)
+            records = self.pending
+            self.pending = 0
+            self.last_fsync = time.time()
+
+        if self.on_sync is not None:
+            self.on_sync(time.perf_counter() - started, records)
+
+    def tick(self):
+        """Chamado pelo loop principal: aplica as políticas 'batch' e 'interval' (e 'group' fora dos lotes)"""
+        if self.pending and time.time() - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def rotate(self):
+        """Fecha o segmento atual; o próximo append abre um segmento novo"""
+        self.sync()
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            self.bytes_written = 0
+            return self.last_lsn
+
+    def discard_through(self, lsn):
+        """Remove segmentos cujos registros já estão todos cobertos pelo snapshot"""
+        with self.lock:
+            keep = []
+            for index, (first_lsn, path) in enumerate(self.segments):
+                next_first = self.segments[index + 1][0] if index + 1 < len(self.segments) else None
+                is_open = self.fd is not None and index == len(self.segments) - 1
+                if next_first is not None and next_first - 1 <= lsn and not is_open:
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                elif next_first is None and not is_open and self.last_lsn <= lsn:
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                else:
+                    keep.append((first_lsn, path))
+            self.segments = keep
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+def write_snapshot(path, state, default=None):
+    """Grava o snapshot compactado de forma atômica (tmp + fsync + rename)"""
+    path = Path(path)
+    tmp_path = path.with_suffix('.tmp')
+
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, default=default)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+    dir_fd = os.open(path.parent, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+    return path.stat().st_size
+
+
+def read_snapshot(path):
+    """Lê o snapshot compactado, ou None se não existir"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,122 @@
+import sys
+from operator import attrgetter
+
+
+def intern_name(name):
+    """Nomes de usuário e de canal compartilham uma única cópia (tabela de strings do interpretador)"""
+    return sys.intern(name) if type(name) is str else name
+
+
+# Ordem total do histórico: relógio lógico e, no empate, o servidor que criou o registro
+order_key = attrgetter('clock', 'server')
+
+
+class Publication:
+    """Publicação em canal armazenada sem dicionário por registro"""
+
+    __slots__ = ('user', 'channel', 'message', 'timestamp', 'clock', 'server')
+
+    def __init__(self, user, channel, message, timestamp, clock, server=''):
+        self.user = intern_name(user)
+        self.channel = intern_name(channel)
+        self.message = message
+        self.timestamp = timestamp
+        self.clock = clock
+        self.server = intern_name(server)  # Servidor de origem ('' em registros anteriores ao campo)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['user'], data['channel'], data['message'], data.get('timestamp', 0), data.get('clock', 0),
+                   data.get('server', ''))
+
+    def index_keys(self):
+        return (self.channel,)
+
+    def to_list(self):
+        """Esquema compacto (RECORD_SCHEMA=array): campos na ordem do construtor"""
+        return [self.user, self.channel, self.message, self.timestamp, self.clock, self.server]
+
+    def identity(self):
+        """Tupla com todos os campos: identifica cópias do mesmo registro vindas de servidores diferentes"""
+        return (self.user, self.channel, self.message, self.timestamp, self.clock, self.server)
+
+    def to_dict(self):
+        return {
+            'user': self.user,
+            'channel': self.channel,
+            'message': self.message,
+            'timestamp': self.timestamp,
+            'clock': self.clock,
+            'server': self.server
+        }
+
+
+class Message:
+    """Mensagem privada armazenada sem dicionário por registro"""
+
+    __slots__ = ('from_user', 'to_user', 'message', 'timestamp', 'clock', 'server')
+
+    def __init__(self, from_user, to_user, message, timestamp, clock, server=''):
+        self.from_user = intern_name(from_user)
+        self.to_user = intern_name(to_user)
+        self.message = message
+        self.timestamp = timestamp
+        self.clock = clock
+        self.server = intern_name(server)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['from'], data['to'], data['message'], data.get('timestamp', 0), data.get('clock', 0),
+                   data.get('server', ''))
+
+    def index_keys(self):
+        """Remetente e destinatário (uma vez só quando o usuário escreve para si mesmo)"""
+        if self.to_user == self.from_user:
+            return (self.from_user,)
+        return (self.from_user, self.to_user)
+
+    def identity(self):
+        return (self.from_user, self.to_user, self.message, self.timestamp, self.clock, self.server)
+
+    def to_list(self):
+        return [self.from_user, self.to_user, self.message, self.timestamp, self.clock, self.server]
+
+    def to_dict(self):
+        return {
+            'from': self.from_user,
+            'to': self.to_user,
+            'message': self.message,
+            'timestamp': self.timestamp,
+            'clock': self.clock,
+            'server': self.server
+        }
+
+
+def as_publication(record):
+    if isinstance(record, Publication):
+        return record
+    if isinstance(record, (list, tuple)):
+        return Publication(*record)
+    return Publication.from_dict(record)
+
+
+def as_message(record):
+    if isinstance(record, Message):
+        return record
+    if isinstance(record, (list, tuple)):
+        return Message(*record)
+    return Message.from_dict(record)
+
+
+def encode_record(obj):
+    """Hook 'default' do msgpack/json: serializa registros no formato de dicionário do protocolo"""
+    if isinstance(obj, (Publication, Message)):
+        return obj.to_dict()
+    raise TypeError(f"Tipo não serializável: {type(obj).__name__}")
+
+
+def encode_record_fields(obj):
+    """Hook 'default' do esquema compacto: registros como listas de campos"""
+    if isinstance(obj, (Publication, Message)):
+        return obj.to_list()
+    raise TypeError(f"Tipo não serializável: {type(obj).__name__}")
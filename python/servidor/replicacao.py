@@ -0,0 +1,143 @@
+import time
+import zlib
+from collections import deque
+
+import msgpack
+
+# Ordem das seções na transferência de snapshot em blocos
+SNAPSHOT_SECTIONS = ('users', 'channels', 'messages', 'publications')
+
+
+class ReplicationBatcher:
+    """Agrupa operações locais em frames de replicação limitados por tamanho e por tempo"""
+
+    # Operações idempotentes: repetições dentro do mesmo frame são descartadas
+    COALESCE_KEYS = {
+        'login': 'user',
+        'channel_create': 'channel'
+    }
+
+    def __init__(self, send, max_ops=64, window=0.005, pack_op=None):
+        self.send = send  # send(ops, first_seq, last_seq)
+        self.pack_op = pack_op  # pack_op(seq, operação, dados): guarda as operações já serializadas
+        self.max_ops = max_ops
+        self.window = window
+
+        self.ops = []
+        self.seen = set()
+        self.first_seq = None
+        self.last_seq = None
+        self.opened_at = None
+
+    def add(self, seq, operation, data):
+        """Adiciona a operação de sequência seq ao frame em aberto"""
+        self._append(seq, operation, data)
+        if len(self.ops) >= self.max_ops:
+            self.flush()
+
+    def add_batch(self, entries):
+        """Adiciona [(seq, operação, dados)] ao mesmo frame: um lote do cliente é replicado inteiro de uma vez"""
+        for seq, operation, data in entries:
+            self._append(seq, operation, data)
+        if len(self.ops) >= self.max_ops:
+            self.flush()
+
+    def _append(self, seq, operation, data):
+        if self.first_seq is None:
+            self.first_seq = seq
+            self.opened_at = time.time()
+        self.last_seq = seq
+
+        key_field = self.COALESCE_KEYS.get(operation)
+        if key_field is not None:
+            key = (operation, data.get(key_field))
+            if key in self.seen:
+                return
+            self.seen.add(key)
+
+        if self.pack_op is not None:
+            self.ops.append(self.pack_op(seq, operation, data))
+        else:
+            self.ops.append({"seq": seq, "operation": operation, "data": data})
+
+    def tick(self):
+        """Envia o frame em aberto quando a janela de agrupamento expira"""
+        if self.first_seq is not None and time.time() - self.opened_at >= self.window:
+            self.flush()
+
+    def flush(self):
+        if self.first_seq is None:
+            return
+
+        ops, first_seq, last_seq = self.ops, self.first_seq, self.last_seq
+        self.ops = []
+        self.seen = set()
+        self.first_seq = None
+        self.last_seq = None
+        self.opened_at = None
+
+        self.send(ops, first_seq, last_seq)
+
+
+class ReplicationBacklog:
+    """Operações recentes por servidor de origem, usadas para responder pedidos de catch-up"""
+
+    def __init__(self, max_ops=10000):
+        self.max_ops = max_ops
+        self.entries = {}  # origem -> deque[(seq, operação, dados)]
+        self.floors = {}  # origem -> maior sequência que não está mais disponível
+
+    def add(self, source, seq, operation, data):
+        entries = self.entries.get(source)
+        if entries is None:
+            entries = self.entries[source] = deque()
+        entries.append((seq, operation, data))
+
+        if len(entries) > self.max_ops:
+            evicted_seq = entries.popleft()[0]
+            self.floors[source] = max(self.floors.get(source, 0), evicted_seq)
+
+    def reset(self, source, floor):
+        """Descarta as operações da origem: nada até floor pode ser servido daqui"""
+        self.entries.pop(source, None)
+        self.floors[source] = floor
+
+    def range(self, source, first_seq, last_seq):
+        """Operações com first_seq <= seq <= last_seq, ou None se parte já saiu do backlog"""
+        if first_seq <= self.floors.get(source, 0):
+            return None
+        return [
+            (seq, operation, data)
+            for seq, operation, data in self.entries.get(source, ())
+            if first_seq <= seq <= last_seq
+        ]
+
+
+def pack_chunk(records, max_records, max_bytes, default=None):
+    """Serializa registros de um iterador até o limite de registros ou de bytes.
+
+    Retorna (payload, quantidade, checksum); o payload é uma sequência de objetos msgpack.
+    """
+    packer = msgpack.Packer(default=default)
+    parts = []
+    size = 0
+
+    for record in records:
+        packed = packer.pack(record)
+        parts.append(packed)
+        size += len(packed)
+        if len(parts) >= max_records or size >= max_bytes:
+            break
+
+    payload = b"".join(parts)
+    return payload, len(parts), zlib.crc32(payload)
+
+
+def unpack_chunk(payload, checksum):
+    """Valida o checksum de um bloco gerado por pack_chunk e retorna seus registros"""
+    if zlib.crc32(payload) != checksum:
+        raise ValueError("Checksum do bloco de snapshot não confere")
+
+    unpacker = msgpack.Unpacker(raw=False)
+    unpacker.feed(payload)
+    return list(unpacker)
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+
+import msgpack
+
+from despacho import PackedReply
+
+
+class CachedResponse:
+    """Resposta já serializada, sem o relógio lógico (que muda a cada chamada)"""
+
+    __slots__ = ('prefix', 'size')
+
+    def __init__(self, fields, default=None):
+        packer = msgpack.Packer(default=default)
+        # Cabeçalho do mapa com uma entrada a mais; o par 'clock' é anexado em reply()
+        parts = [packer.pack_map_header(len(fields) + 1)]
+        for key, value in fields.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        parts.append(packer.pack("clock"))
+        self.prefix = b"".join(parts)
+        self.size = len(self.prefix)
+
+    def reply(self, clock):
+        return PackedReply(self.prefix + msgpack.packb(clock))
+
+
+class ResponseCache:
+    """Cache LRU de respostas serializadas, invalidado por etiquetas ('users', 'channels', ('channel', nome))"""
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, default=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default = default  # Hook 'default' do msgpack para os registros
+        self.lock = threading.Lock()  # Leitores paralelos consultam e preenchem o cache
+        self.entries = OrderedDict()  # chave -> (CachedResponse, etiquetas)
+        self.tags = {}  # etiqueta -> chaves
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, tags, fields):
+        """Serializa os campos e guarda a resposta; devolve-a mesmo quando não cabe no cache"""
+        response = CachedResponse(fields, self.default)
+        # Respostas grandes demais (ex.: histórico completo) expulsariam todo o resto
+        if not self.max_entries or response.size > self.max_bytes // 4:
+            return response
+
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (response, tags)
+            self.bytes += response.size
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+        return response
+
+    def invalidate(self, tag):
+        with self.lock:
+            for key in self.tags.pop(tag, ()):
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        response, tags = entry
+        self.bytes -= response.size
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,80 @@
+import os
+from bisect import bisect_right
+
+# Tipos de chave com retenção: canal (publicações) e caixa de mensagens (usuário)
+RETENTION_KINDS = ('channel', 'mailbox')
+
+
+class RetentionPolicy:
+    """Limites de retenção de um canal ou caixa de mensagens; None = sem limite"""
+
+    FIELDS = ('max_count', 'max_clock_age', 'max_age', 'max_bytes')
+
+    __slots__ = FIELDS
+
+    def __init__(self, max_count=None, max_clock_age=None, max_age=None, max_bytes=None):
+        self.max_count = max_count  # Registros mais recentes mantidos
+        self.max_clock_age = max_clock_age  # Distância máxima, em relógio lógico, até o relógio atual
+        self.max_age = max_age  # Idade máxima em segundos (timestamp do registro)
+        self.max_bytes = max_bytes  # Tamanho serializado máximo dos registros mantidos
+
+    @classmethod
+    def from_env(cls, prefix):
+        """Lê <prefix>_MAX_COUNT, _MAX_CLOCK_AGE, _MAX_AGE e _MAX_BYTES (vazio = sem limite)"""
+        values = {}
+        for field in cls.FIELDS:
+            value = os.getenv(f"{prefix}_{field.upper()}")
+            values[field] = (float(value) if field == 'max_age' else int(value)) if value else None
+        return cls(**values)
+
+    @classmethod
+    def from_dict(cls, data):
+        values = {}
+        for field in cls.FIELDS:
+            value = data.get(field)
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f"'{field}' deve ser um número não negativo")
+            values[field] = value
+        return cls(**values)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+
+    @property
+    def active(self):
+        return any(getattr(self, field) is not None for field in self.FIELDS)
+
+    def watermark(self, clocks, logical_clock, now, timestamp_of, size_of):
+        """Maior relógio C tal que todos os registros com relógio <= C violam a política (None se nenhum).
+
+        clocks está em ordem crescente; timestamp_of(i) e size_of(i) só são chamados quando a política
+        usa idade física ou bytes, e apenas para os registros perto do corte.
+        """
+        total = len(clocks)
+        cut = 0  # Registros [0, cut) expiram
+
+        if self.max_count is not None and total > self.max_count:
+            cut = total - self.max_count
+        if self.max_clock_age is not None:
+            cut = max(cut, bisect_right(clocks, logical_clock - self.max_clock_age))
+        if self.max_age is not None:
+            # Conservador: para no primeiro registro ainda dentro do prazo
+            deadline = now - self.max_age
+            while cut < total and timestamp_of(cut) < deadline:
+                cut += 1
+        if self.max_bytes is not None:
+            kept = 0
+            start = total
+            while start > cut:
+                size = size_of(start - 1)
+                if kept + size > self.max_bytes:
+                    break
+                kept += size
+                start -= 1
+            cut = start
+
+        # O corte é por relógio: registros empatados com o primeiro mantido ficam todos
+        while 0 < cut < total and clocks[cut] == clocks[cut - 1]:
+            cut -= 1
+
+        return clocks[cut - 1] if cut else None
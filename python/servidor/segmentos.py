@@ -0,0 +1,298 @@
+import mmap
+import os
+from array import array
+from bisect import bisect_right
+from pathlib import Path
+
+import msgpack
+
+
+class Segment:
+    """Segmento imutável: registros msgpack contíguos, lidos via mmap pelos offsets do índice"""
+
+    def __init__(self, data_path, index):
+        self.data_path = data_path
+        self.first = index['first']
+        self.count = index['count']
+
+        self.offsets = array('Q')
+        self.offsets.frombytes(index['offsets'])
+
+        self.file = open(data_path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def size(self, local):
+        return self.offsets[local + 1] - self.offsets[local]
+
+    def read(self, local):
+        """Desserializa só o registro pedido (a fatia do mmap copia apenas seus bytes)"""
+        return msgpack.unpackb(self.map[self.offsets[local]:self.offsets[local + 1]], raw=False)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class SegmentStore:
+    """Histórico frio de uma coleção: registros mais antigos selados em segmentos mapeados em memória"""
+
+    def __init__(self, directory, decode, keys_of, default=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.decode = decode  # dict -> registro
+        self.keys_of = keys_of  # registro -> chaves do índice (canal, usuários)
+        self.default = default  # Hook 'default' do msgpack para os registros
+
+        self.segments = []
+        self.firsts = []
+        self.base = 0  # Primeira posição ainda guardada: segmentos anteriores foram removidos pela retenção
+        self.clocks = array('q')  # Relógio de cada registro frio a partir de base, para filtrar sem desserializar
+        self.origins = array('H')  # Servidor de origem de cada registro frio (índice em servers)
+        self.servers = ['']  # '' = segmentos gravados antes de os registros guardarem a origem
+        self.server_ids = {'': 0}
+        self.positions = {}  # chave -> array de posições globais, em ordem (relógio, servidor de origem)
+
+    @property
+    def count(self):
+        """Posição seguinte à do último registro selado (inclui os removidos pela retenção)"""
+        return self.base + len(self.clocks)
+
+    @property
+    def stored(self):
+        return len(self.clocks)
+
+    @property
+    def base_path(self):
+        return self.directory / 'base'
+
+    def _paths(self, first):
+        stem = f"seg-{first:012d}"
+        return self.directory / f"{stem}.dat", self.directory / f"{stem}.idx"
+
+    def open(self, cold_count):
+        """Carrega os índices dos segmentos cobertos pelo snapshot; os demais são descartados"""
+        self.close()
+        if self.base_path.exists():
+            self.base = int(self.base_path.read_text())
+
+        for index_path in sorted(self.directory.glob('seg-*.idx')):
+            data_path = index_path.with_suffix('.dat')
+            with open(index_path, 'rb') as f:
+                index = msgpack.unpackb(f.read(), raw=False)
+
+            # Removido pela retenção, mas a queda veio antes de apagar os arquivos
+            if index['first'] < self.base:
+                index_path.unlink()
+                data_path.unlink(missing_ok=True)
+                continue
+
+            # Selado depois do último snapshot: os registros ainda estão no snapshot/log
+            if index['first'] != self.count or index['first'] + index['count'] > cold_count:
+                index_path.unlink()
+                data_path.unlink(missing_ok=True)
+                continue
+
+            self._attach(Segment(data_path, index), index)
+
+        # Segmentos selados e removidos depois do snapshot: os registros voltam do snapshot/log e serão selados de novo
+        if not self.segments and self.base > cold_count:
+            self.base = cold_count
+            self.base_path.write_text(str(cold_count))
+
+        # Arquivos de dados sem índice são resto de uma selagem interrompida
+        for data_path in self.directory.glob('seg-*.dat'):
+            if not data_path.with_suffix('.idx').exists():
+                data_path.unlink()
+
+        if self.count != cold_count:
+            raise ValueError(f"Segmentos frios incompletos em {self.directory}: {self.count} de {cold_count} registros")
+
+    def _attach(self, segment, index):
+        self.segments.append(segment)
+        self.firsts.append(segment.first)
+
+        clocks = array('q')
+        clocks.frombytes(index['clocks'])
+        self.clocks.extend(clocks)
+
+        # Segmentos antigos não têm a origem: os registros ficam com '' e a ordem é refeita pelo relógio
+        legacy = 'servers' not in index
+        if legacy:
+            self.origins.extend(0 for _ in range(len(clocks)))
+        else:
+            names = [self.server_id(name) for name in index['servers']]
+            origins = array('H')
+            origins.frombytes(index['origins'])
+            self.origins.extend(names[origin] for origin in origins)
+
+        for key, local_positions in index['keys'].items():
+            local = array('Q')
+            local.frombytes(local_positions)
+            added = array('Q', (segment.first + position for position in local))
+            positions = self.positions.get(key)
+            if positions is None:
+                positions = self.positions[key] = array('Q')
+
+            # Um registro atrasado selado depois de outros mais novos da chave é intercalado na sua posição
+            if legacy or (positions and self.order_key(positions[-1]) > self.order_key(added[0])):
+                self.positions[key] = array('Q', sorted(positions + added, key=self.order_key))
+            else:
+                positions.extend(added)
+
+    def server_id(self, name):
+        server_id = self.server_ids.get(name)
+        if server_id is None:
+            server_id = self.server_ids[name] = len(self.servers)
+            self.servers.append(name)
+        return server_id
+
+    def seal(self, records):
+        """Grava os registros (os mais antigos do histórico quente) como um novo segmento"""
+        first = self.count
+        data_path, index_path = self._paths(first)
+
+        packer = msgpack.Packer(default=self.default)
+        offsets = array('Q', [0])
+        clocks = array('q')
+        origins = array('H')
+        servers = {}
+        keys = {}
+
+        tmp_data = data_path.with_suffix('.tmp')
+        with open(tmp_data, 'wb') as f:
+            for local, record in enumerate(records):
+                packed = packer.pack(record)
+                f.write(packed)
+                offsets.append(offsets[-1] + len(packed))
+                clocks.append(record.clock)
+                origins.append(servers.setdefault(record.server, len(servers)))
+                for key in self.keys_of(record):
+                    positions = keys.get(key)
+                    if positions is None:
+                        positions = keys[key] = array('Q')
+                    positions.append(local)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_data, data_path)
+
+        index = {
+            "first": first,
+            "count": len(clocks),
+            "offsets": offsets.tobytes(),
+            "clocks": clocks.tobytes(),
+            "servers": list(servers),
+            "origins": origins.tobytes(),
+            "keys": {key: positions.tobytes() for key, positions in keys.items()}
+        }
+
+        # O índice é gravado por último: só ele torna o segmento visível
+        tmp_index = index_path.with_suffix('.itmp')
+        with open(tmp_index, 'wb') as f:
+            f.write(msgpack.packb(index))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_index, index_path)
+        self._fsync_directory()
+
+        self._attach(Segment(data_path, index), index)
+
+    def _fsync_directory(self):
+        try:
+            dir_fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError:
+            pass
+
+    def drop_head(self, expired):
+        """Remove os segmentos mais antigos cujos registros expiraram em todas as chaves; retorna quantos saíram.
+
+        expired(chave, relógio) diz se o piso de retenção da chave cobre o relógio.
+        """
+        dropped = 0
+        while self.segments:
+            segment = self.segments[0]
+            end = segment.first + segment.count
+
+            # As posições de cada chave seguem a ordem do histórico, não a dos segmentos: o corte é um filtro
+            cuts = {}
+            for key, positions in self.positions.items():
+                removed = [self.clocks[position - self.base] for position in positions if position < end]
+                if not removed:
+                    continue
+                if not expired(key, max(removed)):
+                    return dropped
+                cuts[key] = array('Q', (position for position in positions if position >= end))
+
+            # A nova base vai para o disco antes: uma queda no meio apenas apaga o segmento no próximo open()
+            tmp_path = self.base_path.with_suffix('.tmp')
+            tmp_path.write_text(str(end))
+            os.replace(tmp_path, self.base_path)
+
+            data_path, index_path = self._paths(segment.first)
+            segment.close()
+            index_path.unlink(missing_ok=True)
+            data_path.unlink(missing_ok=True)
+
+            self.segments.pop(0)
+            self.firsts.pop(0)
+            self.clocks = self.clocks[segment.count:]
+            self.origins = self.origins[segment.count:]
+            self.base = end
+            for key, remaining in cuts.items():
+                if remaining:
+                    self.positions[key] = remaining
+                else:
+                    del self.positions[key]
+            dropped += segment.count
+
+        return dropped
+
+    def size(self, position):
+        """Tamanho serializado do registro, sem desserializá-lo"""
+        segment = self.segments[bisect_right(self.firsts, position) - 1]
+        return segment.size(position - segment.first)
+
+    def get(self, position):
+        """Registro na posição global (0 = mais antigo)"""
+        segment = self.segments[bisect_right(self.firsts, position) - 1]
+        return self.decode(segment.read(position - segment.first))
+
+    def clock(self, position):
+        return self.clocks[position - self.base]
+
+    def order_key(self, position):
+        """(relógio, servidor de origem) do registro, a mesma chave de registros.order_key, sem desserializar"""
+        offset = position - self.base
+        return self.clocks[offset], self.servers[self.origins[offset]]
+
+    def key_positions(self, key):
+        return self.positions.get(key, ())
+
+    def iter_range(self, start, stop):
+        for position in range(start, stop):
+            yield self.get(position)
+
+    def clear(self):
+        """Remove todos os segmentos (ex.: estado substituído por um snapshot de outro servidor)"""
+        self.close()
+        for path in self.directory.glob('seg-*'):
+            path.unlink()
+        self.base_path.unlink(missing_ok=True)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        self.firsts = []
+        self.base = 0
+        self.clocks = array('q')
+        self.origins = array('H')
+        self.servers = ['']
+        self.server_ids = {'': 0}
+        self.positions = {}
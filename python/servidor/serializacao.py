@@ -0,0 +1,86 @@
+import os
+import threading
+
+import msgpack
+
+from registros import encode_record, encode_record_fields
+
+# 'map': registros no formato do protocolo (o mesmo do pub/sub e das respostas);
+# 'array': listas de campos no log, nos segmentos frios e na replicação
+RECORD_SCHEMAS = ('map', 'array')
+
+# Prefixo de {"seq", "operation", "data"} e chaves já serializadas, para montar operações de frame por concatenação
+_OP_HEADER = b"\x83" + msgpack.packb("seq")  # Mapa de 3 entradas
+_OPERATION_KEY = msgpack.packb("operation")
+_DATA_KEY = msgpack.packb("data")
+
+
+class Packed(bytes):
+    """Valor já serializado em msgpack: entra no log, nos frames de replicação e no pub/sub sem nova serialização"""
+
+
+class RecordCodec:
+    """Serializa cada registro uma única vez e reaproveita os bytes em todos os destinos.
+
+    Um Packer por thread (msgpack.Packer não é thread-safe) evita criar um a cada chamada. Leitores
+    aceitam os dois esquemas (as_publication/as_message), então servidores com esquemas diferentes convivem.
+    """
+
+    def __init__(self, schema='map'):
+        if schema not in RECORD_SCHEMAS:
+            raise ValueError(f"Esquema de registros inválido: {schema}")
+        self.schema = schema
+        self.default = encode_record if schema == 'map' else encode_record_fields
+        self.local = threading.local()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv('RECORD_SCHEMA', 'map'))
+
+    def packer(self):
+        packer = getattr(self.local, 'packer', None)
+        if packer is None:
+            packer = self.local.packer = msgpack.Packer(default=self.default)
+        return packer
+
+    def pack(self, value):
+        """Serializa no esquema interno; valores já serializados passam direto"""
+        if isinstance(value, Packed):
+            return value
+        return Packed(self.packer().pack(value))
+
+    def pack_op(self, seq, operation, data):
+        """Operação de frame de replicação já serializada; os dados Packed entram sem nova serialização"""
+        packer = self.packer()
+        return Packed(_OP_HEADER + packer.pack(seq) + _OPERATION_KEY + packer.pack(operation) + _DATA_KEY
+                      + self.pack(data))
+
+    def wire(self, record, packed):
+        """Bytes do registro para o pub/sub (sempre no formato do protocolo)"""
+        if self.schema == 'map':
+            return packed
+        return self.packer().pack(record.to_dict())
+
+    def pack_tree(self, value):
+        """Serializa mapas e listas copiando os Packed que estiverem dentro (ex.: 'ops' de um frame)"""
+        if isinstance(value, Packed):
+            return value
+        packer = self.packer()
+        if isinstance(value, dict):
+            parts = [packer.pack_map_header(len(value))]
+            for key, item in value.items():
+                parts.append(packer.pack(key))
+                parts.append(self.pack_tree(item))
+            return b"".join(parts)
+        if isinstance(value, list):
+            parts = [packer.pack_array_header(len(value))]
+            parts.extend(self.pack_tree(item) for item in value)
+            return b"".join(parts)
+        return packer.pack(value)
+
+    @staticmethod
+    def unpack(value):
+        """Dados de uma operação: Packed (escrita local) volta à forma decodificada"""
+        if isinstance(value, Packed):
+            return msgpack.unpackb(value, raw=False)
+        return value
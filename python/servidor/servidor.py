@@ -1,56 +1,132 @@
 import zmq
 import msgpack
+import argparse
 import json
 import time
 import os
 import socket
+import sys
+import threading
+from collections import Counter, OrderedDict
+from itertools import islice
 from datetime import datetime
 from pathlib import Path
 
+# Módulos compartilhados entre os componentes (métricas, particionamento) ficam em python/comum
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'comum'))
+
+from persistencia import WriteAheadLog, write_snapshot, read_snapshot
+from historico import HistoryIndex, insert_ordered
+from segmentos import SegmentStore
+from registros import Publication, Message, as_publication, as_message, encode_record, order_key
+from despacho import RequestDispatcher
+from serializacao import RecordCodec
+from assincrono import AsyncRuntime
+from replicacao import ReplicationBatcher, ReplicationBacklog, SNAPSHOT_SECTIONS, pack_chunk, unpack_chunk
+from metricas import Metrics, Log, start_metrics_server
+from particionamento import ring_from_env, channel_key, mailbox_key
+from respostas import ResponseCache
+from retencao import RetentionPolicy, RETENTION_KINDS
+from idempotencia import RequestDedup
+
+# Primeiro frame das mensagens de controle para o broker (ver python/broker/balanceamento.py)
+CONTROL_FRAME = b"BBS_CTRL"
+
+# Tipos de mensagem do tópico de replicação (rótulos das métricas)
+REPLICATION_TYPES = ('frame', 'catchup', 'status', 'catchup_request', 'catchup_miss', 'snapshot_request', 'snapshot_chunk',
+                     'shard_request', 'handoff')
+
 class Servidor:
-    def __init__(self):
+    def __init__(self, context=None, name=None, data_dir=None, broker=None, proxy_pub=None, proxy_sub=None, reference=None,
+                 runtime=None):
         print("🚀 Iniciando Servidor...")
-        self.context = zmq.Context()
+        # Contexto compartilhado permite vários servidores no mesmo processo (endpoints inproc://)
+        self.context = context or zmq.Context()
         print("  ✓ Contexto ZMQ criado")
         
-        # Socket para Request-Reply (conecta ao broker)
-        self.req_socket = self.context.socket(zmq.REP)
-        self.req_socket.connect("tcp://broker:5556")
+        # Endpoints: os padrões são os nomes do docker-compose; fora do Docker vêm do ambiente ou da linha de comando
+        self.broker_endpoint = broker or os.getenv('BROKER_ENDPOINT', 'tcp://broker:5556')
+        self.proxy_pub_endpoint = proxy_pub or os.getenv('PROXY_PUB_ENDPOINT', 'tcp://proxy:5557')
+        self.proxy_sub_endpoint = proxy_sub or os.getenv('PROXY_SUB_ENDPOINT', 'tcp://proxy:5558')
+        # Vazio desliga o registro no servidor de referência (rank vem de SERVER_RANK)
+        self.reference_endpoint = reference if reference is not None else os.getenv('REFERENCE_ENDPOINT', 'tcp://referencia:5559')
+        self.reference_timeout = float(os.getenv('REFERENCE_TIMEOUT', '5'))
+        
+        # Laço principal: 'poll' (um zmq.Poller para todos os sockets) ou 'asyncio' (zmq.asyncio, uma tarefa
+        # por socket e por temporizador, disco em executor; assincrono.py)
+        self.runtime = runtime or os.getenv('SERVER_RUNTIME', 'poll')
+        if self.runtime not in ('poll', 'asyncio'):
+            raise ValueError(f"Runtime inválido: {self.runtime}")
+        
+        # Observabilidade: log com nível/limite de taxa e métricas expostas em METRICS_PORT
+        self.log = Log()
+        self.metrics = Metrics()
+        self.metrics_port = int(os.getenv('METRICS_PORT', '9100'))
+        
+        # Socket para Request-Reply (conecta ao broker); DEALER permite várias requisições em andamento
+        # e funciona tanto com o broker balanceado (ROUTER) quanto com o modo DEALER
+        self.req_socket = self.context.socket(zmq.DEALER)
+        self.req_socket.connect(self.broker_endpoint)
         
         # Socket para Publish (conecta ao proxy)
         self.pub_socket = self.context.socket(zmq.PUB)
-        self.pub_socket.connect("tcp://proxy:5557")
+        self.pub_socket.connect(self.proxy_pub_endpoint)
         
         # Socket para receber replicações de outros servidores
         self.replication_socket = self.context.socket(zmq.SUB)
-        self.replication_socket.connect("tcp://proxy:5558")
+        self.replication_socket.connect(self.proxy_sub_endpoint)
         self.replication_socket.setsockopt_string(zmq.SUBSCRIBE, "replication")
         
         # Socket para comunicação com servidor de referência
-        self.ref_socket = self.context.socket(zmq.REQ)
-        self.ref_socket.connect("tcp://referencia:5559")
+        self.ref_socket = self.connect_reference()
         
         # Socket para eleição entre servidores (receber)
         self.election_socket = self.context.socket(zmq.SUB)
-        self.election_socket.connect("tcp://proxy:5558")
+        self.election_socket.connect(self.proxy_sub_endpoint)
         self.election_socket.setsockopt_string(zmq.SUBSCRIBE, "servers")
         
         # Socket para enviar mensagens de eleição
         self.election_pub_socket = self.context.socket(zmq.PUB)
-        self.election_pub_socket.connect("tcp://proxy:5557")
+        self.election_pub_socket.connect(self.proxy_pub_endpoint)
         
         # Dados
         self.users = set()
+        self.user_list = []  # Ordem de cadastro, estável para a transferência em blocos
         self.channels = {}
         self.messages = []
         self.publications = []
         
-        # Relógios
+        # Índices secundários para consultas de histórico
+        self.channel_index = HistoryIndex()  # canal -> publicações
+        self.mailbox_index = HistoryIndex()  # usuário -> mensagens (enviadas e recebidas)
+        self.history_max_page = int(os.getenv('HISTORY_MAX_PAGE', '500'))
+        self.batch_max_items = int(os.getenv('BATCH_MAX_ITEMS', '500'))  # Itens por publish_batch/message_batch
+        
+        # Retenção por canal e por caixa de mensagens: padrões do ambiente (RETENTION_CHANNEL_*, RETENTION_MAILBOX_*)
+        # e políticas próprias de cada chave, definidas pelo serviço 'retention'
+        self.retention_defaults = {kind: RetentionPolicy.from_env(f"RETENTION_{kind.upper()}") for kind in RETENTION_KINDS}
+        self.retention_policies = {kind: {} for kind in RETENTION_KINDS}  # tipo -> chave -> RetentionPolicy
+        self.retention_interval = float(os.getenv('RETENTION_INTERVAL', '60'))  # Segundos entre passadas; 0 desliga
+        self.retention_dead = {kind: 0 for kind in RETENTION_KINDS}  # Estimativa de expirados ainda nas listas quentes
+        
+        # Escritas com 'request_id': uma repetição (timeout do cliente, retentativa do broker) recebe a resposta
+        # original; a tabela é replicada com atraso e vai no snapshot, então outro servidor só a conhece depois
+        self.request_dedup = RequestDedup.from_env()
+        
+        # Respostas serializadas de 'users', 'channels' e páginas de 'history_channel', invalidadas pelas escritas
+        self.response_cache = ResponseCache(
+            max_entries=int(os.getenv('RESPONSE_CACHE_ENTRIES', '1024')),
+            max_bytes=int(os.getenv('RESPONSE_CACHE_BYTES', str(16 * 1024 * 1024))),
+            default=encode_record
+        )
+        
+        # Relógios (acessados pelo loop principal e pelos workers)
+        self.clock_lock = threading.Lock()
         self.logical_clock = 0
         self.physical_time = time.time()
         
         # Sincronização
-        self.server_name = os.getenv('SERVER_NAME', socket.gethostname())
+        self.server_name = name or os.getenv('SERVER_NAME', socket.gethostname())
         self.rank = None
         self.coordinator = None
         self.servers = {}
@@ -60,28 +136,157 @@ class Servidor:
         self.election_in_progress = False
         self.election_responses = set()
         self.election_start_time = None
+        self.election_timeout = 15  # 15 segundos sem heartbeat = eleição
+        self.election_wait = 3  # Espera por respostas OK antes de se declarar coordenador
+        self.coordinator_heartbeat_interval = 5
+        self.last_coordinator_heartbeat = time.time()
+        
+        # Heartbeat para o broker balanceado (anuncia quantas requisições simultâneas aceita)
+        self.broker_heartbeat_interval = float(os.getenv('BROKER_HEARTBEAT_INTERVAL', '1'))
+        self.last_broker_heartbeat = 0
         
         # Berkeley - Sincronização de relógio físico
         self.clock_offset = 0  # Offset para ajustar relógio físico
-        self.last_sync_message_count = 0  # Contador para sincronizar a cada 10 mensagens
+        self.berkeley_interval = float(os.getenv('BERKELEY_INTERVAL', '30'))  # Segundos entre rodadas
+        self.berkeley_timeout = float(os.getenv('BERKELEY_TIMEOUT', '2'))  # Janela de coleta de respostas
+        self.berkeley_round = None  # Rodada em andamento (coordenador)
+        self.berkeley_round_id = 0
+        self.last_berkeley_sync = time.time()
         
         # Persistência
-        self.data_dir = Path('/app/data')
-        self.data_dir.mkdir(exist_ok=True)
-        
-        # Controle de replicação (evita loop infinito)
-        self.is_replicating = False
+        self.data_dir = Path(data_dir or os.getenv('DATA_DIR', '/app/data'))
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Cada registro é serializado uma vez (RECORD_SCHEMA=map|array) e os bytes vão para o log, a replicação e o pub/sub
+        self.codec = RecordCodec.from_env()
+        
+        # Histórico frio: registros além da janela quente são selados em segmentos mapeados em memória
+        self.history_hot_records = int(os.getenv('HISTORY_HOT_RECORDS', '100000'))
+        self.history_seal_records = int(os.getenv('HISTORY_SEAL_RECORDS', '10000'))
+        self.cold_publications = SegmentStore(
+            self.data_dir / 'cold' / 'publications', as_publication, Publication.index_keys, default=self.codec.default
+        )
+        self.cold_messages = SegmentStore(
+            self.data_dir / 'cold' / 'messages', as_message, Message.index_keys, default=self.codec.default
+        )
+        self.channel_index.cold = self.cold_publications
+        self.mailbox_index.cold = self.cold_messages
+        
+        # Log append-only + snapshot compactado periódico
+        self.wal = WriteAheadLog(
+            self.data_dir / 'wal',
+            fsync_policy=os.getenv('WAL_FSYNC', 'batch'),
+            batch_size=int(os.getenv('WAL_BATCH_SIZE', '64')),
+            fsync_interval=float(os.getenv('WAL_FSYNC_INTERVAL', '0.05')),
+            default=self.codec.default,
+            on_sync=self.observe_wal_sync
+        )
+        self.snapshot_path = self.data_dir / 'snapshot.json'
+        self.snapshot_lsn = 0
+        self.snapshot_size = 0
+        self.snapshot_thread = None
+        # Compacta quando o log passa de SNAPSHOT_LOG_RATIO x tamanho do snapshot (custo amortizado O(1))
+        self.snapshot_log_ratio = float(os.getenv('SNAPSHOT_LOG_RATIO', '1.0'))
+        self.snapshot_min_log_bytes = int(os.getenv('SNAPSHOT_MIN_LOG_BYTES', str(1024 * 1024)))
+        
+        # Replicação: maior sequência aplicada por servidor de origem (inclui a própria)
+        self.replication_applied = {}
+        self.replication_batcher = ReplicationBatcher(
+            self.send_replication_batch,
+            max_ops=int(os.getenv('REPLICATION_BATCH_SIZE', '64')),
+            window=float(os.getenv('REPLICATION_BATCH_WINDOW', '0.005')),
+            pack_op=self.codec.pack_op
+        )
+        
+        # Catch-up: operações recentes ficam disponíveis para réplicas que perderam frames
+        self.replication_backlog = ReplicationBacklog(int(os.getenv('REPLICATION_BACKLOG', '10000')))
+        self.replication_status_interval = float(os.getenv('REPLICATION_STATUS_INTERVAL', '5'))
+        self.catchup_timeout = float(os.getenv('CATCHUP_TIMEOUT', '3'))
+        self.last_replication_status = 0
+        self.catchup_inflight = {}  # origem -> {"peer", "wanted", "deadline"}
+        self.snapshot_request = None  # Transferência de snapshot em andamento (bloco esperado e dados recebidos)
+        
+        # Snapshot em blocos (serviço 'sync' com stream e catch-up a frio)
+        self.sync_chunk_records = int(os.getenv('SYNC_CHUNK_RECORDS', '500'))
+        self.sync_chunk_bytes = int(os.getenv('SYNC_CHUNK_BYTES', str(256 * 1024)))
+        # Histórico fixado no início de cada transferência em blocos: inserções atrasadas deslocam as listas quentes
+        self.sync_views = OrderedDict()  # ID -> seção -> (base fria, registros frios, cópia da parte quente)
+        self.sync_views_max = int(os.getenv('SYNC_VIEWS', '4'))  # Transferências simultâneas; a mais antiga sai
+        self.sync_views_lock = threading.Lock()  # Leitores ('sync') e o escritor (snapshot a um par) criam vistas
+        
+        # Particionamento (SHARD_NODES): histórico de canais e caixas de mensagens só nos servidores donos da chave;
+        # usuários e metadados de canais continuam em todos
+        self.ring = ring_from_env()
+        self.loaded_shard_nodes = None
+        self.shard_handoff_due = None  # Quando pedir aos pares as chaves que passaram a ser deste servidor
         
         self.load_data()
         self.register_server()
+        
+        if self.ring is not None:
+            print(f"  ✓ Particionamento: {len(self.ring.nodes)} servidores, {self.ring.replicas} réplica(s) por chave")
+            if self.loaded_shard_nodes != self.ring.nodes:
+                # Anel novo ou alterado: espera as inscrições no proxy antes de pedir as chaves
+                self.shard_handoff_due = time.time() + 1
+        
+        # Leituras rodam em paralelo no pool; escritas e replicação passam pelo escritor único
+        write_services = ('login', 'channel', 'publish', 'message', 'publish_batch', 'message_batch', 'retention')
+        handlers = {
+            'login': self.handle_login,
+            'users': self.handle_users,
+            'channel': self.handle_channel_create,
+            'channels': self.handle_channels,
+            'publish': self.handle_publish,
+            'message': self.handle_message,
+            'publish_batch': self.handle_publish_batch,
+            'message_batch': self.handle_message_batch,
+            'history_messages': self.handle_history_messages,
+            'history_channel': self.handle_history_channel,
+            'sync': self.handle_sync_request,
+            'retention': self.handle_retention
+        }
+        for service in write_services:
+            handlers[service] = self.deduplicated(service, handlers[service])
+        
+        self.dispatcher = RequestDispatcher(
+            self.context,
+            handlers,
+            write_services=write_services,
+            workers=int(os.getenv('REQUEST_WORKERS', '4')),
+            writer_tick=self.replication_tick,
+            tick_interval=max(0.001, self.replication_batcher.window),
+            encode_default=encode_record,
+            metrics=self.metrics,
+            log=self.log,
+            # WAL_FSYNC=group: respostas de escrita só depois do fsync do lote
+            commit=self.wal.sync if self.wal.fsync_policy == 'group' else None,
+            commit_batch=int(os.getenv('GROUP_COMMIT_MAX_BATCH', '64')),
+            commit_wait=float(os.getenv('GROUP_COMMIT_MAX_WAIT', '0'))
+        )
+        self.register_metrics()
     
     def increment_clock(self):
-        self.logical_clock += 1
-        return self.logical_clock
+        with self.clock_lock:
+            self.logical_clock += 1
+            return self.logical_clock
     
     def update_clock(self, received_clock):
-        self.logical_clock = max(self.logical_clock, received_clock) + 1
-        return self.logical_clock
+        with self.clock_lock:
+            self.logical_clock = max(self.logical_clock, received_clock) + 1
+            return self.logical_clock
+    
+    def restore_clock(self, *clocks):
+        """Avança o relógio lógico além de todo o estado carregado: escritas novas vêm depois do histórico"""
+        highest = max(
+            self.publications[-1].clock if self.publications else 0,
+            self.messages[-1].clock if self.messages else 0,
+            max(self.cold_publications.clocks, default=0),
+            max(self.cold_messages.clocks, default=0),
+            max((channel.get('clock') or 0 for channel in self.channels.values()), default=0),
+            *clocks
+        )
+        with self.clock_lock:
+            self.logical_clock = max(self.logical_clock, highest)
     
     def get_physical_time(self):
         """Retorna tempo físico ajustado pelo offset do Berkeley"""
@@ -92,12 +297,26 @@ class Servidor:
         self.clock_offset += offset
         print(f"⏰ Relógio ajustado: offset={offset:.3f}s, offset_total={self.clock_offset:.3f}s")
     
+    def connect_reference(self):
+        """Socket REQ para o servidor de referência (None quando desligado)"""
+        if not self.reference_endpoint:
+            return None
+        sock = self.context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.reference_endpoint)
+        return sock
+    
     def register_server(self):
         """Registra servidor e obtém rank"""
+        if self.ref_socket is None:
+            self.rank = int(os.getenv('SERVER_RANK', '999'))
+            print(f"⚠️  Sem servidor de referência, usando rank {self.rank}")
+            return
+        
         print(f"🔄 Tentando registrar servidor {self.server_name}...")
         
         # Configurar timeout para não travar
-        self.ref_socket.setsockopt(zmq.RCVTIMEO, 5000)  # 5 segundos
+        self.ref_socket.setsockopt(zmq.RCVTIMEO, int(self.reference_timeout * 1000))
         
         msg = {
             "service": "rank",
@@ -118,6 +337,9 @@ class Servidor:
         except zmq.Again:
             print(f"⚠️  Timeout ao registrar servidor, usando rank padrão 999")
             self.rank = 999
+            # REQ sem resposta fica preso no estado de espera; recria para o próximo 'list'
+            self.ref_socket.close()
+            self.ref_socket = self.connect_reference()
         except Exception as e:
             print(f"❌ Erro ao registrar servidor: {e}")
             self.rank = 999
@@ -127,6 +349,9 @@ class Servidor:
     
     def get_servers_list(self):
         """Obtém lista de servidores"""
+        if self.ref_socket is None:
+            return self.servers
+        
         msg = {
             "service": "list",
             "data": {
@@ -151,115 +376,1036 @@ class Servidor:
         return self.servers
     
     def load_data(self):
-        """Carrega dados do disco"""
+        """Carrega o snapshot compactado e reaplica a cauda do log.
+        
+        Só a ausência de arquivos (primeira partida) é esperada; qualquer outro erro interrompe a inicialização,
+        porque continuar com o estado parcial faria o próximo snapshot sobrescrever os dados bons no disco.
+        """
         try:
-            users_file = self.data_dir / 'users.json'
-            if users_file.exists():
-                with open(users_file, 'r') as f:
-                    data = json.load(f)
-                    self.users = set(data.get('users', []))
-            
-            channels_file = self.data_dir / 'channels.json'
-            if channels_file.exists():
-                with open(channels_file, 'r') as f:
-                    self.channels = json.load(f)
-            
-            messages_file = self.data_dir / 'messages.json'
-            if messages_file.exists():
-                with open(messages_file, 'r') as f:
-                    self.messages = json.load(f)
-            
-            publications_file = self.data_dir / 'publications.json'
-            if publications_file.exists():
-                with open(publications_file, 'r') as f:
-                    self.publications = json.load(f)
+            snapshot = read_snapshot(self.snapshot_path)
+            legacy_loaded = False
+            clocks = [0]  # Relógios guardados fora dos registros (snapshot, marcas de sequência do log)
+            
+            if snapshot is not None:
+                self.users = set(snapshot.get('users', []))
+                self.channels = snapshot.get('channels', {})
+                self.messages = snapshot.get('messages', [])
+                self.publications = snapshot.get('publications', [])
+                self.replication_applied = snapshot.get('replication', {})
+                clocks.append(snapshot.get('clock', 0))
+                self.loaded_shard_nodes = snapshot.get('shard_nodes')
+                self.load_retention(snapshot.get('retention'))
+                self.request_dedup.load(snapshot.get('requests'))
+                cold = snapshot.get('cold', {})
+                self.cold_publications.open(cold.get('publications', 0))
+                self.cold_messages.open(cold.get('messages', 0))
+                self.snapshot_lsn = snapshot.get('lsn', 0)
+                self.snapshot_size = self.snapshot_path.stat().st_size
+                # Operações anteriores ao snapshot não podem mais ser servidas para catch-up
+                for source, seq in self.replication_applied.items():
+                    self.replication_backlog.reset(source, seq)
+            else:
+                self.cold_publications.open(0)
+                self.cold_messages.open(0)
+                legacy_loaded = self.load_legacy_data()
+            
+            self.rebuild_indexes()
+            
+            replayed = 0
+            for lsn, operation, data, origin in self.wal.replay(self.snapshot_lsn):
+                # Cada (origem, sequência) é aplicada uma vez, mesmo que o log a tenha gravado de novo
+                if origin is not None and origin[1] <= self.replication_applied.get(origin[0], 0):
+                    continue
+                if operation == 'applied':
+                    # As operações alheias até aqui não estão no log: o backlog da origem não pode servi-las
+                    self.mark_applied(*origin)
+                    self.replication_backlog.reset(*origin)
+                    clocks.append((data or {}).get('clock', 0))
+                    continue
+                self.apply_operation(operation, data)
+                if origin is not None:
+                    self.mark_applied(*origin)
+                    self.replication_backlog.add(origin[0], origin[1], operation, data)
+                replayed += 1
+            
+            self.restore_clock(*clocks)
+            print(f"  ✓ Dados carregados (snapshot lsn={self.snapshot_lsn}, {replayed} operações do log, relógio {self.logical_clock})")
+            
+            # Migra os arquivos JSON antigos para o formato snapshot + log; o histórico antigo vai para segmentos
+            if self.seal_cold_history() or legacy_loaded:
+                self.save_snapshot(background=False)
                     
         except Exception as e:
-            print(f"Erro ao carregar dados: {e}")
+            print(f"❌ Erro ao carregar dados de {self.data_dir}: {e}")
+            raise
+    
+    def load_legacy_data(self):
+        """Carrega os arquivos JSON do formato antigo (um arquivo por coleção)"""
+        loaded = False
+        
+        users_file = self.data_dir / 'users.json'
+        if users_file.exists():
+            with open(users_file, 'r') as f:
+                data = json.load(f)
+                self.users = set(data.get('users', []))
+            loaded = True
+        
+        channels_file = self.data_dir / 'channels.json'
+        if channels_file.exists():
+            with open(channels_file, 'r') as f:
+                self.channels = json.load(f)
+            loaded = True
+        
+        messages_file = self.data_dir / 'messages.json'
+        if messages_file.exists():
+            with open(messages_file, 'r') as f:
+                self.messages = json.load(f)
+            loaded = True
+        
+        publications_file = self.data_dir / 'publications.json'
+        if publications_file.exists():
+            with open(publications_file, 'r') as f:
+                self.publications = json.load(f)
+            loaded = True
+        
+        return loaded
+    
+    def rebuild_indexes(self):
+        """Converte os registros carregados para a forma compacta e reconstrói os índices de histórico"""
+        # Registros abaixo dos pisos de retenção ficam de fora
+        self.messages = [message for message in map(as_message, self.messages) if self.mailbox_index.live(message)]
+        self.publications = [publication for publication in map(as_publication, self.publications)
+                             if self.channel_index.live(publication)]
+        # Snapshots e pares antigos guardavam a ordem de chegada; já ordenado, o sort é linear
+        self.messages.sort(key=order_key)
+        self.publications.sort(key=order_key)
+        self.retention_dead = {kind: 0 for kind in RETENTION_KINDS}
+        
+        self.channel_index.clear()
+        self.mailbox_index.clear()
+        self.user_list = list(self.users)
+        self.response_cache.clear()
+        
+        for publication in self.publications:
+            self.index_publication(publication)
+        
+        for message in self.messages:
+            self.index_message(message)
     
-    def save_data(self):
-        """Salva dados no disco"""
+    def index_publication(self, publication):
+        self.channel_index.add(publication.channel, publication)
+    
+    def index_message(self, message):
+        for user in message.index_keys():
+            self.mailbox_index.add(user, message)
+    
+    def add_user(self, user):
+        """Registra o usuário preservando a ordem de cadastro"""
+        if user not in self.users:
+            self.users.add(user)
+            self.user_list.append(user)
+            self.response_cache.invalidate('users')
+    
+    def store_publication(self, publication):
+        """Armazena a publicação e atualiza o índice por canal"""
+        if not self.channel_index.live(publication):
+            return  # Já cortada pela retenção (ex.: replicação ou handoff atrasados)
+        if insert_ordered(self.publications, publication):
+            self.metrics.inc('bbs_server_history_late_inserts_total', kind='publications')
+        self.response_cache.invalidate(('channel', publication.channel))
+        self.index_publication(publication)
+    
+    def store_message(self, message):
+        """Armazena a mensagem e atualiza o índice por usuário"""
+        if not self.mailbox_index.live(message):
+            return
+        if insert_ordered(self.messages, message):
+            self.metrics.inc('bbs_server_history_late_inserts_total', kind='messages')
+        self.index_message(message)
+    
+    def log_operation(self, operation, data, origin=None):
+        """Registra a operação no log append-only (custo O(1) por escrita)"""
+        self.log_operations([(operation, data, origin)])
+    
+    def log_operations(self, operations):
+        """Registra [(operação, dados, origem)] no log com uma única escrita"""
         try:
-            with open(self.data_dir / 'users.json', 'w') as f:
-                json.dump({'users': list(self.users)}, f, indent=2)
-            
-            with open(self.data_dir / 'channels.json', 'w') as f:
-                json.dump(self.channels, f, indent=2)
+            with self.metrics.timer('bbs_server_wal_append_seconds'):
+                self.wal.append_batch(operations)
+            self.metrics.inc('bbs_server_wal_records_total', len(operations))
+        except Exception as e:
+            self.log.error(f"Erro ao salvar dados: {e}", key='wal')
+        
+        self.maybe_seal()
+        self.maybe_snapshot()
+    
+    def mark_applied(self, source, seq):
+        """Avança a maior sequência aplicada do servidor de origem"""
+        if seq > self.replication_applied.get(source, 0):
+            self.replication_applied[source] = seq
+    
+    def commit_operation(self, operation, data):
+        """Persiste uma escrita local e a enfileira no próximo frame de replicação; retorna os dados gravados"""
+        return self.commit_operations(operation, [data])[0]
+    
+    def commit_operations(self, operation, records):
+        """Persiste escritas locais com uma única escrita no log e as replica no mesmo frame.
+        
+        Registros são serializados aqui uma única vez; os mesmos bytes (Packed) vão para o log, o backlog
+        de catch-up e o frame, e são devolvidos para o pub/sub.
+        """
+        records = [self.codec.pack(record) if isinstance(record, (Publication, Message)) else record
+                   for record in records]
+        first_seq = self.replication_applied.get(self.server_name, 0) + 1
+        entries = [(first_seq + offset, operation, record) for offset, record in enumerate(records)]
+        self.replication_applied[self.server_name] = first_seq + len(records) - 1
+        
+        self.log_operations([(operation, record, (self.server_name, seq)) for seq, operation, record in entries])
+        for seq, operation, record in entries:
+            self.replication_backlog.add(self.server_name, seq, operation, record)
+        self.replication_batcher.add_batch(entries)
+        return records
+    
+    def seal_history(self, records, store, index):
+        """Sela os registros quentes mais antigos em um segmento e os retira da memória"""
+        batch = records[:self.history_seal_records]
+        store.seal(batch)
+        
+        # Registros expirados ainda não compactados vão junto, mas já não estão no índice das chaves cortadas
+        sealed_per_key = Counter(key for record in batch for key in record.index_keys() if index.retained(key, record))
+        for key, count in sealed_per_key.items():
+            index.discard_sealed(key, count)
+        
+        del records[:len(batch)]
+    
+    def seal_cold_history(self):
+        """Sela lotes até a parte quente voltar à janela configurada; retorna se algo foi selado"""
+        sealed = False
+        limit = self.history_hot_records + self.history_seal_records
+        started = time.perf_counter()
+        
+        while len(self.publications) >= limit:
+            self.seal_history(self.publications, self.cold_publications, self.channel_index)
+            sealed = True
+        
+        while len(self.messages) >= limit:
+            self.seal_history(self.messages, self.cold_messages, self.mailbox_index)
+            sealed = True
+        
+        if sealed:
+            self.metrics.observe('bbs_server_seal_seconds', time.perf_counter() - started)
+            print(f"🧊 Histórico frio: {self.cold_publications.count} publicações, {self.cold_messages.count} mensagens")
+        return sealed
+    
+    def maybe_seal(self):
+        """Sela o histórico antigo e grava um snapshot que já não o contém"""
+        try:
+            if not self.seal_cold_history():
+                return
+        except Exception as e:
+            print(f"Erro ao selar histórico: {e}")
+            return
+        
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            self.snapshot_thread.join()
+        self.save_snapshot()
+    
+    def retention_index(self, kind):
+        return self.channel_index if kind == 'channel' else self.mailbox_index
+    
+    def retention_policy(self, kind, key):
+        return self.retention_policies[kind].get(key, self.retention_defaults[kind])
+    
+    def set_retention_policy(self, kind, key, policy):
+        """Define a política própria da chave; None volta ao padrão do ambiente"""
+        if policy is None:
+            self.retention_policies[kind].pop(key, None)
+        else:
+            self.retention_policies[kind][key] = RetentionPolicy.from_dict(policy)
+    
+    def decides_retention(self, kind, key):
+        """Um único servidor decide o corte de cada chave: o primeiro dono no anel ou, sem particionamento, o coordenador"""
+        if self.ring is None:
+            return self.coordinator == self.server_name
+        ring_key = channel_key(key) if kind == 'channel' else mailbox_key(key)
+        return self.ring.owners(ring_key)[0] == self.server_name
+    
+    def retention_watermark(self, kind, key, policy):
+        """Relógio de corte da política para a chave, sobre os registros frios e quentes ainda retidos"""
+        index = self.retention_index(kind)
+        cold = index.cold
+        entries = [(cold.clock(position), position, None) for position in cold.key_positions(key)
+                   if not index.expired(key, cold.clock(position))]
+        entries += [(record.clock, None, record) for record in index.entries.get(key, ())]
+        entries.sort(key=lambda entry: entry[0])
+        
+        def timestamp_of(i):
+            _, position, record = entries[i]
+            return (record if record is not None else cold.get(position)).timestamp
+        
+        def size_of(i):
+            _, position, record = entries[i]
+            if record is None:
+                return cold.size(position)
+            return len(self.codec.pack(record))
+        
+        return policy.watermark([entry[0] for entry in entries], self.logical_clock, self.get_physical_time(),
+                                timestamp_of, size_of)
+    
+    def apply_retention(self, kind, key, clock):
+        """Sobe o piso da chave; o corte é por relógio, então réplicas que o aplicam concordam no que saiu"""
+        index = self.retention_index(kind)
+        if index.expired(key, clock):
+            return False
+        removed = index.set_floor(key, clock)
+        self.retention_dead[kind] += removed
+        if kind == 'channel':
+            self.response_cache.invalidate(('channel', key))
+        self.metrics.inc('bbs_server_retention_floors_total', kind=kind)
+        self.metrics.inc('bbs_server_retention_expired_total', removed, kind=kind)
+        return True
+    
+    def retain(self, kind, key, clock):
+        """Executado pelo escritor: aplica o corte decidido aqui e o replica como operação do log"""
+        if self.apply_retention(kind, key, clock):
+            self.commit_operation('retention', {"kind": kind, "key": key, "clock": clock})
+    
+    def compact_history(self, force=False):
+        """Executado pelo escritor: tira da memória e dos segmentos frios os registros expirados"""
+        started = time.perf_counter()
+        shifted = False
+        
+        stores = (
+            ('channel', self.publications, self.channel_index, self.cold_publications),
+            ('mailbox', self.messages, self.mailbox_index, self.cold_messages)
+        )
+        for kind, records, index, cold in stores:
+            dead = self.retention_dead[kind]
+            # Reescrever a lista custa O(n): só compensa com uma fração relevante de expirados
+            if dead and (force or dead * 8 >= len(records)):
+                kept = [record for record in records if index.live(record)]
+                self.metrics.inc('bbs_server_retention_dropped_total', len(records) - len(kept), kind=kind, tier='hot')
+                shifted = shifted or len(kept) != len(records)
+                records[:] = kept
+                self.retention_dead[kind] = 0
             
-            with open(self.data_dir / 'messages.json', 'w') as f:
-                json.dump(self.messages, f, indent=2)
+            if cold.segments and index.floors:
+                # Os pisos vão para o disco antes de os segmentos sumirem
+                self.wal.sync()
+                dropped = cold.drop_head(index.expired)
+                if dropped:
+                    self.metrics.inc('bbs_server_retention_dropped_total', dropped, kind=kind, tier='cold')
+                    shifted = True
+        
+        if shifted:
+            self.metrics.observe('bbs_server_retention_compaction_seconds', time.perf_counter() - started)
+    
+    def retention_pass(self):
+        """Calcula os cortes fora do escritor, com o lock de leitura, e envia a ele só as decisões"""
+        for kind in RETENTION_KINDS:
+            if not self.retention_defaults[kind].active and not self.retention_policies[kind]:
+                continue
+            index = self.retention_index(kind)
+            with self.dispatcher.lock.read():
+                keys = set(index.entries) | set(index.cold.positions)
             
-            with open(self.data_dir / 'publications.json', 'w') as f:
-                json.dump(self.publications, f, indent=2)
-                
-        except Exception as e:
-            print(f"Erro ao salvar dados: {e}")
+            for key in keys:
+                policy = self.retention_policy(kind, key)
+                if not policy.active or not self.decides_retention(kind, key):
+                    continue
+                # Lock por chave: escritas não esperam a passada inteira
+                with self.dispatcher.lock.read():
+                    clock = self.retention_watermark(kind, key, policy)
+                if clock is not None and not index.expired(key, clock):
+                    self.dispatcher.submit_write(lambda kind=kind, key=key, clock=clock: self.retain(kind, key, clock))
+        
+        self.dispatcher.submit_write(self.compact_history)
+    
+    def retention_loop(self):
+        while True:
+            time.sleep(self.retention_interval)
+            try:
+                self.retention_pass()
+            except Exception as e:
+                self.log.error(f"Erro na retenção: {e}", key='retencao')
+    
+    def retention_state(self):
+        """Pisos e políticas próprias, para o snapshot e para a transferência a outro servidor"""
+        return {
+            "floors": {kind: dict(self.retention_index(kind).floors) for kind in RETENTION_KINDS},
+            "policies": {
+                kind: {key: policy.to_dict() for key, policy in self.retention_policies[kind].items()}
+                for kind in RETENTION_KINDS
+            }
+        }
+    
+    def load_retention(self, state):
+        """Incorpora pisos (vale o maior) e políticas de um snapshot local ou de um par"""
+        if not state:
+            return
+        for kind in RETENTION_KINDS:
+            index = self.retention_index(kind)
+            for key, clock in state.get('floors', {}).get(kind, {}).items():
+                if not index.expired(key, clock):
+                    index.floors[key] = clock
+            for key, policy in state.get('policies', {}).get(kind, {}).items():
+                self.set_retention_policy(kind, key, policy)
     
-    def replicate_data(self, operation, data):
-        """Replica dados para outros servidores"""
-        if self.is_replicating:
+    def maybe_snapshot(self):
+        """Dispara a compactação quando o log cresce demais em relação ao snapshot"""
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
             return
         
-        replication_msg = {
-            "operation": operation,
-            "data": data,
-            "source": self.server_name,
-            "clock": self.increment_clock(),
-            "timestamp": time.time()
+        threshold = max(self.snapshot_min_log_bytes, self.snapshot_size * self.snapshot_log_ratio)
+        if self.wal.bytes_written >= threshold:
+            self.save_snapshot()
+    
+    def save_snapshot(self, background=True):
+        """Gera um snapshot compactado; o log anterior a ele é descartado"""
+        lsn = self.wal.rotate()
+        
+        # Cópias rasas: os registros não são alterados depois de inseridos
+        state = {
+            "lsn": lsn,
+            "users": list(self.users),
+            "channels": dict(self.channels),
+            "messages": list(self.messages),
+            "publications": list(self.publications),
+            "replication": dict(self.replication_applied),
+            "clock": self.logical_clock,
+            "shard_nodes": self.ring.nodes if self.ring is not None else None,
+            "retention": self.retention_state(),
+            "requests": self.request_dedup.state(),
+            "cold": {
+                "publications": self.cold_publications.count,
+                "messages": self.cold_messages.count
+            }
         }
         
+        if background:
+            self.snapshot_thread = threading.Thread(target=self.write_snapshot, args=(state,), daemon=True)
+            self.snapshot_thread.start()
+        else:
+            self.write_snapshot(state)
+    
+    def write_snapshot(self, state):
+        """Grava o snapshot em disco e remove os segmentos do log já cobertos"""
+        try:
+            started = time.time()
+            self.snapshot_size = write_snapshot(self.snapshot_path, state, default=encode_record)
+            self.snapshot_lsn = state['lsn']
+            self.wal.discard_through(state['lsn'])
+            self.metrics.observe('bbs_server_snapshot_seconds', time.time() - started)
+            self.metrics.set('bbs_server_snapshot_bytes', self.snapshot_size)
+            print(f"💾 Snapshot gravado (lsn={state['lsn']}, {self.snapshot_size} bytes, {time.time() - started:.2f}s)")
+        except Exception as e:
+            print(f"Erro ao gravar snapshot: {e}")
+    
+    def publish_replication(self, replication_msg):
+        """Publica uma mensagem no tópico de replicação (executado pelo escritor)"""
+        replication_msg["sender"] = self.server_name
+        replication_msg["clock"] = self.increment_clock()
+        replication_msg["timestamp"] = time.time()
+        
         try:
             self.pub_socket.send_multipart([
                 b"replication",
-                msgpack.packb(replication_msg)
+                self.codec.pack_tree(replication_msg)
             ])
+            self.metrics.inc('bbs_server_replication_sent_total', type=replication_msg.get('type', 'frame'))
         except Exception as e:
-            print(f"Erro ao replicar dados: {e}")
+            self.log.error(f"Erro ao replicar dados: {e}", key='replicacao_envio')
+    
+    def send_replication_batch(self, ops, first_seq, last_seq):
+        """Publica um frame com as operações locais de sequência first_seq..last_seq"""
+        self.metrics.inc('bbs_server_replication_ops_sent_total', len(ops))
+        self.publish_replication({
+            "type": "frame",
+            "source": self.server_name,
+            "first_seq": first_seq,
+            "last_seq": last_seq,
+            "ops": ops
+        })
+    
+    def apply_operation(self, operation, data):
+        """Aplica uma operação replicada ou lida do log aos dados em memória.
+        
+        Retorna False para publicações e mensagens de chaves de outros servidores, que não ficam aqui.
+        """
+        data = self.codec.unpack(data)  # Escritas locais reaplicadas do backlog chegam serializadas
+        if operation == 'login':
+            self.add_user(data['user'])
+        elif operation == 'channel_create':
+            if data['channel'] not in self.channels:
+                self.channels[data['channel']] = {
+                    'creator': data['creator'],
+                    'subscribers': [],
+                    'timestamp': data.get('timestamp', time.time()),
+                    'clock': data.get('clock', self.logical_clock)
+                }
+                self.response_cache.invalidate('channels')
+        elif operation == 'publish':
+            publication = as_publication(data)
+            if not self.owns_publication(publication):
+                return False
+            self.store_publication(publication)
+        elif operation == 'message':
+            message = as_message(data)
+            if not self.owns_message(message):
+                return False
+            self.store_message(message)
+        elif operation == 'retention':
+            # Vale em todos os servidores, donos ou não: o piso também filtra registros que chegarem depois
+            self.apply_retention(data['kind'], data['key'], data['clock'])
+        elif operation == 'retention_policy':
+            self.set_retention_policy(data['kind'], data['key'], data.get('policy'))
+        elif operation == 'request':
+            self.request_dedup.put(data['service'], data['id'], data['response'], data['timestamp'])
+        return True
+    
+    def owns_publication(self, publication, node=None):
+        """Sem particionamento todo servidor guarda tudo"""
+        if self.ring is None:
+            return True
+        return (node or self.server_name) in self.ring.owners(channel_key(publication.channel))
+    
+    def owns_message(self, message, node=None):
+        """A mensagem fica com os donos das caixas do remetente e do destinatário"""
+        if self.ring is None:
+            return True
+        node = node or self.server_name
+        return any(node in self.ring.owners(mailbox_key(user)) for user in message.index_keys())
     
-    def handle_replication(self, msg):
-        """Processa replicação recebida de outros servidores"""
-        if msg.get('source') == self.server_name:
+    def handle_replication_message(self, msg):
+        """Distribui as mensagens do tópico de replicação (executado pelo escritor)"""
+        sender = msg.get('sender', msg.get('source'))
+        if sender == self.server_name or msg.get('to', self.server_name) != self.server_name:
             return
         
-        self.is_replicating = True
+        msg_type = msg.get('type', 'frame')
+        label = msg_type if msg_type in REPLICATION_TYPES else 'desconhecido'
+        self.metrics.inc('bbs_server_replication_received_total', type=label)
+        started = time.perf_counter()
         
         try:
-            operation = msg['operation']
-            data = msg['data']
-            
-            self.update_clock(msg['clock'])
-            
-            if operation == 'login':
-                self.users.add(data['user'])
-            elif operation == 'channel_create':
-                if data['channel'] not in self.channels:
-                    self.channels[data['channel']] = {
-                        'creator': data['creator'],
-                        'subscribers': [],
-                        'timestamp': data.get('timestamp', time.time()),
-                        'clock': data.get('clock', self.logical_clock)
-                    }
-            elif operation == 'publish':
-                self.publications.append(data)
-            elif operation == 'message':
-                self.messages.append(data)
+            if msg_type in ('frame', 'catchup'):
+                self.handle_replication(msg, sender)
+            elif msg_type == 'status':
+                self.handle_replication_status(msg, sender)
+            elif msg_type == 'catchup_request':
+                self.serve_catchup(msg, sender)
+            elif msg_type == 'catchup_miss':
+                # O par não tem mais o intervalo: só um snapshot resolve
+                self.catchup_inflight.pop(msg['source'], None)
+                self.request_snapshot(sender)
+            elif msg_type == 'snapshot_request':
+                self.serve_snapshot(msg, sender)
+            elif msg_type == 'snapshot_chunk':
+                self.handle_snapshot_chunk(msg, sender)
+            elif msg_type == 'shard_request':
+                self.serve_shard_handoff(msg, sender)
+            elif msg_type == 'handoff':
+                self.handle_handoff(msg, sender)
+        except Exception as e:
+            self.log.error(f"Erro ao processar replicação: {e}", key='replicacao')
+        
+        self.metrics.observe('bbs_server_replication_apply_seconds', time.perf_counter() - started, type=label)
+    
+    def handle_replication(self, msg, sender):
+        """Aplica um frame de replicação recebido com um único passo de persistência"""
+        source = msg['source']
+        if source == self.server_name:
+            return
+        
+        self.update_clock(msg['clock'])
+        
+        applied = self.replication_applied.get(source, 0)
+        
+        if msg['first_seq'] > applied + 1:
+            # Lacuna: descarta o frame e pede o intervalo completo a quem o enviou
+            self.request_catchup(source, sender, msg['last_seq'])
+            return
+        
+        records = []
+        for op in msg['ops']:
+            # Frames repetidos ou sobrepostos não reaplicam operações
+            if op['seq'] <= applied:
+                continue
+            # O backlog (em memória) guarda tudo: um par pode pedir daqui o catch-up das chaves dele
+            self.replication_backlog.add(source, op['seq'], op['operation'], op['data'])
+            # Com particionamento, registros de chaves alheias não vão para o log deste servidor
+            if self.apply_operation(op['operation'], op['data']):
+                records.append((op['operation'], op['data'], (source, op['seq'])))
+        
+        last_seq = msg['last_seq']
+        if last_seq > applied and (not records or records[-1][2][1] < last_seq):
+            # Marca só de sequência: ao reaplicar o log, a origem avança até last_seq sem as operações alheias
+            records.append(('applied', {"clock": msg['clock']}, (source, last_seq)))
+        
+        self.mark_applied(source, last_seq)
+        self.log_operations(records)
+        
+        inflight = self.catchup_inflight.get(source)
+        if inflight is not None and self.replication_applied[source] >= inflight['wanted']:
+            del self.catchup_inflight[source]
+            self.log.info(f"🔁 Catch-up de {source} concluído (seq {self.replication_applied[source]})")
+    
+    def is_empty(self):
+        return not (self.users or self.channels or self.messages or self.publications or self.replication_applied
+                    or self.cold_messages.count or self.cold_publications.count)
+    
+    def replication_tick(self):
+        """Chamado pelo escritor: envia frames pendentes, anuncia o estado e refaz pedidos expirados"""
+        self.replication_batcher.tick()
+        now = time.time()
+        
+        if now - self.last_replication_status >= self.replication_status_interval:
+            self.last_replication_status = now
+            self.publish_replication({
+                "type": "status",
+                "applied": dict(self.replication_applied)
+            })
+        
+        if self.snapshot_request is not None and now >= self.snapshot_request['deadline']:
+            self.snapshot_request['retries'] += 1
+            if self.snapshot_request['retries'] > 3:
+                print(f"⚠️  Snapshot de {self.snapshot_request['peer']} abandonado")
+                self.snapshot_request = None  # O próximo status de um par dispara um novo pedido
+            else:
+                self.send_snapshot_request()  # Retoma a partir do último bloco recebido
+        
+        for source, inflight in list(self.catchup_inflight.items()):
+            if now >= inflight['deadline']:
+                del self.catchup_inflight[source]
+                self.request_catchup(source, inflight['peer'], inflight['wanted'])
+        
+        if self.shard_handoff_due is not None and now >= self.shard_handoff_due and self.snapshot_request is None:
+            self.shard_handoff_due = None
+            self.request_shard_handoff()
+    
+    def handle_replication_status(self, msg, sender):
+        """Compara o estado anunciado por um par com o local e pede o que falta"""
+        announced = msg.get('applied', {})
+        
+        if self.is_empty():
+            # Partida a frio: um snapshot é mais barato que reaplicar todo o histórico
+            if any(seq > 0 for seq in announced.values()):
+                self.request_snapshot(sender)
+            return
+        
+        for source, seq in announced.items():
+            if source != self.server_name and seq > self.replication_applied.get(source, 0):
+                self.request_catchup(source, sender, seq)
+    
+    def request_catchup(self, source, peer, wanted):
+        """Pede ao par as operações da origem entre a última aplicada e wanted"""
+        if self.snapshot_request is not None:
+            return  # O snapshot em andamento já cobre o intervalo
+        
+        inflight = self.catchup_inflight.get(source)
+        if inflight is not None:
+            inflight['wanted'] = max(inflight['wanted'], wanted)
+            return
+        
+        first_seq = self.replication_applied.get(source, 0) + 1
+        if wanted < first_seq:
+            return
+        
+        self.catchup_inflight[source] = {
+            "peer": peer,
+            "wanted": wanted,
+            "deadline": time.time() + self.catchup_timeout
+        }
+        
+        self.metrics.inc('bbs_server_catchup_requests_total')
+        self.log.info(f"🔁 Pedindo catch-up de {source} ({first_seq}..{wanted}) a {peer}", key='catchup')
+        self.publish_replication({
+            "type": "catchup_request",
+            "to": peer,
+            "source": source,
+            "first_seq": first_seq,
+            "last_seq": wanted
+        })
+    
+    def serve_catchup(self, msg, requester):
+        """Responde um pedido de catch-up com frames do backlog, ou avisa que é preciso snapshot"""
+        source = msg['source']
+        first_seq = msg['first_seq']
+        last_seq = min(msg['last_seq'], self.replication_applied.get(source, 0))
+        if last_seq < first_seq:
+            return
+        
+        ops = self.replication_backlog.range(source, first_seq, last_seq)
+        if ops is None:
+            self.publish_replication({"type": "catchup_miss", "to": requester, "source": source})
+            return
+        
+        # Frames do mesmo tamanho dos de replicação, com intervalos contíguos
+        chunk_size = self.replication_batcher.max_ops
+        for start in range(0, max(len(ops), 1), chunk_size):
+            chunk = ops[start:start + chunk_size]
+            is_last = start + chunk_size >= len(ops)
+            self.publish_replication({
+                "type": "catchup",
+                "to": requester,
+                "source": source,
+                "first_seq": first_seq,
+                "last_seq": last_seq if is_last else chunk[-1][0],
+                "ops": [self.codec.pack_op(seq, operation, data) for seq, operation, data in chunk]
+            })
+            if not is_last:
+                first_seq = chunk[-1][0] + 1
+    
+    def snapshot_limits(self):
+        """Fixa o histórico no início da transferência: registros gravados depois vêm pelo catch-up.
+        
+        Os segmentos frios só crescem no fim, então basta o intervalo de posições; a parte quente é copiada
+        (só as referências), porque um registro atrasado entra no meio dela e a compactação a reescreve.
+        """
+        view = {
+            "messages": (self.cold_messages.base, self.cold_messages.stored, list(self.messages)),
+            "publications": (self.cold_publications.base, self.cold_publications.stored, list(self.publications))
+        }
+        view_id = os.urandom(8).hex()
+        with self.sync_views_lock:
+            self.sync_views[view_id] = view
+            while len(self.sync_views) > self.sync_views_max:
+                self.sync_views.popitem(last=False)
+        
+        return {
+            "messages": view['messages'][1] + len(view['messages'][2]),
+            "publications": view['publications'][1] + len(view['publications'][2]),
+            "view": view_id
+        }
+    
+    def sync_view(self, limits):
+        with self.sync_views_lock:
+            return self.sync_views.get(limits.get('view'))
+    
+    def release_sync_view(self, limits):
+        with self.sync_views_lock:
+            self.sync_views.pop(limits.get('view'), None)
+    
+    def snapshot_shifted(self, limits):
+        """A vista fixada no início da transferência já saiu, ou a retenção apagou segmentos frios que ela lê"""
+        if limits is None:
+            return False
+        view = self.sync_view(limits)
+        if view is None:
+            return True
+        return (self.cold_messages.base > view['messages'][0]
+                or self.cold_publications.base > view['publications'][0])
+    
+    def snapshot_chunk(self, section, offset, limits):
+        """Lê um bloco limitado de uma seção do estado a partir de offset, dentro da vista fixada em limits"""
+        if section not in SNAPSHOT_SECTIONS:
+            raise ValueError(f"Seção de snapshot inválida: {section}")
+        
+        if section == 'channels':
+            total = len(self.channels)
+            records = ([name, channel_data] for name, channel_data in islice(self.channels.items(), offset, None))
+        elif section == 'users':
+            total = len(self.user_list)
+            records = (self.user_list[index] for index in range(offset, total))
+        else:
+            # Posições lógicas: primeiro os segmentos frios ainda guardados, depois a parte quente
+            cold = self.cold_messages if section == 'messages' else self.cold_publications
+            view = self.sync_view(limits)
+            if view is None:
+                raise ValueError("Transferência expirada; recomece sem 'limits'")
+            cold_base, cold_stored, hot = view[section]
+            total = cold_stored + len(hot)
+            records = (
+                cold.get(cold_base + index) if index < cold_stored else hot[index - cold_stored]
+                for index in range(offset, total)
+            )
+        
+        payload, count, checksum = pack_chunk(records, self.sync_chunk_records, self.sync_chunk_bytes, default=encode_record)
+        
+        next_section, next_offset = section, offset + count
+        if next_offset >= total:
+            position = SNAPSHOT_SECTIONS.index(section) + 1
+            next_section = SNAPSHOT_SECTIONS[position] if position < len(SNAPSHOT_SECTIONS) else None
+            next_offset = 0
+            if next_section is None:
+                self.release_sync_view(limits)
+        
+        return {
+            "section": section,
+            "offset": offset,
+            "count": count,
+            "payload": payload,
+            "checksum": checksum,
+            "next_section": next_section,
+            "next_offset": next_offset
+        }
+    
+    def request_snapshot(self, peer):
+        """Pede ao par o estado completo (partida a frio ou intervalo fora do backlog)"""
+        if self.snapshot_request is not None:
+            return
+        
+        self.snapshot_request = {
+            "peer": peer,
+            "section": SNAPSHOT_SECTIONS[0],
+            "offset": 0,
+            "limits": None,
+            "replication": None,
+            "clock": 0,
+            "retention": None,
+            "requests": None,
+            "retries": 0,
+            "deadline": None,
+            "users": [],
+            "channels": {},
+            "messages": [],
+            "publications": []
+        }
+        self.catchup_inflight.clear()
+        
+        self.metrics.inc('bbs_server_snapshot_transfers_total')
+        print(f"📦 Pedindo snapshot a {peer}")
+        self.send_snapshot_request()
+    
+    def send_snapshot_request(self):
+        """Pede o próximo bloco esperado; também usado para retomar após perda ou checksum inválido"""
+        request = self.snapshot_request
+        request['deadline'] = time.time() + self.catchup_timeout
+        
+        msg = {
+            "type": "snapshot_request",
+            "to": request['peer'],
+            "section": request['section'],
+            "offset": request['offset']
+        }
+        if request['limits'] is not None:
+            msg['limits'] = request['limits']
+        
+        self.publish_replication(msg)
+    
+    def serve_snapshot(self, msg, requester):
+        """Responde com um único bloco; o par pede o seguinte quando o receber"""
+        limits = msg.get('limits')
+        section = msg.get('section', SNAPSHOT_SECTIONS[0])
+        
+        if self.snapshot_shifted(limits):
+            self.publish_replication({"type": "snapshot_chunk", "to": requester, "section": section,
+                                      "offset": msg.get('offset', 0), "restart": True})
+            return
+        
+        first = limits is None
+        if first:
+            # Primeiro bloco: fixa o ponto de corte da transferência
+            limits = self.snapshot_limits()
+        
+        chunk = self.snapshot_chunk(section, msg.get('offset', 0), limits)
+        chunk['type'] = 'snapshot_chunk'
+        chunk['to'] = requester
+        
+        if first:
+            chunk['limits'] = limits
+            chunk['replication'] = dict(self.replication_applied)
+            chunk['clock'] = self.logical_clock
+            chunk['retention'] = self.retention_state()
+            chunk['requests'] = self.request_dedup.state()
+        
+        self.publish_replication(chunk)
+    
+    def handle_snapshot_chunk(self, msg, sender):
+        """Acumula um bloco do snapshot e pede o próximo"""
+        request = self.snapshot_request
+        if request is None or request['peer'] != sender:
+            return
+        if msg['section'] != request['section'] or msg['offset'] != request['offset']:
+            return  # Bloco duplicado ou atrasado
+        
+        if msg.get('restart'):
+            # O par apagou segmentos frios no meio da transferência ou descartou a vista: recomeça do início
+            print(f"⚠️  Snapshot de {sender} interrompido pela retenção ou expirado; recomeçando")
+            self.snapshot_request = None
+            self.request_snapshot(sender)
+            return
+        
+        try:
+            records = unpack_chunk(msg['payload'], msg['checksum'])
+        except ValueError as e:
+            print(f"⚠️  {e}; pedindo o bloco novamente")
+            self.send_snapshot_request()
+            return
+        
+        if request['limits'] is None:
+            request['limits'] = msg['limits']
+            request['replication'] = msg['replication']
+            request['clock'] = msg.get('clock', 0)
+            request['retention'] = msg.get('retention')
+            request['requests'] = msg.get('requests')
+        
+        if msg['section'] == 'channels':
+            for name, channel_data in records:
+                request['channels'][name] = channel_data
+        else:
+            request[msg['section']].extend(records)
+        
+        request['retries'] = 0
+        
+        if msg['next_section'] is None:
+            self.install_snapshot(request)
+        else:
+            request['section'] = msg['next_section']
+            request['offset'] = msg['next_offset']
+            self.send_snapshot_request()
+    
+    def install_snapshot(self, request):
+        """Substitui o estado pelo snapshot do par, preservando operações que ele ainda não tinha"""
+        self.snapshot_request = None
+        
+        if self.snapshot_thread is not None:
+            self.snapshot_thread.join()
+        
+        local_applied = dict(self.replication_applied)
+        remote_applied = request['replication']
+        
+        # O histórico frio local é substituído junto com o resto do estado
+        self.cold_messages.clear()
+        self.cold_publications.clear()
+        
+        # Pisos antes dos registros: rebuild_indexes descarta o que o par já tinha cortado
+        self.load_retention(request['retention'])
+        self.request_dedup.load(request['requests'])
+        self.users = set(request['users'])
+        self.channels = request['channels']
+        self.messages = [message for message in map(as_message, request['messages']) if self.owns_message(message)]
+        self.publications = [publication for publication in map(as_publication, request['publications'])
+                             if self.owns_publication(publication)]
+        self.replication_applied = dict(remote_applied)
+        self.rebuild_indexes()
+        
+        # Reaplica do backlog o que só este servidor tinha (ex.: escritas próprias ainda não replicadas)
+        for source in set(local_applied) | set(remote_applied):
+            local_seq = local_applied.get(source, 0)
+            remote_seq = remote_applied.get(source, 0)
             
-            self.save_data()
+            if local_seq <= remote_seq:
+                self.replication_backlog.reset(source, remote_seq)
+                continue
             
-        except Exception as e:
-            print(f"Erro ao processar replicação: {e}")
-        finally:
-            self.is_replicating = False
+            ops = self.replication_backlog.range(source, remote_seq + 1, local_seq)
+            if ops is None:
+                print(f"⚠️  Operações {remote_seq + 1}..{local_seq} de {source} fora do backlog")
+                self.replication_backlog.reset(source, remote_seq)
+                continue
+            
+            for seq, operation, data in ops:
+                self.apply_operation(operation, data)
+            self.replication_applied[source] = local_seq
+        
+        self.restore_clock(request['clock'])
+        self.seal_cold_history()
+        self.save_snapshot(background=False)
+        print(f"📦 Snapshot de {request['peer']} instalado ({len(self.messages)} mensagens, {len(self.publications)} publicações)")
+        
+        if self.ring is not None:
+            # O par só tinha as chaves dele: as demais chaves deste servidor vêm dos outros donos
+            self.shard_handoff_due = time.time()
+    
+    def request_shard_handoff(self):
+        """Pede a todos os pares os registros das chaves que pertencem a este servidor"""
+        print(f"🧩 Pedindo aos pares as chaves deste servidor ({len(self.ring.nodes)} servidores no anel)")
+        self.publish_replication({"type": "shard_request", "nodes": self.ring.nodes})
+    
+    def serve_shard_handoff(self, msg, requester):
+        """Envia ao par os registros guardados aqui cujas chaves são dele (só as chaves que mudaram de dono)"""
+        if self.ring is None:
+            return
+        if msg.get('nodes') != self.ring.nodes:
+            self.log.warning(f"⚠️  Anel de {requester} difere do local; usando o local", key='anel')
+        
+        sections = (
+            ('publications', self.cold_publications, self.publications, self.owns_publication),
+            ('messages', self.cold_messages, self.messages, self.owns_message)
+        )
+        sent = 0
+        for kind, cold, hot, owns in sections:
+            records = (record for record in self.iter_history(cold, hot) if owns(record, requester))
+            while True:
+                chunk = list(islice(records, self.sync_chunk_records))
+                if not chunk:
+                    break
+                self.publish_replication({"type": "handoff", "to": requester, "kind": kind, "records": chunk})
+                sent += len(chunk)
+        
+        if sent:
+            print(f"🧩 {sent} registros entregues a {requester}")
+    
+    def iter_history(self, cold, hot):
+        yield from cold.iter_range(cold.base, cold.count)
+        yield from list(hot)
+    
+    def handle_handoff(self, msg, sender):
+        """Incorpora registros de chaves recebidas de outro dono, ignorando os que já existem aqui"""
+        if msg['kind'] == 'publications':
+            records = [as_publication(record) for record in msg['records']]
+            index, owns, store, operation = self.channel_index, self.owns_publication, self.store_publication, 'publish'
+        else:
+            records = [as_message(record) for record in msg['records']]
+            index, owns, store, operation = self.mailbox_index, self.owns_message, self.store_message, 'message'
+        
+        known = {}  # chave do índice -> identidades já guardadas
+        added = []
+        for record in records:
+            if not owns(record):
+                continue
+            key = record.index_keys()[0]
+            identities = known.get(key)
+            if identities is None:
+                identities = known[key] = {stored.identity() for stored in index.get(key)}
+            if record.identity() in identities:
+                continue
+            identities.add(record.identity())
+            store(record)
+            added.append((operation, record, None))
+        
+        if added:
+            self.log_operations(added)
+            self.metrics.inc('bbs_server_handoff_records_total', len(added))
+    
+    def deduplicated(self, service, handler):
+        """Escrita com 'request_id' opcional: repetir o mesmo ID devolve a resposta original sem reaplicar nada"""
+        def handle(data):
+            request_id = data.get('request_id')
+            if request_id is None or not self.request_dedup.max_entries:
+                return handler(data)
+            if not isinstance(request_id, str) or not 0 < len(request_id) <= 128:
+                raise ValueError("'request_id' deve ser um texto de 1 a 128 caracteres")
+            
+            remembered = self.request_dedup.get(service, request_id)
+            if remembered is not None:
+                self.update_clock(data['clock'])
+                self.metrics.inc('bbs_server_request_dedup_total', service=service, result='duplicate')
+                return dict(remembered, duplicate=True, clock=self.increment_clock())
+            
+            response = handler(data)
+            # Erros não ficam registrados: o cliente pode repetir depois de corrigir a causa
+            if isinstance(response, dict) and response.get('success'):
+                remembered = {key: value for key, value in response.items() if key != 'clock'}
+                timestamp = time.time()
+                self.request_dedup.put(service, request_id, remembered, timestamp)
+                # Vai no mesmo frame de replicação da escrita: em outro servidor a repetição só é reconhecida depois
+                # que o frame chega lá (o broker fixa o servidor pelo request_id para não depender disso)
+                self.commit_operation('request', {
+                    "service": service, "id": request_id, "timestamp": timestamp, "response": remembered
+                })
+                self.metrics.inc('bbs_server_request_dedup_total', service=service, result='new')
+            return response
+        return handle
     
     def handle_login(self, data):
         """Processa login de usuário"""
         user = data['user']
         self.update_clock(data['clock'])
         
-        self.users.add(user)
-        self.save_data()
-        
-        self.replicate_data('login', {'user': user})
+        self.add_user(user)
+        self.commit_operation('login', {'user': user})
         
         return {
             "success": True,
@@ -271,10 +1417,17 @@ class Servidor:
         """Retorna lista de usuários"""
         self.update_clock(data['clock'])
         
-        return {
-            "users": list(self.users),
-            "clock": self.increment_clock()
-        }
+        response = self.cached_response('users', ('users',), ('users',), lambda: {"users": list(self.users)})
+        return response.reply(self.increment_clock())
+    
+    def cached_response(self, service, key, tags, build):
+        """Resposta serializada do cache; em caso de falta, build() monta os campos (sem o relógio)"""
+        response = self.response_cache.get(key)
+        if response is not None:
+            self.metrics.inc('bbs_server_response_cache_total', service=service, result='hit')
+            return response
+        self.metrics.inc('bbs_server_response_cache_total', service=service, result='miss')
+        return self.response_cache.put(key, tags, build())
     
     def handle_channel_create(self, data):
         """Cria novo canal"""
@@ -298,14 +1451,15 @@ class Servidor:
         }
         
         self.channels[channel] = channel_data
-        self.save_data()
+        self.response_cache.invalidate('channels')
         
-        self.replicate_data('channel_create', {
+        operation_data = {
             'channel': channel,
             'creator': creator,
             'timestamp': channel_data['timestamp'],
             'clock': self.logical_clock
-        })
+        }
+        self.commit_operation('channel_create', operation_data)
         
         return {
             "success": True,
@@ -317,42 +1471,40 @@ class Servidor:
         """Retorna lista de canais"""
         self.update_clock(data['clock'])
         
-        channels_list = [
-            {
-                "name": channel_name,
-                "creator": channel_data.get("creator", "unknown"),
-                "timestamp": channel_data.get("timestamp", 0),
-                "subscribers": channel_data.get("subscribers", []),
-                "clock": channel_data.get("clock", 0)
-            }
-            for channel_name, channel_data in self.channels.items()
-        ]
+        def build():
+            return {"channels": [
+                {
+                    "name": channel_name,
+                    "creator": channel_data.get("creator", "unknown"),
+                    "timestamp": channel_data.get("timestamp", 0),
+                    "subscribers": channel_data.get("subscribers", []),
+                    "clock": channel_data.get("clock", 0)
+                }
+                for channel_name, channel_data in self.channels.items()
+            ]}
         
-        return {
-            "channels": channels_list,
-            "clock": self.increment_clock()
-        }
+        response = self.cached_response('channels', ('channels',), ('channels',), build)
+        return response.reply(self.increment_clock())
     
     def handle_publish(self, data):
         """Processa publicação em canal"""
         self.update_clock(data['clock'])
         
-        publication = {
-            'user': data['user'],
-            'channel': data['channel'],
-            'message': data['message'],
-            'timestamp': time.time(),
-            'clock': self.logical_clock
-        }
+        publication = Publication(
+            data['user'],
+            data['channel'],
+            data['message'],
+            time.time(),
+            self.logical_clock,
+            self.server_name
+        )
         
-        self.publications.append(publication)
-        self.save_data()
-        
-        self.replicate_data('publish', publication)
+        self.store_publication(publication)
+        packed = self.commit_operation('publish', publication)
         
         self.pub_socket.send_multipart([
             data['channel'].encode(),
-            msgpack.packb(publication)
+            self.codec.wire(publication, packed)
         ])
         
         return {
@@ -365,22 +1517,21 @@ class Servidor:
         """Processa mensagem privada"""
         self.update_clock(data['clock'])
         
-        message = {
-            'from': data['from'],
-            'to': data['to'],
-            'message': data['message'],
-            'timestamp': time.time(),
-            'clock': self.logical_clock
-        }
-        
-        self.messages.append(message)
-        self.save_data()
+        message = Message(
+            data['from'],
+            data['to'],
+            data['message'],
+            time.time(),
+            self.logical_clock,
+            self.server_name
+        )
         
-        self.replicate_data('message', message)
+        self.store_message(message)
+        packed = self.commit_operation('message', message)
         
         self.pub_socket.send_multipart([
             f"private_{data['to']}".encode(),
-            msgpack.packb(message)
+            self.codec.wire(message, packed)
         ])
         
         return {
@@ -389,18 +1540,112 @@ class Servidor:
             "clock": self.increment_clock()
         }
     
+    def batch_items(self, data, fields):
+        """Valida o lote inteiro antes de qualquer alteração: ou todos os itens são aplicados, ou nenhum"""
+        items = data.get('items')
+        if not isinstance(items, list) or not items:
+            raise ValueError("'items' deve ser uma lista não vazia")
+        if len(items) > self.batch_max_items:
+            raise ValueError(f"Lote com {len(items)} itens excede o limite de {self.batch_max_items}")
+        
+        batch = []
+        for position, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ValueError(f"Item {position}: esperado um mapa")
+            # Campos ausentes no item vêm do nível de cima (ex.: o mesmo 'user' para o lote todo)
+            values = [item.get(field, data.get(field)) for field in fields]
+            for field, value in zip(fields, values):
+                if value is None:
+                    raise ValueError(f"Item {position}: campo '{field}' ausente")
+                if field != 'message' and not isinstance(value, str):
+                    raise ValueError(f"Item {position}: campo '{field}' deve ser texto")
+            batch.append(values)
+        return batch
+    
+    def handle_publish_batch(self, data):
+        """Publica vários itens com uma escrita no log e um frame de replicação"""
+        self.update_clock(data['clock'])
+        items = self.batch_items(data, ('user', 'channel', 'message'))
+        
+        timestamp = time.time()
+        publications = [Publication(user, channel, message, timestamp, self.increment_clock(), self.server_name)
+                        for user, channel, message in items]
+        
+        # Com particionamento o lote mistura canais: só os do servidor ficam aqui, os donos recebem pela replicação
+        for publication in publications:
+            if self.owns_publication(publication):
+                self.store_publication(publication)
+        packed = self.commit_operations('publish', publications)
+        
+        for publication, payload in zip(publications, packed):
+            self.pub_socket.send_multipart([
+                publication.channel.encode(),
+                self.codec.wire(publication, payload)
+            ])
+        
+        return {
+            "success": True,
+            "message": f"{len(publications)} publicações enviadas",
+            "results": [{"success": True, "clock": publication.clock} for publication in publications],
+            "clock": self.increment_clock()
+        }
+    
+    def handle_message_batch(self, data):
+        """Envia várias mensagens privadas com uma escrita no log e um frame de replicação"""
+        self.update_clock(data['clock'])
+        items = self.batch_items(data, ('from', 'to', 'message'))
+        
+        timestamp = time.time()
+        messages = [Message(sender, recipient, message, timestamp, self.increment_clock(), self.server_name)
+                    for sender, recipient, message in items]
+        
+        for message in messages:
+            if self.owns_message(message):
+                self.store_message(message)
+        packed = self.commit_operations('message', messages)
+        
+        for message, payload in zip(messages, packed):
+            self.pub_socket.send_multipart([
+                f"private_{message.to_user}".encode(),
+                self.codec.wire(message, payload)
+            ])
+        
+        return {
+            "success": True,
+            "message": f"{len(messages)} mensagens enviadas",
+            "results": [{"success": True, "clock": message.clock} for message in messages],
+            "clock": self.increment_clock()
+        }
+    
+    def history_page_args(self, data):
+        """Extrai os parâmetros de paginação opcionais de uma requisição de histórico"""
+        args = {
+            "before_clock": data.get('before_clock'),
+            "after_clock": data.get('after_clock'),
+            "cursor": data.get('cursor'),
+            "newest_first": bool(data.get('newest_first', False)),
+            "limit": None
+        }
+        
+        # Sem 'limit' a resposta mantém o comportamento antigo (histórico completo)
+        if data.get('limit') is not None:
+            limit = int(data['limit'])
+            if limit <= 0:
+                raise ValueError("'limit' deve ser positivo")
+            args["limit"] = min(limit, self.history_max_page)
+        
+        return args
+    
     def handle_history_messages(self, data):
         """Retorna histórico de mensagens privadas"""
         user = data['user']
         self.update_clock(data['clock'])
         
-        user_messages = [
-            msg for msg in self.messages
-            if msg['from'] == user or msg['to'] == user
-        ]
+        user_messages, next_cursor = self.mailbox_index.page(user, **self.history_page_args(data))
         
         return {
             "messages": user_messages,
+            "next_cursor": next_cursor,
             "clock": self.increment_clock()
         }
     
@@ -409,28 +1654,129 @@ class Servidor:
         channel = data['channel']
         self.update_clock(data['clock'])
         
-        channel_publications = [
-            pub for pub in self.publications
-            if pub['channel'] == channel
-        ]
+        args = self.history_page_args(data)
         
-        return {
-            "publications": channel_publications,
-            "clock": self.increment_clock()
-        }
+        def build():
+            channel_publications, next_cursor = self.channel_index.page(channel, **args)
+            return {"publications": channel_publications, "next_cursor": next_cursor}
+        
+        key = ('history_channel', channel) + tuple(sorted(args.items()))
+        response = self.cached_response('history_channel', key, (('channel', channel),), build)
+        return response.reply(self.increment_clock())
     
     def handle_sync_request(self, data):
         """Processa requisição de sincronização"""
         self.update_clock(data['clock'])
         
+        if data.get('stream'):
+            # Modo em blocos: um bloco limitado por requisição, retomável por seção/offset
+            limits = data.get('limits')
+            section = data.get('section', SNAPSHOT_SECTIONS[0])
+            if self.snapshot_shifted(limits):
+                raise ValueError("Histórico compactado ou transferência expirada; recomece sem 'limits'")
+            
+            first = limits is None
+            if first:
+                limits = self.snapshot_limits()
+            
+            response = self.snapshot_chunk(section, int(data.get('offset', 0)), limits)
+            if first:
+                response['limits'] = limits
+                response['replication'] = dict(self.replication_applied)
+            response['clock'] = self.increment_clock()
+            return response
+        
         return {
             "users": list(self.users),
             "channels": self.channels,
-            "messages": self.messages,
-            "publications": self.publications,
+            "messages": [message for message in self.iter_history(self.cold_messages, self.messages)
+                         if self.mailbox_index.live(message)],
+            "publications": [publication for publication in self.iter_history(self.cold_publications, self.publications)
+                             if self.channel_index.live(publication)],
+            "clock": self.increment_clock()
+        }
+    
+    def handle_retention(self, data):
+        """Consulta ou define ('policy', None = padrão) a política de retenção de um canal ou caixa de mensagens"""
+        kind = data.get('kind')
+        key = data.get('key')
+        self.update_clock(data['clock'])
+        
+        if kind not in RETENTION_KINDS:
+            raise ValueError(f"'kind' deve ser um de {', '.join(RETENTION_KINDS)}")
+        if not isinstance(key, str):
+            raise ValueError("'key' deve ser texto")
+        
+        if 'policy' in data:
+            policy = data['policy']
+            if policy is not None:
+                if not isinstance(policy, dict):
+                    raise ValueError("'policy' deve ser um mapa")
+                policy = RetentionPolicy.from_dict(policy).to_dict()
+            self.set_retention_policy(kind, key, policy)
+            self.commit_operation('retention_policy', {"kind": kind, "key": key, "policy": policy})
+        
+        return {
+            "success": True,
+            "kind": kind,
+            "key": key,
+            "policy": self.retention_policy(kind, key).to_dict(),
+            "floor": self.retention_index(kind).floors.get(key),
             "clock": self.increment_clock()
         }
     
+    def register_metrics(self):
+        """Descrições e gauges lidos a cada coleta de /metrics"""
+        m = self.metrics
+        m.describe('bbs_server_wal_append_seconds', 'Tempo de escrita de um lote no log')
+        m.describe('bbs_server_wal_fsync_seconds', 'Duração de cada fsync do log (group commit)')
+        m.describe('bbs_server_snapshot_seconds', 'Tempo de gravação de um snapshot')
+        m.describe('bbs_server_replication_apply_seconds', 'Tempo do escritor por mensagem de replicação, por tipo')
+        m.describe('bbs_server_replication_applied_seq', 'Maior sequência aplicada por servidor de origem')
+        m.describe('bbs_server_request_dedup_total', 'Escritas com request_id: novas e repetições respondidas pela tabela')
+        m.describe('bbs_server_history_late_inserts_total', 'Registros que chegaram fora da ordem de relógio')
+        m.describe('bbs_server_retention_floors_total', 'Pisos de retenção aplicados (decididos aqui ou replicados)')
+        m.describe('bbs_server_retention_expired_total', 'Registros retirados do índice pelos pisos de retenção')
+        m.describe('bbs_server_retention_dropped_total', 'Registros expirados removidos da memória (hot) e do disco (cold)')
+        m.describe('bbs_server_retention_compaction_seconds', 'Tempo do escritor em cada compactação que removeu registros')
+        
+        m.gauge('bbs_server_users', lambda: len(self.users))
+        m.gauge('bbs_server_channels', lambda: len(self.channels))
+        m.gauge('bbs_server_request_dedup_entries', lambda: len(self.request_dedup))
+        m.gauge('bbs_server_records', lambda: {
+            (('kind', 'publications'), ('tier', 'hot')): len(self.publications),
+            (('kind', 'publications'), ('tier', 'cold')): self.cold_publications.stored,
+            (('kind', 'messages'), ('tier', 'hot')): len(self.messages),
+            (('kind', 'messages'), ('tier', 'cold')): self.cold_messages.stored
+        })
+        m.gauge('bbs_server_replication_applied_seq',
+                lambda: {(('source', source),): seq for source, seq in list(self.replication_applied.items())})
+        m.gauge('bbs_server_replication_batch_pending', lambda: len(self.replication_batcher.ops))
+        m.gauge('bbs_server_catchups_inflight', lambda: len(self.catchup_inflight))
+        m.gauge('bbs_server_wal_pending_records', lambda: self.wal.pending)
+        m.gauge('bbs_server_wal_bytes', lambda: self.wal.bytes_written)
+        m.gauge('bbs_server_response_cache_entries', lambda: len(self.response_cache))
+        m.gauge('bbs_server_response_cache_bytes', lambda: self.response_cache.bytes)
+    
+    def observe_wal_sync(self, seconds, records):
+        self.metrics.observe('bbs_server_wal_fsync_seconds', seconds)
+        self.metrics.inc('bbs_server_wal_fsync_records_total', records)
+    
+    def broker_heartbeat_frames(self):
+        """Heartbeat ao broker: nome do servidor e capacidade de requisições em andamento"""
+        info = {
+            "name": self.server_name,
+            "capacity": int(os.getenv('BROKER_CAPACITY', str(self.dispatcher.workers * 2)))
+        }
+        return [CONTROL_FRAME, b"heartbeat", msgpack.packb(info)]
+    
+    def broker_heartbeat(self):
+        """Anuncia ao broker que o servidor está vivo"""
+        try:
+            self.req_socket.send_multipart(self.broker_heartbeat_frames())
+        except Exception as e:
+            self.log.error(f"Erro ao enviar heartbeat ao broker: {e}", key='heartbeat_broker')
+    
     def heartbeat(self):
         """Envia heartbeat se for coordenador"""
         if self.rank == 1 or (self.coordinator and self.coordinator == self.server_name):
@@ -556,28 +1902,29 @@ class Servidor:
             print(f"Erro ao enviar resposta de eleição: {e}")
     
     def synchronize_clocks_berkeley(self):
-        """Coordenador sincroniza relógios físicos usando algoritmo de Berkeley"""
-        if self.coordinator != self.server_name:
-            return  # Apenas coordenador sincroniza
-        
-        print(f"⏰ Berkeley: Iniciando sincronização de relógios...")
+        """Coordenador inicia uma rodada de Berkeley; as respostas são coletadas pelo loop principal"""
+        if self.coordinator != self.server_name or self.berkeley_round is not None:
+            return
         
-        # Obter lista atualizada de servidores
-        self.get_servers_list()
+        self.berkeley_round_id += 1
+        sent_at = self.get_physical_time()
+        self.berkeley_round = {
+            "id": self.berkeley_round_id,
+            "sent_at": sent_at,
+            "deadline": time.time() + self.berkeley_timeout,
+            "offsets": {}
+        }
         
-        # Coletar timestamps de todos os servidores
-        timestamps = {}
-        my_time = self.get_physical_time()
-        timestamps[self.server_name] = my_time
+        print(f"⏰ Berkeley: Iniciando rodada {self.berkeley_round_id}...")
         
-        # Enviar requisição de clock para cada servidor via Pub-Sub
         clock_request = {
             "service": "clock_sync",
             "data": {
                 "type": "request",
                 "from": self.server_name,
+                "round": self.berkeley_round_id,
                 "clock": self.increment_clock(),
-                "timestamp": my_time
+                "timestamp": sent_at
             }
         }
         
@@ -588,39 +1935,78 @@ class Servidor:
             ])
         except Exception as e:
             print(f"Erro ao enviar requisição de clock: {e}")
-            return
+            self.berkeley_round = None
+    
+    def handle_clock_response(self, msg_data):
+        """Coordenador registra a resposta de um servidor, compensando metade do RTT"""
+        current = self.berkeley_round
+        if current is None or msg_data.get('round') != current['id']:
+            return  # Resposta atrasada de uma rodada já encerrada
+        
+        received_at = self.get_physical_time()
+        rtt = received_at - current['sent_at']
+        # Estimativa do relógio remoto no instante da recepção
+        remote_time = msg_data['time'] + rtt / 2
+        current['offsets'][msg_data['from']] = remote_time - received_at
+    
+    def finish_berkeley_round(self):
+        """Encerra a rodada: média dos offsets e ajuste individual para cada servidor"""
+        current = self.berkeley_round
+        self.berkeley_round = None
+        self.last_berkeley_sync = time.time()
         
-        # Aguardar respostas por 2 segundos
-        time.sleep(2)
+        offsets = dict(current['offsets'])
+        offsets[self.server_name] = 0.0
+        average = sum(offsets.values()) / len(offsets)
         
-        # Calcular média dos timestamps (simulação - em produção usaria respostas reais)
-        # Como estamos em um sistema assíncrono via Pub-Sub, vamos usar uma abordagem simplificada
-        # O coordenador assume que os outros servidores estão próximos do seu tempo
-        avg_time = my_time
+        print(f"⏰ Berkeley: rodada {current['id']} com {len(offsets)} relógio(s), média {average:+.3f}s")
         
-        # Calcular offset para cada servidor e enviar ajuste
-        adjustment = {
-            "service": "clock_sync",
-            "data": {
-                "type": "adjust",
-                "from": self.server_name,
-                "offset": 0,  # Offset calculado
-                "clock": self.increment_clock(),
-                "timestamp": time.time()
+        for server_name, offset in offsets.items():
+            correction = average - offset
+            
+            if server_name == self.server_name:
+                if correction != 0:
+                    self.adjust_physical_clock(correction)
+                continue
+            
+            adjustment = {
+                "service": "clock_sync",
+                "data": {
+                    "type": "adjust",
+                    "from": self.server_name,
+                    "to": server_name,
+                    "round": current['id'],
+                    "offset": correction,
+                    "clock": self.increment_clock(),
+                    "timestamp": time.time()
+                }
             }
-        }
+            
+            try:
+                self.election_pub_socket.send_multipart([
+                    b"servers",
+                    msgpack.packb(adjustment)
+                ])
+            except Exception as e:
+                print(f"Erro ao enviar ajuste de clock: {e}")
+    
+    def berkeley_tick(self):
+        """Chamado a cada volta do loop: agenda e encerra rodadas sem bloquear"""
+        now = time.time()
         
-        try:
-            self.election_pub_socket.send_multipart([
-                b"servers",
-                msgpack.packb(adjustment)
-            ])
-            print(f"  ↳ Ajustes de relógio enviados para todos os servidores")
-        except Exception as e:
-            print(f"Erro ao enviar ajuste de clock: {e}")
+        if self.berkeley_round is not None:
+            if self.coordinator != self.server_name:
+                self.berkeley_round = None  # Perdeu a coordenação no meio da rodada
+            elif now >= self.berkeley_round['deadline']:
+                self.finish_berkeley_round()
+        elif self.coordinator == self.server_name and now - self.last_berkeley_sync >= self.berkeley_interval:
+            self.synchronize_clocks_berkeley()
     
     def handle_clock_request(self, msg_data):
         """Responde requisição de clock do coordenador (Berkeley)"""
+        if msg_data.get('from') == self.server_name:
+            return
+        
         my_time = self.get_physical_time()
         
         response = {
@@ -628,6 +2014,8 @@ class Servidor:
             "data": {
                 "type": "response",
                 "from": self.server_name,
+                "to": msg_data.get('from'),
+                "round": msg_data.get('round'),
                 "time": my_time,
                 "clock": self.increment_clock(),
                 "timestamp": my_time
@@ -644,10 +2032,104 @@ class Servidor:
     
     def handle_clock_adjust(self, msg_data):
         """Aplica ajuste de clock recebido do coordenador (Berkeley)"""
+        if msg_data.get('to', self.server_name) != self.server_name:
+            return
+        
         offset = msg_data.get('offset', 0)
         if offset != 0:
             self.adjust_physical_clock(offset)
     
+    def handle_election_message(self, msg):
+        """Eleição (heartbeat, ELECTION, OK, anúncio) e Berkeley recebidos no tópico 'servers'"""
+        msg_data = msg.get('data', {})
+        
+        if msg.get('service') == 'election':
+            msg_type = msg_data.get('type')
+            
+            if 'clock' in msg_data:
+                self.update_clock(msg_data['clock'])
+            
+            # Heartbeat do coordenador
+            if msg_type == 'heartbeat':
+                self.last_coordinator_heartbeat = time.time()
+                coordinator_name = msg_data.get('coordinator')
+                
+                if coordinator_name and coordinator_name != self.coordinator:
+                    print(f"💓 Heartbeat do coordenador: {coordinator_name}")
+                    self.coordinator = coordinator_name
+                    self.election_in_progress = False
+            
+            # Mensagem de eleição recebida
+            elif msg_type == 'election':
+                from_server = msg_data.get('from')
+                from_rank = msg_data.get('from_rank', float('inf'))
+                
+                print(f"🗳️  Recebida ELECTION de {from_server} (rank {from_rank})")
+                
+                # Se meu rank é menor (maior prioridade), respondo OK e inicio minha eleição
+                if self.rank < from_rank:
+                    print(f"  ↳ Meu rank {self.rank} é melhor que {from_rank}, respondendo OK")
+                    self.send_election_response(from_server)
+                    # Iniciar minha própria eleição
+                    self.start_election()
+            
+            # Resposta OK a minha eleição
+            elif msg_type == 'election_ok':
+                from_server = msg_data.get('from')
+                print(f"  ↳ Recebido OK de {from_server} (servidor com maior prioridade)")
+                self.election_responses.add(from_server)
+                # Não me torno coordenador, alguém com maior prioridade está ativo
+            
+            # Anúncio de novo coordenador
+            elif msg_type == 'coordinator_announcement':
+                self.last_coordinator_heartbeat = time.time()
+                new_coordinator = msg_data.get('coordinator')
+                new_rank = msg_data.get('rank', '?')
+                
+                if new_coordinator and new_coordinator != self.coordinator:
+                    print(f"✓ Novo coordenador reconhecido: {new_coordinator} (rank {new_rank})")
+                    self.coordinator = new_coordinator
+                    self.election_in_progress = False
+        
+        # Mensagens de sincronização de clock (Berkeley)
+        if msg.get('service') == 'clock_sync':
+            sync_type = msg_data.get('type')
+            
+            if sync_type == 'request':
+                # Coordenador pedindo nosso timestamp
+                self.handle_clock_request(msg_data)
+            
+            elif sync_type == 'response' and msg_data.get('to') == self.server_name:
+                # Resposta a uma rodada iniciada por este coordenador
+                self.handle_clock_response(msg_data)
+            
+            elif sync_type == 'adjust':
+                # Coordenador enviando ajuste de clock
+                self.handle_clock_adjust(msg_data)
+            
+            if 'clock' in msg_data:
+                self.update_clock(msg_data['clock'])
+    
+    def check_election(self):
+        """Dispara a eleição sem heartbeat do coordenador e encerra a eleição sem respostas"""
+        if self.coordinator != self.server_name:
+            time_since_last_heartbeat = time.time() - self.last_coordinator_heartbeat
+            
+            if time_since_last_heartbeat > self.election_timeout:
+                print(f"⚠️  Coordenador não responde há {time_since_last_heartbeat:.1f}s")
+                print(f"🗳️  Timeout detectado! Iniciando eleição...")
+                self.start_election()
+                self.last_coordinator_heartbeat = time.time()  # Reset após iniciar eleição
+        
+        # Iniciou eleição mas não recebeu resposta
+        if self.election_in_progress and self.election_start_time:
+            if time.time() - self.election_start_time > self.election_wait:
+                if len(self.election_responses) == 0:
+                    print(f"  ↳ Timeout da eleição, nenhuma resposta recebida")
+                    self.become_coordinator()
+                self.election_in_progress = False
+                self.election_start_time = None
+    
     def run(self):
         """Loop principal do servidor"""
         print(f"╔{'═'*50}╗")
@@ -655,171 +2137,108 @@ class Servidor:
         print(f"║ Rank: {self.rank:^45} ║")
         print(f"╚{'═'*50}╝")
         
-        poller = zmq.Poller()
-        poller.register(self.req_socket, zmq.POLLIN)
-        poller.register(self.election_socket, zmq.POLLIN)
-        poller.register(self.replication_socket, zmq.POLLIN)
+        start_metrics_server(self.metrics, self.metrics_port, self.log)
         
-        last_heartbeat = time.time()
-        last_coordinator_heartbeat = time.time()
-        election_timeout = 15  # 15 segundos sem heartbeat = eleição
+        # Compactador de retenção: decide os cortes em segundo plano; o escritor só aplica
+        if self.retention_interval > 0:
+            threading.Thread(target=self.retention_loop, name="retencao", daemon=True).start()
+        
+        self.last_coordinator_heartbeat = time.time()
         
         # Se rank 1, já é coordenador inicial
         if self.rank == 1:
             self.coordinator = self.server_name
             print(f"👑 Servidor {self.server_name} iniciado como COORDENADOR (rank 1)")
         
+        if self.runtime == 'asyncio':
+            AsyncRuntime(self).run()
+        else:
+            self.run_poll()
+    
+    def run_poll(self):
+        """Laço com um único poll: temporizadores só são verificados quando o poll retorna"""
+        poller = zmq.Poller()
+        poller.register(self.req_socket, zmq.POLLIN)
+        poller.register(self.dispatcher.reply_socket, zmq.POLLIN)
+        poller.register(self.election_socket, zmq.POLLIN)
+        poller.register(self.replication_socket, zmq.POLLIN)
+        
+        last_heartbeat = time.time()
+        
         while True:
-            socks = dict(poller.poll(1000))
+            # Com registros pendentes de fsync, acorda a tempo de cumprir a política do log
+            poll_timeout = int(self.wal.fsync_interval * 1000) if self.wal.pending else 1000
+            if self.berkeley_round is not None:
+                # Acorda no fim da janela de coleta da rodada de Berkeley
+                remaining = self.berkeley_round['deadline'] - time.time()
+                poll_timeout = max(0, min(poll_timeout, int(remaining * 1000)))
+            socks = dict(poller.poll(poll_timeout))
             
-            # Processa requisições
+            # Encaminha requisições aos workers (não bloqueia o loop)
             if self.req_socket in socks:
                 try:
-                    msg = msgpack.unpackb(self.req_socket.recv())
-                    service = msg['service']
-                    data = msg['data']
-                    
-                    if service == 'login':
-                        response = self.handle_login(data)
-                    elif service == 'users':
-                        response = self.handle_users(data)
-                    elif service == 'channel':
-                        response = self.handle_channel_create(data)
-                    elif service == 'channels':
-                        response = self.handle_channels(data)
-                    elif service == 'publish':
-                        response = self.handle_publish(data)
-                    elif service == 'message':
-                        response = self.handle_message(data)
-                    elif service == 'history_messages':
-                        response = self.handle_history_messages(data)
-                    elif service == 'history_channel':
-                        response = self.handle_history_channel(data)
-                    elif service == 'sync':
-                        response = self.handle_sync_request(data)
-                    else:
-                        response = {"error": "Serviço desconhecido"}
-                    
-                    self.req_socket.send(msgpack.packb(response))
+                    self.dispatcher.dispatch(self.req_socket.recv_multipart())
+                except Exception as e:
+                    self.log.error(f"❌ Erro ao despachar requisição: {e}", key='despacho')
+            
+            # Devolve ao broker as respostas prontas
+            if self.dispatcher.reply_socket in socks:
+                try:
+                    self.req_socket.send_multipart(self.dispatcher.recv_reply())
                     self.message_count += 1
-                    
-                    # Berkeley: Sincronizar relógios a cada 10 mensagens
-                    if self.message_count - self.last_sync_message_count >= 10:
-                        if self.coordinator == self.server_name:
-                            self.synchronize_clocks_berkeley()
-                        self.last_sync_message_count = self.message_count
-                
                 except Exception as e:
-                    print(f"❌ Erro ao processar requisição: {e}")
-                    error_response = {"error": str(e)}
-                    self.req_socket.send(msgpack.packb(error_response))
+                    self.log.error(f"❌ Erro ao enviar resposta: {e}", key='resposta')
             
             # Processa mensagens de replicação
             if self.replication_socket in socks:
                 try:
                     topic = self.replication_socket.recv()
                     msg = msgpack.unpackb(self.replication_socket.recv())
-                    self.handle_replication(msg)
+                    self.dispatcher.submit_write(lambda msg=msg: self.handle_replication_message(msg))
                 except Exception as e:
-                    print(f"❌ Erro ao processar replicação: {e}")
+                    self.log.error(f"❌ Erro ao processar replicação: {e}", key='replicacao')
             
             # Processa mensagens de eleição
             if self.election_socket in socks:
                 try:
                     topic = self.election_socket.recv()
-                    msg = msgpack.unpackb(self.election_socket.recv())
-                    
-                    if msg.get('service') == 'election':
-                        msg_data = msg.get('data', {})
-                        msg_type = msg_data.get('type')
-                        
-                        if 'clock' in msg_data:
-                            self.update_clock(msg_data['clock'])
-                        
-                        # Heartbeat do coordenador
-                        if msg_type == 'heartbeat':
-                            last_coordinator_heartbeat = time.time()
-                            coordinator_name = msg_data.get('coordinator')
-                            
-                            if coordinator_name and coordinator_name != self.coordinator:
-                                print(f"💓 Heartbeat do coordenador: {coordinator_name}")
-                                self.coordinator = coordinator_name
-                                self.election_in_progress = False
-                        
-                        # Mensagem de eleição recebida
-                        elif msg_type == 'election':
-                            from_server = msg_data.get('from')
-                            from_rank = msg_data.get('from_rank', float('inf'))
-                            
-                            print(f"🗳️  Recebida ELECTION de {from_server} (rank {from_rank})")
-                            
-                            # Se meu rank é menor (maior prioridade), respondo OK e inicio minha eleição
-                            if self.rank < from_rank:
-                                print(f"  ↳ Meu rank {self.rank} é melhor que {from_rank}, respondendo OK")
-                                self.send_election_response(from_server)
-                                # Iniciar minha própria eleição
-                                self.start_election()
-                        
-                        # Resposta OK a minha eleição
-                        elif msg_type == 'election_ok':
-                            from_server = msg_data.get('from')
-                            print(f"  ↳ Recebido OK de {from_server} (servidor com maior prioridade)")
-                            self.election_responses.add(from_server)
-                            # Não me torno coordenador, alguém com maior prioridade está ativo
-                        
-                        # Anúncio de novo coordenador
-                        elif msg_type == 'coordinator_announcement':
-                            last_coordinator_heartbeat = time.time()
-                            new_coordinator = msg_data.get('coordinator')
-                            new_rank = msg_data.get('rank', '?')
-                            
-                            if new_coordinator and new_coordinator != self.coordinator:
-                                print(f"✓ Novo coordenador reconhecido: {new_coordinator} (rank {new_rank})")
-                                self.coordinator = new_coordinator
-                                self.election_in_progress = False
-                    
-                    # Mensagens de sincronização de clock (Berkeley)
-                    if msg.get('service') == 'clock_sync':
-                        sync_type = msg_data.get('type')
-                        
-                        if sync_type == 'request':
-                            # Coordenador pedindo nosso timestamp
-                            self.handle_clock_request(msg_data)
-                        
-                        elif sync_type == 'adjust':
-                            # Coordenador enviando ajuste de clock
-                            self.handle_clock_adjust(msg_data)
-                        
-                        if 'clock' in msg_data:
-                            self.update_clock(msg_data['clock'])
-                                
+                    self.handle_election_message(msgpack.unpackb(self.election_socket.recv()))
                 except Exception as e:
-                    print(f"❌ Erro ao processar mensagem de eleição: {e}")
+                    self.log.error(f"❌ Erro ao processar mensagem de eleição: {e}", key='eleicao')
             
-            # Verificar timeout do coordenador (se não for coordenador)
-            if self.coordinator != self.server_name:
-                time_since_last_heartbeat = time.time() - last_coordinator_heartbeat
-                
-                if time_since_last_heartbeat > election_timeout:
-                    print(f"⚠️  Coordenador não responde há {time_since_last_heartbeat:.1f}s")
-                    print(f"🗳️  Timeout detectado! Iniciando eleição...")
-                    self.start_election()
-                    last_coordinator_heartbeat = time.time()  # Reset após iniciar eleição
-            
-            # Verificar timeout de eleição (se iniciou eleição mas não recebeu resposta)
-            if self.election_in_progress and self.election_start_time:
-                if time.time() - self.election_start_time > 3:  # 3 segundos esperando resposta
-                    if len(self.election_responses) == 0:
-                        print(f"  ↳ Timeout da eleição, nenhuma resposta recebida")
-                        self.become_coordinator()
-                    self.election_in_progress = False
-                    self.election_start_time = None
+            self.check_election()
             
             # Heartbeat periódico (se for coordenador)
-            if time.time() - last_heartbeat > 5:
+            if time.time() - last_heartbeat > self.coordinator_heartbeat_interval:
                 self.heartbeat()
                 last_heartbeat = time.time()
+            
+            # Heartbeat para o broker balanceado
+            if time.time() - self.last_broker_heartbeat >= self.broker_heartbeat_interval:
+                self.broker_heartbeat()
+                self.last_broker_heartbeat = time.time()
+            
+            # Berkeley: rodadas periódicas conduzidas pelo coordenador
+            self.berkeley_tick()
+            
+            # Group commit do log (políticas 'batch' e 'interval'; em 'group', escritas de replicação)
+            self.wal.tick()
 
 if __name__ == "__main__":
-    servidor = Servidor()
-    servidor.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Servidor do Bulletin Board")
+    parser.add_argument('--name', help="nome do servidor (padrão: SERVER_NAME ou hostname)")
+    parser.add_argument('--data-dir', help="diretório de dados (padrão: DATA_DIR ou /app/data)")
+    parser.add_argument('--broker', help="endpoint do broker (padrão: BROKER_ENDPOINT ou tcp://broker:5556)")
+    parser.add_argument('--proxy-pub', help="XSUB do proxy (padrão: PROXY_PUB_ENDPOINT ou tcp://proxy:5557)")
+    parser.add_argument('--proxy-sub', help="XPUB do proxy (padrão: PROXY_SUB_ENDPOINT ou tcp://proxy:5558)")
+    parser.add_argument('--reference', help="servidor de referência; vazio desliga (padrão: REFERENCE_ENDPOINT)")
+    parser.add_argument('--runtime', choices=('poll', 'asyncio'), help="laço principal (padrão: SERVER_RUNTIME ou poll)")
+    args = parser.parse_args()
+    
+    servidor = Servidor(name=args.name, data_dir=args.data_dir, broker=args.broker, proxy_pub=args.proxy_pub,
+                        proxy_sub=args.proxy_sub, reference=args.reference, runtime=args.runtime)
+    try:
+        servidor.run()
+    finally:
+        servidor.dispatcher.close()
+        servidor.wal.close()
\ No newline at end of file